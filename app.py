@@ -1,47 +1,219 @@
 import os
-from flask import Flask, request, jsonify, send_from_directory, send_file
-from flask_socketio import SocketIO, emit, join_room
+from flask import Flask, Response, request, jsonify, abort
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from datetime import datetime
-import hashlib
-import uuid
-import json
+import atexit
+import logging
+import mimetypes
+import logs
+from persistence import EventLog, migrate_json
+from message import Message
+from passwords import PasswordHasher, HasherBusy
+from history import Retention, RetentionCompactor, RoomHistory
+from search import SearchIndex
+from storage import SQLiteConnections
+from connections import ConnectionRegistry
+from calls import CallRegistry, ENDED
+from typing_indicators import TypingAggregator
+from static_assets import StaticAssets
+from file_responses import FileCache, prepare, wsgi_response
+from previews import PreviewPipeline
+from uploads import BlobStore, ChunkedUploads, UploadError, BLOCK_SIZE
+from presence import PresenceTracker
+from broker import EncodeOnceManager
+from fanout import MessageOutbox
+from subscriptions import Subscriptions, channel
+from metrics import CONTENT_TYPE, ServerMetrics, instrument_events, instrument_flask
+from profiler import MAX_PROFILE_SECONDS, ProfilerBusy, SamplingProfiler, admin_allowed, admin_token, folded
+from ratelimit import RateLimiter, limit_events
+from catchup import catch_up
+from backpressure import Backpressure
+
+logs.setup()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'noknowgram-simple-secret'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", client_manager=EncodeOnceManager())
+# Сообщения и typing - только вкладкам, открывшим комнату (subscriptions.py)
+subscriptions = Subscriptions(socketio.server)
+
+# Метрики для /metrics (metrics.py): задержки событий и маршрутов, рассылка, запись
+metrics = ServerMetrics()
+socketio.server.manager.on_emit = metrics.on_emit
+instrument_flask(app, metrics.routes)
+profiler = SamplingProfiler()
+
+# Лимиты частоты событий от одного соединения (ratelimit.py, RATE_LIMITS)
+rate_limiter = RateLimiter.from_env()
+# Медленные получатели: typing и присутствие откладываются, переполненный сокет отключается (backpressure.py)
+backpressure = Backpressure.from_env(socketio.server, socketio.server.manager.deliver)
+backpressure.on_drop = metrics.on_drop
+socketio.server.manager.backpressure = backpressure
+backpressure.start()
 
 # Создаем папки
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Файл для хранения данных
+# Каталог с данными (манифест + сегменты комнат) и старый файл для переноса
+DATA_DIR = 'chat_data'
 DATA_FILE = 'chat_data.json'
 
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_RESULTS = 100
+
+# Настройки фоновой записи
+app.config['PERSIST_INTERVAL'] = float(os.environ.get('PERSIST_INTERVAL', 0.05))
+app.config['PERSIST_FSYNC'] = os.environ.get('PERSIST_FSYNC', 'interval')
+app.config['PERSIST_COMPACT_EVERY'] = int(os.environ.get('PERSIST_COMPACT_EVERY', 10000))
+
+# История: сколько последних сообщений комнаты держать в памяти и сколько хранить
+app.config['HISTORY_HOT_MESSAGES'] = int(os.environ.get('HISTORY_HOT_MESSAGES', 500))
+app.config['HISTORY_HOT_ROOMS'] = int(os.environ.get('HISTORY_HOT_ROOMS', 1000))
+app.config['RETENTION'] = Retention.from_env()
+app.config['ROOM_RETENTION'] = {}  # room -> Retention, вместо общей политики
+app.config['RETENTION_INTERVAL'] = float(os.environ.get('RETENTION_INTERVAL', 300))
+app.config['UPLOAD_GC_INTERVAL'] = float(os.environ.get('UPLOAD_GC_INTERVAL', 3600))
+app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'txt', 'pdf'}
+app.config['TYPING_INTERVAL'] = int(os.environ.get('TYPING_INTERVAL_MS', 300)) / 1000
+app.config['PRESENCE_INTERVAL'] = int(os.environ.get('PRESENCE_INTERVAL_MS', 250)) / 1000
+app.config['CALL_RING_TIMEOUT'] = float(os.environ.get('CALL_RING_TIMEOUT', 45))
+# Сообщения пачками new_messages вместо new_message на каждое (fanout.py)
+app.config['MESSAGE_BATCHING'] = os.environ.get('MESSAGE_BATCHING', '0') == '1'
+app.config['BATCH_INTERVAL'] = int(os.environ.get('BATCH_INTERVAL_MS', 5)) / 1000
+app.config['BATCH_MAX'] = int(os.environ.get('BATCH_MAX', 100))
+# Токен для /api/admin/* и /metrics (заголовок X-Admin-Token); без него они выключены
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+
+# Однократный перенос истории из chat_data.json
+if os.path.exists(DATA_FILE) and not os.path.exists(os.path.join(DATA_DIR, 'manifest.json')):
+    migrate_json(DATA_FILE, DATA_DIR)
+
+persistence = EventLog(
+    DATA_DIR,
+    interval=app.config['PERSIST_INTERVAL'],
+    fsync=app.config['PERSIST_FSYNC'],
+    compact_every=app.config['PERSIST_COMPACT_EVERY']
+)
+# Вместо save_data(): сколько занимает запись пачки событий на диск
+persistence.on_commit = lambda events, seconds: metrics.saves.observe(seconds, 'event_log')
+
 def load_data():
-    try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {
-            'users': {},
-            'messages': {'general': [], 'friends': [], 'work': []},
-            'online_users': {}
-        }
-
-def save_data():
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump({
-            'users': users_db,
-            'messages': messages_db,
-            'online_users': online_users
-        }, f, ensure_ascii=False, indent=2)
-
-# Загружаем данные
+    return persistence.load()
+
+# Загружаем данные - история комнат подгружается при первом обращении
 data = load_data()
 users_db = data['users']
-messages_db = data['messages']
-online_users = data['online_users']
+connections = ConnectionRegistry()  # sid <-> username, несколько вкладок на пользователя
+# Сессии звонков (calls.py): каждому звонку - своя комната call:<call_id>
+calls = CallRegistry(ring_timeout=app.config['CALL_RING_TIMEOUT'])
+
+# scrypt считается в отдельном пуле с ограниченной очередью (PASSWORD_* в окружении)
+passwords = PasswordHasher.from_env()
+atexit.register(passwords.close)
+messages_db = RoomHistory(
+    persistence.rooms,
+    on_append=lambda room, message: persistence.append({'op': 'message', 'room': room, 'message': message}),
+    hot_size=app.config['HISTORY_HOT_MESSAGES'],
+    max_rooms=app.config['HISTORY_HOT_ROOMS']
+)
+
+# Поиск по истории: индекс FTS5 рядом с сегментами комнат (search.py).
+# При старте доиндексируется всё, что записано в сегменты после индекса.
+search_index = SearchIndex(SQLiteConnections(os.path.join(DATA_DIR, 'search.db')), owned=True)
+atexit.register(search_index.close)
+
+def index_history(batch=1000):
+    for room in persistence.rooms.rooms():
+        log = persistence.rooms.log(room)
+        start = max(search_index.last_seq(room) + 1, log.first_seq)
+        for first in range(start, log.next_seq, batch):
+            messages = log.read(first, min(first + batch, log.next_seq))
+            search_index.add_many(room, [(message.seq, message.text) for message in messages])
+
+index_history()
+
+def retention_for(room):
+    return app.config['ROOM_RETENTION'].get(room, app.config['RETENTION'])
+
+# Сообщения удаляются по срокам хранения вместе со ссылками на их файлы
+def enforce_retention():
+    persistence.rooms.enforce_retention(retention_for, blobs.release_files)
+    for room in persistence.rooms.rooms():
+        search_index.trim(room, persistence.rooms.log(room).first_seq)
+
+retention = RetentionCompactor(enforce_retention, app.config['RETENTION_INTERVAL'])
+
+# Индикаторы набора: один список печатающих на комнату не чаще раза в TYPING_INTERVAL
+typing_state = TypingAggregator(
+    lambda room, users: socketio.emit('typing_set', {'room': room, 'users': users}, to=channel(room)),
+    interval=app.config['TYPING_INTERVAL']
+)
+
+# Файлы хранятся по содержимому (одинаковые - один раз). Незавершённые
+# загрузки по частям; брошенные удаляются раз в UPLOAD_GC_INTERVAL
+blobs = BlobStore(app.config['UPLOAD_FOLDER'])
+atexit.register(blobs.close)
+# Превью картинок, видео и PDF считаются в фоне после загрузки (previews.py)
+previews = PreviewPipeline.from_env(blobs)
+blobs.on_store = previews.on_store
+atexit.register(previews.close)
+upload_cache = FileCache.from_env()
+static_assets = StaticAssets(app.root_path)
+uploads = ChunkedUploads.from_env(app.config['UPLOAD_FOLDER'], blobs, allowed_extensions=app.config['ALLOWED_EXTENSIONS'])
+upload_gc = RetentionCompactor(uploads.collect, app.config['UPLOAD_GC_INTERVAL'])
+
+# Звонок завершён: сообщаем участникам разговора и тем, у кого он ещё звонит
+def finish_call(session, event='call_ended', payload=None, skip_sid=None):
+    audience = [session.room] + [sid for user in session.invitees for sid in connections.sessions(user)]
+    socketio.emit(event, dict(payload or {}, call_id=session.call_id), to=audience, skip_sid=skip_sid)
+    socketio.close_room(session.room)
+
+# Неотвеченные звонки снимаются раз в несколько секунд
+call_reaper = RetentionCompactor(
+    lambda: [finish_call(session, payload={'ended_by': None}) for session in calls.reap()],
+    min(5.0, app.config['CALL_RING_TIMEOUT'])
+)
+
+persistence.start()
+retention.start()
+upload_gc.start()
+call_reaper.start()
+typing_state.start()
+
+if app.config['MESSAGE_BATCHING']:
+    outbox = MessageOutbox(
+        lambda room, messages: socketio.emit('new_messages', {'room': room, 'messages': messages}, to=channel(room)),
+        interval=app.config['BATCH_INTERVAL'],
+        max_batch=app.config['BATCH_MAX']
+    )
+    outbox.start()
+    atexit.register(outbox.stop)
+else:
+    outbox = None
+
+# Присутствие: снимок при входе, дальше - пачки joined/left раз в PRESENCE_INTERVAL.
+# Комнат на сокетах здесь нет, поэтому изменения уходят всем.
+presence = PresenceTracker(
+    lambda payload, to: socketio.emit('presence_delta', payload),
+    interval=app.config['PRESENCE_INTERVAL']
+)
+presence.start()
+atexit.register(persistence.close)
+
+metrics.socket_gauges(socketio.server)
+metrics.gauge('users_online', 'Пользователи онлайн', lambda: len(connections.users()))
+metrics.gauge('subscriptions', 'Вкладки, подписанные на комнату', lambda: len(subscriptions))
+metrics.gauge('calls', 'Звонки: ждут ответа или идут', lambda: len(calls))
+metrics.gauge('parked_sockets', 'Сокеты с отложенными событиями', lambda: len(backpressure))
+metrics.gauge('event_log_healthy', 'Журнал событий пишется на диск (0 - запись не удаётся)',
+              lambda: int(persistence.healthy))
+# Без разбивки по комнатам: имена комнат (private_<a>_<b>) выдают, кто с кем
+# переписывается, а число рядов росло бы с числом пар пользователей
+metrics.gauge('stored_messages', 'Сообщения в истории всех комнат', lambda: sum(messages_db.sizes().values()))
+metrics.gauge('history_rooms', 'Комнаты с историей', lambda: len(persistence.rooms.rooms()))
 
 groups = {
     'general': {'name': 'Общий чат', 'members': []},
@@ -50,20 +222,84 @@ groups = {
 }
 
 # Главная страница
+# Статика - только файлы из списка, из памяти, сжатая (static_assets.py)
+def static_response(name):
+    found = static_assets.respond(name, request.headers.get)
+    if found is None:
+        abort(404)
+    status, headers, body = found
+    return Response(body, status=status, headers=headers)
+
 @app.route('/')
 def serve_index():
-    return send_file('index.html')
+    return static_response('index.html')
 
-# Статические файлы
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('.', path)
+    return static_response(path)
 
-# API для получения сообщений комнаты
+# API для получения сообщений комнаты (постранично, курсоры - номера seq)
 @app.route('/api/messages/<room>')
 def get_messages(room):
-    messages = messages_db.get(room, [])
-    return jsonify({'messages': messages})
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_PAGE_SIZE)
+    messages, next_cursor = messages_db.page(room, before=before, after=after, limit=limit)
+    return jsonify({'messages': [message.to_dict(room) for message in messages], 'next_cursor': next_cursor})
+
+# Поиск по истории: q - слова, каждое ищется и как префикс; room - одна
+# комната (иначе все - сообщения здесь и так видят все); order=rank|recent
+@app.route('/api/search')
+def search_messages():
+    room = request.args.get('room')
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_SEARCH_RESULTS)
+    cursor = max(request.args.get('cursor', 0, type=int), 0)
+    hits, next_cursor = search_index.search(request.args.get('q', ''), {room} if room else None,
+                                            limit=limit, cursor=cursor, order=request.args.get('order', 'rank'))
+    results = []
+    for hit_room, seq in hits:
+        page, _ = messages_db.page(hit_room, after=seq - 1, limit=1)
+        if page and page[0].seq == seq:
+            results.append(page[0].to_dict(hit_room))
+    return jsonify({'results': results, 'next_cursor': next_cursor})
+
+# Админские маршруты и /metrics: без ADMIN_TOKEN их нет, с чужим токеном - 403
+def admin_error():
+    if not app.config['ADMIN_TOKEN']:
+        abort(404)
+    if not admin_allowed(admin_token(request.headers), app.config['ADMIN_TOKEN']):
+        return jsonify({'success': False, 'message': 'Нет доступа'}), 403
+    return None
+
+@app.route('/metrics')
+def serve_metrics():
+    error = admin_error()
+    if error is not None:
+        return error
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+# Профиль по выборкам за seconds секунд (profiler.py) - свёрнутые стеки текстом
+@app.route('/api/admin/profile', methods=['POST'])
+def admin_profile():
+    error = admin_error()
+    if error is not None:
+        return error
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), MAX_PROFILE_SECONDS)
+    interval_ms = request.args.get('interval_ms', type=float)
+    stacks, passes = profiler.run(seconds, interval_ms / 1000 if interval_ms else None)
+    return Response(folded(stacks), content_type='text/plain; charset=utf-8',
+                    headers={'X-Profile-Samples': str(passes)})
+
+@app.errorhandler(ProfilerBusy)
+def profiler_busy(e):
+    return jsonify({'success': False, 'message': 'Профиль уже снимается'}), 409
+
+# Пул хеширования паролей переполнен - просим повторить позже
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    response = jsonify({'success': False, 'message': 'Сервер перегружен, попробуйте позже'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 # API для регистрации/входа
 @app.route('/api/register', methods=['POST'])
@@ -78,11 +314,14 @@ def register():
     if username in users_db:
         return jsonify({'success': False, 'message': 'Пользователь уже существует'})
     
-    users_db[username] = {
-        'password_hash': hashlib.sha256(password.encode()).hexdigest(),
+    user = {
+        'password_hash': passwords.hash(password),
         'created_at': datetime.now().isoformat()
     }
-    save_data()
+    # Пока считался хеш, имя мог занять параллельный запрос
+    if users_db.setdefault(username, user) is not user:
+        return jsonify({'success': False, 'message': 'Пользователь уже существует'})
+    persistence.append({'op': 'user', 'username': username, 'data': user})
     
     return jsonify({'success': True, 'message': 'Пользователь создан'})
 
@@ -96,8 +335,14 @@ def login():
         return jsonify({'success': False, 'message': 'Заполните все поля'})
     
     user = users_db.get(username)
-    if user and user['password_hash'] == hashlib.sha256(password.encode()).hexdigest():
-        return jsonify({'success': True, 'message': 'Успешный вход'})
+    if user:
+        ok, new_hash = passwords.verify(password, user['password_hash'])
+        if new_hash:
+            # Старый sha256 или прежние параметры scrypt - заменяем при входе
+            user = users_db[username] = dict(user, password_hash=new_hash)
+            persistence.append({'op': 'user', 'username': username, 'data': user})
+        if ok:
+            return jsonify({'success': True, 'message': 'Успешный вход'})
     
     return jsonify({'success': False, 'message': 'Неверный логин или пароль'})
 
@@ -111,149 +356,218 @@ def upload_file():
     if file.filename == '':
         return jsonify({'success': False, 'message': 'Файл не выбран'})
     
-    allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'txt', 'pdf'}
     file_ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
     
-    if file_ext not in allowed_extensions:
+    if file_ext not in app.config['ALLOWED_EXTENSIONS']:
         return jsonify({'success': False, 'message': 'Недопустимый тип файла'})
     
-    filename = f"{uuid.uuid4().hex}.{file_ext}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
-    
-    return jsonify({
-        'success': True,
-        'filename': filename,
-        'original_name': file.filename,
-        'url': f'/uploads/{filename}'
-    })
+    writer = blobs.writer()
+    try:
+        for block in iter(lambda: file.stream.read(BLOCK_SIZE), b''):
+            writer.write(block)
+        info = writer.commit(file.filename)
+    finally:
+        writer.close()
+    return jsonify(info)
+
+# Загрузка по частям с докачкой (uploads.py)
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({'success': False, 'message': e.message}), e.status
+
+@app.route('/api/uploads', methods=['POST'])
+def upload_init():
+    data = request.get_json() or {}
+    return jsonify(uploads.init(data.get('name'), data.get('size'), data.get('sha256')))
 
+# Тело - сырые байты диапазона из Content-Range, пишутся на диск блоками
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_range(upload_id):
+    writer = uploads.open_range(upload_id, request.headers.get('Content-Range'))
+    try:
+        for block in iter(lambda: request.stream.read(BLOCK_SIZE), b''):
+            writer.write(block)
+        chunk = writer.commit()
+    finally:
+        writer.close()
+    return jsonify({'success': True, 'chunk': chunk})
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    return jsonify(uploads.status(upload_id))
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    return jsonify(uploads.finalize(upload_id))
+
+# Такой файл уже есть - ссылка на него по proof из ответа на создание загрузки
+@app.route('/api/uploads/<upload_id>/dedup', methods=['POST'])
+def upload_dedup(upload_id):
+    data = request.get_json() or {}
+    return jsonify(uploads.dedup(upload_id, data.get('proof')))
+
+# Имена загрузок уникальны и не меняются: ETag, immutable, Range (file_responses.py)
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    found = blobs.resolve(filename)
+    if found is None:
+        abort(404)
+    path, etag = found
+    # Блоб лежит без расширения, тип берём из имени в ссылке
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    plan = prepare(path, etag, content_type, request.headers.get, cache=upload_cache)
+    return wsgi_response(plan, request.environ)
+
+@app.route('/previews/<name>')
+def preview_file(name):
+    found = previews.resolve(name)
+    if found is None:
+        abort(404)
+    path, etag = found
+    plan = prepare(path, etag, 'image/jpeg', request.headers.get, cache=upload_cache)
+    return wsgi_response(plan, request.environ)
 
 # WebSocket события
 @socketio.on('connect')
 def handle_connect():
-    print(f'Client connected: {request.sid}')
+    connections.connect(request.sid)
+    logger.debug('Client connected: %s', request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    for username, data in list(online_users.items()):
-        if data.get('sid') == request.sid:
-            del online_users[username]
-            emit('user_left', {'username': username}, broadcast=True)
-            emit('online_users', {'users': list(online_users.keys())}, broadcast=True)
-            save_data()
-            break
+    conn, last_session = connections.disconnect(request.sid)
+    subscriptions.drop(request.sid)
+    # Вкладка была в звонке - она из него выходит
+    if conn is not None and conn.username is not None:
+        for session in calls.disconnect(request.sid, conn.username, last_session):
+            if session.state == ENDED:
+                finish_call(session, payload={'ended_by': conn.username})
+    # Пользователь ушёл, только когда закрыта его последняя вкладка
+    if last_session:
+        typing_state.clear(conn.username)
+        presence.offline(conn.username)
 
 @socketio.on('user_join')
 def handle_user_join(data):
     username = data['username']
-    online_users[username] = {'sid': request.sid, 'joined_at': datetime.now().isoformat()}
-    emit('user_joined', {'username': username}, broadcast=True)
-    emit('online_users', {'users': list(online_users.keys())}, broadcast=True)
-    save_data()
+    if connections.bind(request.sid, username):
+        presence.online(username)
+    version, users = presence.snapshot()
+    emit('presence_snapshot', {'version': version, 'users': users}, room=request.sid)
+
+# Вкладка открыла комнату - дальше получает только её сообщения
+@socketio.on('join_room')
+def handle_join_room(data):
+    subscriptions.switch(request.sid, data.get('room', 'general'))
 
 @socketio.on('send_message')
 def handle_message(data):
     room = data.get('room', 'general')
     
-    if room not in messages_db:
-        messages_db[room] = []
+    message = Message.from_event(data)
+    # Файл - только свой: token приходит в ответе на загрузку, ссылка
+    # сообщения учитывается, чтобы файл не удалился, пока на него ссылаются
+    if message.file and not blobs.attach(message.file, data.get('file_token')):
+        emit('message_rejected', {'reason': 'file'}, room=request.sid)
+        return
     
-    message = {
-        'id': str(uuid.uuid4()),
-        'username': data['username'],
-        'text': data.get('text', ''),
-        'file': data.get('file'),
-        'timestamp': datetime.now().isoformat(),
-        'type': data.get('type', 'text'),
-        'room': room
-    }
-    
-    messages_db[room].append(message)
+    # Получает номер seq и уходит в журнал (запись на диск - в фоновом потоке)
+    messages_db.append(room, message)
+    search_index.add(room, message.seq, message.text)
     
-    # Сохраняем в файл
-    save_data()
-    
-    # Отправляем всем
-    emit('new_message', message, broadcast=True)
+    # Отправляем открывшим комнату
+    if outbox is not None:
+        outbox.add(room, message.to_dict(room))
+    else:
+        emit('new_message', message.to_dict(room), room=channel(room))
+
+# Догон после переподключения или возврата в комнату: только пропущенное (catchup.py)
+@socketio.on('sync')
+def handle_sync(data):
+    emit('synced', {'rooms': catch_up(messages_db.page, data.get('rooms'))}, room=request.sid)
 
 @socketio.on('typing')
 def handle_typing(data):
-    emit('user_typing', {
-        'username': data['username'],
-        'is_typing': data['is_typing']
-    }, broadcast=True)
+    typing_state.update(data.get('room', 'general'), data['username'], data['is_typing'])
 
-# WebRTC signaling - ФИКСИРОВАННЫЕ ЗВОНКИ
+# ЗВОНКИ: сессия на call_id (calls.py), события - только её участникам
 @socketio.on('start_call')
 def handle_start_call(data):
-    # Отправляем только конкретному пользователю
-    target_user = online_users.get(data.get('target'))
-    if target_user:
-        emit('incoming_call', {
-            'caller': data['username'],
-            'type': data.get('type', 'voice'),
-            'call_id': data.get('call_id')
-        }, room=target_user['sid'])
+    # Звоним только конкретному пользователю, если он онлайн. Сессии
+    # читаются один раз: пустой room= python-socketio шлёт всем
+    target = data.get('target')
+    sessions = connections.sessions(target)
+    if not sessions:
+        return
+    session = calls.start(data.get('call_id'), data['username'], request.sid, [target], type=data.get('type', 'voice'))
+    if session is None:
+        return
+    join_room(session.room)
+    emit('incoming_call', {
+        'caller': data['username'],
+        'type': data.get('type', 'voice'),
+        'call_id': data.get('call_id')
+    }, room=sessions)
 
 @socketio.on('accept_call')
 def handle_accept_call(data):
     # Уведомляем звонящего, что звонок принят
-    caller_user = online_users.get(data['caller'])
-    if caller_user:
+    session = calls.accept(data['call_id'], data['username'], request.sid)
+    if session is not None:
+        join_room(session.room)
         emit('call_accepted', {
             'accepted_by': data['username'],
             'call_id': data['call_id']
-        }, room=caller_user['sid'])
+        }, room=session.room, include_self=False)
 
 @socketio.on('reject_call')
 def handle_reject_call(data):
     # Уведомляем звонящего, что звонок отклонен
-    caller_user = online_users.get(data['caller'])
-    if caller_user:
-        emit('call_rejected', {
-            'rejected_by': data['username'],
-            'call_id': data['call_id']
-        }, room=caller_user['sid'])
+    session = calls.reject(data['call_id'], data['username'])
+    if session is not None and session.state == ENDED:
+        finish_call(session, 'call_rejected', {'rejected_by': data['username']})
 
 @socketio.on('end_call')
 def handle_end_call(data):
-    emit('call_ended', {
-        'ended_by': data['username'],
-        'call_id': data.get('call_id')
-    }, broadcast=True)
+    session = calls.leave(data.get('call_id'), data['username'])
+    if session is None:
+        return
+    if session.state == ENDED:
+        finish_call(session, payload={'ended_by': data['username']}, skip_sid=request.sid)
+    else:
+        leave_room(session.room)
+
+# WebRTC signaling - только между участниками звонка. Если start_call
+# этого звонка ещё не обработан, сигнал уйдёт из него - обработчик не ждёт
+def relay_signal(event, data, payload):
+    calls.signal(data.get('call_id'), connections.username(request.sid), data.get('target_user'),
+                 connections.sessions, lambda sessions: socketio.emit(event, payload, room=sessions))
 
-# WebRTC signaling
 @socketio.on('webrtc_offer')
 def handle_webrtc_offer(data):
-    target_user = online_users.get(data['target_user'])
-    if target_user:
-        emit('webrtc_offer', {
-            'offer': data['offer'],
-            'caller': data['caller'],
-            'call_id': data['call_id']
-        }, room=target_user['sid'])
+    relay_signal('webrtc_offer', data, {
+        'offer': data['offer'],
+        'caller': data['caller'],
+        'call_id': data['call_id']
+    })
 
 @socketio.on('webrtc_answer')
 def handle_webrtc_answer(data):
-    target_user = online_users.get(data['target_user'])
-    if target_user:
-        emit('webrtc_answer', {
-            'answer': data['answer'],
-            'call_id': data['call_id']
-        }, room=target_user['sid'])
+    relay_signal('webrtc_answer', data, {
+        'answer': data['answer'],
+        'call_id': data['call_id']
+    })
 
 @socketio.on('webrtc_ice_candidate')
 def handle_webrtc_ice_candidate(data):
-    target_user = online_users.get(data['target_user'])
-    if target_user:
-        emit('webrtc_ice_candidate', {
-            'candidate': data['candidate'],
-            'call_id': data['call_id']
-        }, room=target_user['sid'])
+    relay_signal('webrtc_ice_candidate', data, {
+        'candidate': data['candidate'],
+        'call_id': data['call_id']
+    })
+
+# Все обработчики зарегистрированы - лимиты частоты и замер времени
+limit_events(socketio.server, rate_limiter, on_limited=metrics.on_limited)
+instrument_events(socketio.server, metrics.events)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
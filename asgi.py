@@ -0,0 +1,746 @@
+import os
+import asyncio
+import atexit
+import logging
+import mimetypes
+import uuid
+from datetime import datetime
+
+import socketio
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from storage import create_storage
+from connections import ConnectionRegistry, SQLiteConnectionRegistry
+from calls import CallRegistry, SQLiteCallRegistry, ENDED
+from broker import client_manager
+from typing_indicators import TypingAggregator
+from presence import PresenceTracker
+from fanout import MessageOutbox
+from subscriptions import Subscriptions, channel
+from message import Message
+from passwords import PasswordHasher, HasherBusy
+from history import Retention, RetentionCompactor
+from static_assets import StaticAssets
+from file_responses import ASGIFileResponse, FileCache, prepare
+from previews import PreviewPipeline
+from uploads import BlobStore, ChunkedUploads, UploadError, BLOCK_SIZE
+from metrics import CONTENT_TYPE, ASGIRouteMetrics, ServerMetrics, instrument_events
+from profiler import MAX_PROFILE_SECONDS, ProfilerBusy, SamplingProfiler, admin_allowed, admin_token, folded
+from ratelimit import RateLimiter, limit_events
+from catchup import catch_up
+from backpressure import Backpressure
+import logs
+
+# Асинхронный режим server.py: python-socketio AsyncServer поверх ASGI.
+# Соединение - это корутина, а не поток ОС, поэтому тысячи открытых
+# WebSocket не упираются в лимиты потоков и памяти Werkzeug.
+# События и HTTP API те же, что в server.py, хранилище и фоновые
+# агрегаторы (присутствие, typing, сроки хранения) - общие модули.
+# Запуск: SERVER_MODE=asgi python run.py (см. run.py).
+
+UPLOAD_FOLDER = 'uploads'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'noknowgram.db')
+HISTORY_HOT_MESSAGES = int(os.environ.get('HISTORY_HOT_MESSAGES', 500))
+RETENTION = Retention.from_env()
+ROOM_RETENTION = {}  # room -> Retention, вместо общей политики
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 300))
+UPLOAD_GC_INTERVAL = float(os.environ.get('UPLOAD_GC_INTERVAL', 3600))
+TYPING_INTERVAL = int(os.environ.get('TYPING_INTERVAL_MS', 300)) / 1000
+PRESENCE_INTERVAL = int(os.environ.get('PRESENCE_INTERVAL_MS', 250)) / 1000
+CALL_RING_TIMEOUT = float(os.environ.get('CALL_RING_TIMEOUT', 45))
+MESSAGE_BATCHING = os.environ.get('MESSAGE_BATCHING', '0') == '1'
+BATCH_INTERVAL = int(os.environ.get('BATCH_INTERVAL_MS', 5)) / 1000
+BATCH_MAX = int(os.environ.get('BATCH_MAX', 100))
+# Очередь для нескольких воркеров: sqlite:///путь (один хост) или redis://...
+MESSAGE_QUEUE = os.environ.get('MESSAGE_QUEUE')
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_RESULTS = 100
+# Токен для /api/admin/* и /metrics (X-Admin-Token); без него они выключены
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+PUBLIC_ROOMS = ('general', 'random', 'help')
+
+logs.setup()
+logger = logging.getLogger(__name__)
+
+if MESSAGE_QUEUE and STORAGE_BACKEND != 'sqlite':
+    raise SystemExit('MESSAGE_QUEUE требует STORAGE_BACKEND=sqlite: история и группы должны быть общими')
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*',
+                           client_manager=client_manager(MESSAGE_QUEUE, asyncio_mode=True))
+# Сообщения и typing - только вкладкам, открывшим комнату (subscriptions.py)
+subscriptions = Subscriptions(sio)
+
+# Метрики для /metrics (metrics.py): задержки событий и маршрутов, рассылка, запись
+metrics = ServerMetrics()
+sio.manager.on_emit = metrics.on_emit
+profiler = SamplingProfiler()
+# Лимиты частоты событий от одного соединения (ratelimit.py, RATE_LIMITS)
+rate_limiter = RateLimiter.from_env()
+
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+storage = create_storage(STORAGE_BACKEND, DATABASE_PATH, hot_size=HISTORY_HOT_MESSAGES)
+atexit.register(storage.close)
+
+passwords = PasswordHasher.from_env()
+atexit.register(passwords.close)
+
+if MESSAGE_QUEUE:
+    connections = SQLiteConnectionRegistry(DATABASE_PATH)
+else:
+    connections = ConnectionRegistry()
+atexit.register(connections.close)
+
+if MESSAGE_QUEUE:
+    calls = SQLiteCallRegistry(DATABASE_PATH, ring_timeout=CALL_RING_TIMEOUT)
+else:
+    calls = CallRegistry(ring_timeout=CALL_RING_TIMEOUT)
+atexit.register(calls.close)
+
+metrics.socket_gauges(sio)
+metrics.gauge('users_online', 'Пользователи онлайн', lambda: len(connections.users()))
+metrics.gauge('subscriptions', 'Вкладки, подписанные на комнату', lambda: len(subscriptions))
+metrics.gauge('calls', 'Звонки: ждут ответа или идут', lambda: len(calls))
+metrics.gauge('parked_sockets', 'Сокеты с отложенными событиями', lambda: len(backpressure))
+# Без разбивки по комнатам: имена комнат (private_<a>_<b>) выдают, кто с кем
+# переписывается, а число рядов росло бы с числом пар пользователей
+metrics.gauge('stored_messages', 'Сообщения в истории всех комнат', lambda: sum(storage.room_sizes().values()))
+metrics.gauge('history_rooms', 'Комнаты с историей', lambda: len(storage.rooms()))
+
+# Цикл событий сервера - фоновые потоки отправляют через него
+loop = None
+
+
+def emit_threadsafe(event, data, to=None):
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(sio.emit(event, data, to=to), loop)
+
+
+def deliver_threadsafe(sid, event, data, namespace):
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(sio.manager.deliver(sid, event, data, namespace), loop)
+
+
+# Медленные получатели: typing и присутствие откладываются, переполненный сокет отключается (backpressure.py)
+backpressure = Backpressure.from_env(sio, deliver_threadsafe)
+backpressure.on_drop = metrics.on_drop
+sio.manager.backpressure = backpressure
+
+
+# С MESSAGE_QUEUE реестры соединений и звонков - SQLite с BEGIN IMMEDIATE:
+# занятая блокировка не должна останавливать цикл событий, поэтому их вызовы
+# идут через run_in_threadpool (несколько подряд - одним заходом).
+def sessions_of(users):
+    return [sid for user in users for sid in connections.sessions(user)]
+
+
+# Звонок завершён: сообщаем участникам разговора и тем, у кого он ещё звонит
+async def finish_call(session, event='call_ended', payload=None, skip_sid=None):
+    audience = [session.room] + await run_in_threadpool(sessions_of, session.invitees)
+    await sio.emit(event, dict(payload or {}, call_id=session.call_id), to=audience, skip_sid=skip_sid)
+    await sio.close_room(session.room)
+
+
+def reap_calls():
+    for session in calls.reap():
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(finish_call(session, payload={'ended_by': None}), loop)
+
+
+def retention_for(room):
+    return ROOM_RETENTION.get(room, RETENTION)
+
+
+def presence_audience(username):
+    members = {member for group in storage.get_user_groups(username) for member in group['members']}
+    members.discard(username)
+    return sessions_of(members)
+
+
+call_reaper = RetentionCompactor(reap_calls, min(5.0, CALL_RING_TIMEOUT))
+blobs = BlobStore(UPLOAD_FOLDER)
+atexit.register(blobs.close)
+# Сообщения удаляются по срокам хранения вместе со ссылками на их файлы
+retention = RetentionCompactor(lambda: storage.enforce_retention(retention_for, blobs.release_files),
+                               RETENTION_INTERVAL)
+# Превью картинок, видео и PDF считаются в фоне после загрузки (previews.py)
+previews = PreviewPipeline.from_env(blobs)
+blobs.on_store = previews.on_store
+atexit.register(previews.close)
+upload_cache = FileCache.from_env()
+static_assets = StaticAssets()
+uploads = ChunkedUploads.from_env(UPLOAD_FOLDER, blobs)
+upload_gc = RetentionCompactor(uploads.collect, UPLOAD_GC_INTERVAL)
+typing_state = TypingAggregator(
+    lambda room, users: emit_threadsafe('typing_set', {'room': room, 'users': users, 'source': os.getpid()}, to=channel(room)),
+    interval=TYPING_INTERVAL
+)
+presence = PresenceTracker(
+    lambda payload, to: emit_threadsafe('presence_delta', payload, to=to),
+    audience=presence_audience,
+    room_audience=connections.room_sessions,
+    interval=PRESENCE_INTERVAL
+)
+# Сообщения пачками new_messages вместо new_message на каждое (fanout.py)
+outbox = MessageOutbox(
+    lambda room, messages: emit_threadsafe('new_messages', {'room': room, 'messages': messages}, to=channel(room)),
+    interval=BATCH_INTERVAL,
+    max_batch=BATCH_MAX
+) if MESSAGE_BATCHING else None
+
+
+async def on_startup():
+    global loop
+    loop = asyncio.get_running_loop()
+    retention.start()
+    upload_gc.start()
+    call_reaper.start()
+    typing_state.start()
+    presence.start()
+    backpressure.start()
+    if outbox is not None:
+        outbox.start()
+
+
+async def on_shutdown():
+    if outbox is not None:
+        outbox.stop()
+    presence.stop()
+    backpressure.stop()
+    typing_state.stop()
+    retention.stop()
+    upload_gc.stop()
+    call_reaper.stop()
+
+
+def int_arg(request, name, default=None):
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def float_arg(request, name, default=None):
+    try:
+        return float(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+# Статика - только файлы из списка, из памяти, сжатая (static_assets.py)
+def static_response(request, name):
+    found = static_assets.respond(name, request.headers.get)
+    if found is None:
+        return Response(status_code=404)
+    status, headers, body = found
+    return Response(body, status_code=status, headers=dict(headers))
+
+
+async def serve_index(request):
+    return static_response(request, 'index.html')
+
+
+async def serve_static(request):
+    return static_response(request, request.path_params['path'])
+
+
+# Админские маршруты и /metrics: без ADMIN_TOKEN их нет, с чужим токеном - 403
+def admin_error(request):
+    if not ADMIN_TOKEN:
+        return Response(status_code=404)
+    if not admin_allowed(admin_token(request.headers), ADMIN_TOKEN):
+        return JSONResponse({'success': False, 'message': 'Нет доступа'}, status_code=403)
+    return None
+
+
+async def serve_metrics(request):
+    error = admin_error(request)
+    if error is not None:
+        return error
+    # gauge ходят в хранилище и реестры
+    return Response(await run_in_threadpool(metrics.render), headers={'Content-Type': CONTENT_TYPE})
+
+
+# Профиль по выборкам (profiler.py): окно ждёт в пуле потоков, цикл событий
+# работает дальше и попадает в профиль
+async def admin_profile(request):
+    error = admin_error(request)
+    if error is not None:
+        return error
+    seconds = min(max(float_arg(request, 'seconds', 10), 0.1), MAX_PROFILE_SECONDS)
+    interval_ms = float_arg(request, 'interval_ms')
+    stacks, passes = await run_in_threadpool(profiler.run, seconds, interval_ms / 1000 if interval_ms else None)
+    return Response(folded(stacks), media_type='text/plain', headers={'X-Profile-Samples': str(passes)})
+
+
+async def profiler_busy(request, exc):
+    return JSONResponse({'success': False, 'message': 'Профиль уже снимается'}, status_code=409)
+
+
+# Пул хеширования паролей переполнен - просим повторить позже
+async def hasher_busy(request, exc):
+    return JSONResponse({'success': False, 'message': 'Сервер перегружен, попробуйте позже'},
+                        status_code=503, headers={'Retry-After': '1'})
+
+
+async def register(request):
+    data = await request.json()
+    username = data.get('username', '').strip()
+    password = data.get('password', '')
+
+    if not username or not password:
+        return JSONResponse({'success': False, 'message': 'Заполните все поля'})
+
+    if await run_in_threadpool(storage.get_user, username):
+        return JSONResponse({'success': False, 'message': 'Пользователь уже существует'})
+
+    password_hash = await passwords.hash_async(password)
+    if not await run_in_threadpool(storage.create_user, username, password_hash, datetime.now().isoformat()):
+        return JSONResponse({'success': False, 'message': 'Пользователь уже существует'})
+
+    return JSONResponse({'success': True, 'message': 'Пользователь создан'})
+
+
+async def login(request):
+    data = await request.json()
+    username = data.get('username', '').strip()
+    password = data.get('password', '')
+
+    if not username or not password:
+        return JSONResponse({'success': False, 'message': 'Заполните все поля'})
+
+    user = await run_in_threadpool(storage.get_user, username)
+    if user:
+        ok, new_hash = await passwords.verify_async(password, user['password_hash'])
+        if new_hash:
+            # Старый sha256 или прежние параметры scrypt - заменяем при входе
+            await run_in_threadpool(storage.set_password_hash, username, new_hash)
+        if ok:
+            return JSONResponse({'success': True, 'message': 'Успешный вход'})
+
+    return JSONResponse({'success': False, 'message': 'Неверный логин или пароль'})
+
+
+async def get_messages(request):
+    room = request.path_params['room']
+    before = int_arg(request, 'before')
+    after = int_arg(request, 'after')
+    limit = min(max(int_arg(request, 'limit', 100), 1), MAX_PAGE_SIZE)
+    messages, next_cursor = await run_in_threadpool(storage.get_messages, room, before=before, after=after,
+                                                    limit=limit)
+    return JSONResponse({'messages': [message.to_dict(room) for message in messages], 'next_cursor': next_cursor})
+
+
+# Комнаты, чью историю видит пользователь: общие, его группы и личные
+# чаты private_<a>_<b> (имена отсортированы)
+def search_rooms(username):
+    rooms = set(PUBLIC_ROOMS)
+    rooms.update(group['id'] for group in storage.get_user_groups(username))
+    for room in storage.rooms():
+        names = room[len('private_'):]
+        if room.startswith('private_') and (names.startswith(username + '_') or names.endswith('_' + username)):
+            rooms.add(room)
+    return rooms
+
+
+# Поиск по истории (search.py), параметры - как в server.py
+async def search_messages(request):
+    params = request.query_params
+    rooms = await run_in_threadpool(search_rooms, params.get('username', ''))
+    room = params.get('room')
+    if room is not None:
+        if room not in rooms:
+            return JSONResponse({'success': False, 'message': 'Нет доступа к комнате'}, status_code=403)
+        rooms = {room}
+    limit = min(max(int_arg(request, 'limit', 20), 1), MAX_SEARCH_RESULTS)
+    cursor = max(int_arg(request, 'cursor', 0), 0)
+    found, next_cursor = await run_in_threadpool(storage.search, params.get('q', ''), rooms, limit=limit,
+                                                 cursor=cursor, order=params.get('order', 'rank'))
+    return JSONResponse({'results': [message.to_dict(room) for room, message in found], 'next_cursor': next_cursor})
+
+
+async def create_group(request):
+    data = await request.json()
+    group_name = data.get('name', '').strip()
+    creator = data.get('creator', '')
+    members = data.get('members', [])
+
+    if not group_name or not creator:
+        return JSONResponse({'success': False, 'message': 'Неверные данные'})
+
+    group = await run_in_threadpool(storage.create_group, {
+        'id': f"group_{uuid.uuid4().hex[:8]}",
+        'name': group_name,
+        'creator': creator,
+        'members': list(set([creator] + members)),
+        'created_at': datetime.now().isoformat()
+    })
+
+    return JSONResponse({'success': True, 'group': group})
+
+
+async def get_user_groups(request):
+    groups = await run_in_threadpool(storage.get_user_groups, request.path_params['username'])
+    return JSONResponse({'groups': groups})
+
+
+async def upload_file(request):
+    form = await request.form()
+    file = form.get('file')
+    if file is None or not getattr(file, 'filename', ''):
+        return JSONResponse({'success': False, 'message': 'Файл не выбран'})
+
+    # Запись на диск, sha256 и индекс - в пуле потоков, не в цикле событий
+    writer = await run_in_threadpool(blobs.writer)
+    try:
+        while True:
+            chunk = await file.read(BLOCK_SIZE)
+            if not chunk:
+                break
+            await run_in_threadpool(writer.write, chunk)
+        info = await run_in_threadpool(writer.commit, file.filename)
+    finally:
+        await run_in_threadpool(writer.close)
+    return JSONResponse(info)
+
+
+# Загрузка по частям с докачкой (uploads.py)
+async def upload_error(request, exc):
+    return JSONResponse({'success': False, 'message': exc.message}, status_code=exc.status)
+
+
+async def upload_init(request):
+    data = await request.json()
+    return JSONResponse(await run_in_threadpool(uploads.init, data.get('name'), data.get('size'), data.get('sha256')))
+
+
+# Тело - сырые байты диапазона из Content-Range, пишутся на диск по мере прихода
+# (запись - в пуле потоков, цикл событий только принимает байты)
+async def upload_range(request):
+    writer = await run_in_threadpool(uploads.open_range, request.path_params['upload_id'],
+                                     request.headers.get('content-range'))
+    try:
+        async for block in request.stream():
+            if block:
+                await run_in_threadpool(writer.write, block)
+        chunk = await run_in_threadpool(writer.commit)
+    finally:
+        await run_in_threadpool(writer.close)
+    return JSONResponse({'success': True, 'chunk': chunk})
+
+
+async def upload_status(request):
+    return JSONResponse(await run_in_threadpool(uploads.status, request.path_params['upload_id']))
+
+
+async def upload_finalize(request):
+    return JSONResponse(await run_in_threadpool(uploads.finalize, request.path_params['upload_id']))
+
+
+# Такой файл уже есть - ссылка на него по proof из ответа на создание загрузки
+async def upload_dedup(request):
+    data = await request.json()
+    return JSONResponse(await run_in_threadpool(uploads.dedup, request.path_params['upload_id'], data.get('proof')))
+
+
+# Имена загрузок уникальны и не меняются: ETag, immutable, Range (file_responses.py)
+async def uploaded_file(request):
+    filename = request.path_params['filename']
+    found = await run_in_threadpool(blobs.resolve, filename)
+    if found is None:
+        return Response(status_code=404)
+    path, etag = found
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    plan = prepare(path, etag, content_type, request.headers.get, cache=upload_cache)
+    return ASGIFileResponse(plan)
+
+
+# Превью может ещё считаться - ждём его в пуле потоков, не в цикле событий
+async def preview_file(request):
+    found = await run_in_threadpool(previews.resolve, request.path_params['name'])
+    if found is None:
+        return Response(status_code=404)
+    path, etag = found
+    return ASGIFileResponse(prepare(path, etag, 'image/jpeg', request.headers.get, cache=upload_cache))
+
+
+http = Starlette(
+    routes=[
+        Route('/', serve_index),
+        Route('/metrics', serve_metrics),
+        Route('/api/admin/profile', admin_profile, methods=['POST']),
+        Route('/api/register', register, methods=['POST']),
+        Route('/api/login', login, methods=['POST']),
+        Route('/api/messages/{room}', get_messages),
+        Route('/api/search', search_messages),
+        Route('/api/groups/create', create_group, methods=['POST']),
+        Route('/api/groups/{username}', get_user_groups),
+        Route('/api/upload', upload_file, methods=['POST']),
+        Route('/api/uploads', upload_init, methods=['POST']),
+        Route('/api/uploads/{upload_id}', upload_range, methods=['PUT']),
+        Route('/api/uploads/{upload_id}', upload_status, methods=['GET']),
+        Route('/api/uploads/{upload_id}/finalize', upload_finalize, methods=['POST']),
+        Route('/api/uploads/{upload_id}/dedup', upload_dedup, methods=['POST']),
+        Route('/uploads/{filename}', uploaded_file),
+        Route('/previews/{name}', preview_file),
+        Route('/{path:path}', serve_static),
+    ],
+    exception_handlers={HasherBusy: hasher_busy, UploadError: upload_error, ProfilerBusy: profiler_busy}
+)
+
+app = socketio.ASGIApp(sio, ASGIRouteMetrics(http, metrics.routes, http.routes),
+                       on_startup=on_startup, on_shutdown=on_shutdown)
+
+
+# WebSocket события
+@sio.event
+async def connect(sid, environ):
+    connections.connect(sid)
+    logger.debug('Client connected: %s', sid)
+
+
+# sid -> asyncio.Event, пока user_join этой вкладки регистрирует её в реестре:
+# join_room и disconnect той же вкладки ждут, иначе disconnect мог бы
+# пройти раньше bind и оставить в реестре сессию закрытого сокета
+joining_users = {}
+
+
+async def user_joined(sid):
+    joining = joining_users.get(sid)
+    if joining is not None:
+        await joining.wait()
+
+
+@sio.event
+async def disconnect(sid):
+    await user_joined(sid)
+    conn, last_session = await run_in_threadpool(connections.disconnect, sid)
+    subscriptions.drop(sid)
+    if conn is not None and conn.username is not None:
+        ended = await run_in_threadpool(calls.disconnect, sid, conn.username, last_session)
+        for session in ended:
+            if session.state == ENDED:
+                await finish_call(session, payload={'ended_by': conn.username})
+    # Пользователь ушёл, только когда закрыта его последняя вкладка
+    if last_session:
+        typing_state.clear(conn.username)
+        presence.offline(conn.username)
+
+
+# Общий чат - для всех, в нём пользователь виден каждому онлайн.
+# True - первая вкладка пользователя.
+def bind_user(sid, username):
+    first = connections.bind(sid, username)
+    connections.join_room(sid, 'general')
+    return first
+
+
+def online_for(sid, users):
+    conn = connections.get(sid)
+    return sorted(connections.online_in(rooms=conn.rooms if conn is not None else (), users=users))
+
+
+@sio.on('user_join')
+async def handle_user_join(sid, data):
+    username = data['username']
+    # Отметка ставится до первого await, как у start_call
+    joining = joining_users[sid] = asyncio.Event()
+    try:
+        first = await run_in_threadpool(bind_user, sid, username)
+    finally:
+        joining.set()
+        if joining_users.get(sid) is joining:
+            del joining_users[sid]
+    if first:
+        presence.online(username)
+    presence.enter_room(username, 'general')
+
+    groups = await run_in_threadpool(storage.get_user_groups, username)
+    members = {member for group in groups for member in group['members']}
+    version = presence.stamp()
+    users = await run_in_threadpool(online_for, sid, members)
+    await sio.emit('presence_snapshot', {'version': version, 'users': users}, to=sid)
+    await sio.emit('user_groups', {'groups': groups}, to=sid)
+
+
+@sio.on('join_room')
+async def handle_join_room(sid, data):
+    room = data.get('room', 'general')
+    await user_joined(sid)
+    # Присутствие копится по всем открытым комнатам (в реестре подключений,
+    # не в комнатах Socket.IO), трафик - только текущей
+    await run_in_threadpool(connections.join_room, sid, room)
+    subscriptions.switch(sid, room)
+    username = connections.username(sid)
+    if username is not None:
+        presence.enter_room(username, room)
+    version = presence.stamp()
+    users = sorted(await run_in_threadpool(connections.online_in, [room]))
+    await sio.emit('presence_snapshot', {'version': version, 'users': users, 'room': room}, to=sid)
+
+
+@sio.on('send_message')
+async def handle_message(sid, data):
+    room = data.get('room', 'general')
+    message = Message.from_event(data)
+    # Файл - только свой: token приходит в ответе на загрузку, ссылка
+    # сообщения учитывается, чтобы файл не удалился, пока на него ссылаются
+    if message.file and not await run_in_threadpool(blobs.attach, message.file, data.get('file_token')):
+        await sio.emit('message_rejected', {'reason': 'file'}, to=sid)
+        return
+    with metrics.saves.time('message'):
+        await run_in_threadpool(storage.add_message, room, message)
+    if outbox is not None:
+        outbox.add(room, message.to_dict(room))
+    else:
+        await sio.emit('new_message', message.to_dict(room), to=channel(room))
+
+
+# Догон после переподключения или возврата в комнату: только пропущенное (catchup.py)
+@sio.on('sync')
+async def handle_sync(sid, data):
+    rooms = await run_in_threadpool(catch_up, storage.get_messages, data.get('rooms'))
+    await sio.emit('synced', {'rooms': rooms}, to=sid)
+
+
+@sio.on('typing')
+async def handle_typing(sid, data):
+    typing_state.update(data.get('room', 'general'), data['username'], data['is_typing'])
+
+
+# Звонки: сессия на call_id (calls.py), события - только её участникам.
+# Пока start_call ждёт хранилище, сигналинг того же звонка ждёт его:
+# call_id -> asyncio.Event
+starting_calls = {}
+
+
+# Сессии читаются один раз: пустой to= python-socketio шлёт всем.
+# -> (сессия или None, {участник: его sid})
+def ring(call_id, caller, sid, members, call_type, group):
+    online = {member: connections.sessions(member) for member in members}
+    invitees = [member for member, sids in online.items() if sids]
+    return calls.start(call_id, caller, sid, invitees, type=call_type, group=group), online
+
+
+@sio.on('start_call')
+async def handle_start_call(sid, data):
+    target = data.get('target')
+    call_type = data.get('type', 'voice')
+    call_id = data.get('call_id')
+    caller = data.get('username')
+
+    # Отметка ставится до первого await: оффер того же клиента идёт следом
+    started = starting_calls[call_id] = asyncio.Event()
+    try:
+        group = await run_in_threadpool(storage.get_group, target) if target.startswith('group_') else None
+        session, online = await run_in_threadpool(ring, call_id, caller, sid, group['members'] if group else [target],
+                                                  call_type, target if group else None)
+    finally:
+        started.set()
+        if starting_calls.get(call_id) is started:
+            del starting_calls[call_id]
+    if session is None:
+        # Некому звонить (пользователь не онлайн) - уведомляем звонящего
+        await sio.emit('call_rejected', {'rejected_by': group['name'] if group else target, 'call_id': call_id}, to=sid)
+        return
+
+    sio.enter_room(sid, session.room)
+    sessions = [s for member in session.invitees for s in online.get(member, ())]
+    if not sessions:
+        return
+    await sio.emit('incoming_call', {
+        'caller': caller,
+        'type': call_type,
+        'call_id': call_id,
+        'is_group': bool(group),
+        'group_name': group['name'] if group else None
+    }, to=sessions)
+
+
+@sio.on('accept_call')
+async def handle_accept_call(sid, data):
+    session = await run_in_threadpool(calls.accept, data['call_id'], data['username'], sid)
+    if session is None:
+        return
+    sio.enter_room(sid, session.room)
+    await sio.emit('call_accepted', {'accepted_by': data['username'], 'call_id': data['call_id']},
+                   to=session.room, skip_sid=sid)
+
+
+@sio.on('reject_call')
+async def handle_reject_call(sid, data):
+    # Звонящему сообщаем, только когда отказались все, кому звонили
+    session = await run_in_threadpool(calls.reject, data['call_id'], data['username'])
+    if session is not None and session.state == ENDED:
+        await finish_call(session, 'call_rejected', {'rejected_by': data['username']})
+
+
+@sio.on('end_call')
+async def handle_end_call(sid, data):
+    session = await run_in_threadpool(calls.leave, data.get('call_id'), data.get('username'))
+    if session is None:
+        return
+    if session.state == ENDED:
+        await finish_call(session, payload={'ended_by': data.get('username')}, skip_sid=sid)
+    else:
+        sio.leave_room(sid, session.room)
+
+
+# WebRTC signaling - только между участниками звонка. Обработчики
+# событий одного клиента стартуют по порядку: если start_call ещё идёт,
+# его отметка уже в starting_calls.
+async def signal_targets(sid, data):
+    started = starting_calls.get(data.get('call_id'))
+    if started is not None:
+        await started.wait()
+    return await run_in_threadpool(calls.route, data.get('call_id'), connections.username(sid),
+                                   data.get('target_user'), connections.sessions)
+
+
+@sio.on('webrtc_offer')
+async def handle_webrtc_offer(sid, data):
+    sessions = await signal_targets(sid, data)
+    if sessions:
+        await sio.emit('webrtc_offer', {
+            'offer': data['offer'],
+            'caller': data.get('caller'),
+            'call_id': data.get('call_id')
+        }, to=sessions)
+
+
+@sio.on('webrtc_answer')
+async def handle_webrtc_answer(sid, data):
+    sessions = await signal_targets(sid, data)
+    if sessions:
+        await sio.emit('webrtc_answer', {'answer': data['answer'], 'call_id': data.get('call_id')}, to=sessions)
+
+
+@sio.on('webrtc_ice_candidate')
+async def handle_webrtc_ice_candidate(sid, data):
+    sessions = await signal_targets(sid, data)
+    if sessions:
+        await sio.emit('webrtc_ice_candidate', {
+            'candidate': data['candidate'],
+            'call_id': data.get('call_id')
+        }, to=sessions)
+
+
+# Клиент шлёт его вместе с end_call - обычно звонок к этому моменту уже снят
+@sio.on('webrtc_end_call')
+async def handle_webrtc_end_call(sid, data):
+    session = await run_in_threadpool(calls.leave, data.get('call_id'), connections.username(sid))
+    if session is None:
+        return
+    if session.state == ENDED:
+        await finish_call(session, 'webrtc_call_ended', skip_sid=sid)
+    else:
+        sio.leave_room(sid, session.room)
+
+
+# Все обработчики зарегистрированы - лимиты частоты и замер времени
+limit_events(sio, rate_limiter, on_limited=metrics.on_limited)
+instrument_events(sio, metrics.events)
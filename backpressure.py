@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+
+# Медленные получатели. У каждого сокета Engine.IO своя очередь исходящих
+# пакетов без предела: если клиент читает медленнее, чем ему шлют (плохая
+# сеть, спящая вкладка телефона), очередь и память процесса растут.
+# Менеджер рассылки (broker.py) смотрит на длину очереди получателя:
+#   - от soft_limit пакетов низкоприоритетные события не ставятся в очередь,
+#     а откладываются, по одному на ключ: typing_set - последний список
+#     комнаты, presence_delta - изменения сливаются в одно. Отложенное
+#     уходит, когда очередь сокета станет короче soft_limit;
+#   - от hard_limit сокет отключается: очередь не растёт дальше, клиент
+#     переподключится и загрузит комнату заново.
+# Лимиты - SLOW_CONSUMER_SOFT и SLOW_CONSUMER_HARD (пакетов), 0 - выключено.
+
+SOFT_LIMIT = 100
+HARD_LIMIT = 2000
+DRAIN_INTERVAL = 0.25
+
+SEND = 'send'
+PARK = 'park'
+EVICT = 'evict'
+
+logger = logging.getLogger(__name__)
+
+
+def _latest(old, new):
+    return new
+
+
+# Два изменения присутствия подряд -> одно с тем же итогом
+def _merge_presence(old, new):
+    joined = (set(old['joined']) - set(new['left'])) | set(new['joined'])
+    left = (set(old['left']) - set(new['joined'])) | set(new['left'])
+    return {'version': new['version'], 'joined': sorted(joined), 'left': sorted(left)}
+
+
+# событие -> (ключ отложенного по данным, слияние старого и нового)
+LOW_PRIORITY = {
+    'typing_set': (lambda data: (data.get('room'), data.get('source')), _latest),
+    'presence_delta': (lambda data: None, _merge_presence),
+}
+
+
+class Backpressure:
+    def __init__(self, server, deliver, soft_limit=SOFT_LIMIT, hard_limit=HARD_LIMIT,
+                 interval=DRAIN_INTERVAL, low_priority=LOW_PRIORITY):
+        self.server = server    # python-socketio Server/AsyncServer: очереди в server.eio.sockets
+        self.deliver = deliver  # deliver(sid, event, data, namespace) - отложенное одному сокету
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.interval = interval
+        self.low_priority = low_priority
+        self.on_drop = None     # on_drop(event, PARK | EVICT) - для метрик
+        self._parked = {}       # sid -> (eio_sid, {(namespace, event, key): data})
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, server, deliver, environ=os.environ):
+        return cls(server, deliver,
+                   soft_limit=int(environ.get('SLOW_CONSUMER_SOFT', SOFT_LIMIT)),
+                   hard_limit=int(environ.get('SLOW_CONSUMER_HARD', HARD_LIMIT)))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='backpressure', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def backlog(self, eio_sid):
+        socket = self.server.eio.sockets.get(eio_sid)
+        return socket.queue.qsize() if socket is not None else 0
+
+    # Что делать с событием для сокета: (SEND, данные) - отправить (данные
+    # другие, если к ним добавилось отложенное), (PARK, None) - отложено,
+    # (EVICT, None) - сокет пора отключать
+    def check(self, sid, eio_sid, event, data, namespace):
+        backlog = self.backlog(eio_sid)
+        if self.hard_limit and backlog >= self.hard_limit:
+            self._count(event, EVICT)
+            return EVICT, None
+        policy = self.low_priority.get(event)
+        if policy is None:
+            return SEND, data
+        key_of, merge = policy
+        key = (namespace, event, key_of(data))
+        with self._lock:
+            parked = self._parked.get(sid)
+            if self.soft_limit and backlog >= self.soft_limit:
+                if parked is None:
+                    parked = self._parked[sid] = (eio_sid, {})
+                old = parked[1].get(key)
+                parked[1][key] = merge(old, data) if old is not None else data
+            else:
+                # Очередь освободилась раньше, чем до сокета дошла очередь
+                # разбора: отложенное уходит вместе с новым, а не после него
+                old = parked[1].pop(key, None) if parked is not None else None
+                return SEND, merge(old, data) if old is not None else data
+        self._count(event, PARK)
+        return PARK, None
+
+    def _count(self, event, action):
+        if self.on_drop is not None:
+            self.on_drop(event, action)
+
+    def flush(self):
+        ready = []
+        with self._lock:
+            for sid, (eio_sid, items) in list(self._parked.items()):
+                if eio_sid not in self.server.eio.sockets:
+                    del self._parked[sid]
+                elif not items or self.backlog(eio_sid) < self.soft_limit:
+                    del self._parked[sid]
+                    ready.append((sid, items))
+        for sid, items in ready:
+            for (namespace, event, _), data in items.items():
+                self.deliver(sid, event, data, namespace)
+
+    def __len__(self):
+        return len(self._parked)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Ошибка доставки отложенных событий')
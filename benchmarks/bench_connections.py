@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import socketio
+
+# Сколько памяти сервера уходит на простаивающие соединения и как растёт
+# задержка доставки события при 1k/5k/10k открытых сокетов.
+# Сервер запускается через run.py в выбранном режиме отдельным процессом.
+# Клиентам нужен aiohttp (pip install aiohttp); на 10k сокетов поднимите
+# лимит дескрипторов: ulimit -n 65536.
+# Запуск: python benchmarks/bench_connections.py --mode asgi --sockets 1000 5000 10000
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def start_server(mode, port, db_path):
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), DATABASE_PATH=db_path, WORKERS='1')
+    proc = subprocess.Popen([sys.executable, 'run.py'], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = socketio.AsyncClient()
+        try:
+            await client.connect(url, transports=['websocket'])
+            await client.disconnect()
+            return
+        except socketio.exceptions.ConnectionError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError('сервер не запустился')
+
+
+async def open_clients(url, count, received, batch=200):
+    clients = []
+
+    async def one(i):
+        client = socketio.AsyncClient(reconnection=False)
+        client.on('new_message', lambda data: received(data))
+        await client.connect(url, transports=['websocket'])
+        await client.emit('user_join', {'username': f'bench{i}'})
+        clients.append(client)
+
+    # Пачками, чтобы не упереться в очередь accept
+    for start in range(0, count, batch):
+        await asyncio.gather(*(one(i) for i in range(start, min(count, start + batch))))
+    return clients
+
+
+async def run_level(url, pid, count, messages):
+    base = rss_mb(pid)
+    arrivals = {}
+    expected = {}
+
+    def received(data):
+        sent = expected.get(data.get('text'))
+        if sent is not None:
+            arrivals.setdefault(data['text'], []).append(time.perf_counter() - sent)
+
+    clients = await open_clients(url, count, received)
+    await asyncio.sleep(2)
+    idle = rss_mb(pid)
+
+    sender = clients[0]
+    for i in range(messages):
+        text = f'bench-{count}-{i}'
+        expected[text] = time.perf_counter()
+        await sender.emit('send_message', {'username': 'bench0', 'text': text, 'room': 'general'})
+        await asyncio.sleep(0.2)
+    await asyncio.sleep(2)
+
+    # Задержка до последнего получателя каждого сообщения
+    fanout = [max(times) for times in arrivals.values() if times]
+    delivered = sum(len(times) for times in arrivals.values()) / max(messages, 1)
+
+    await asyncio.gather(*(client.disconnect() for client in clients))
+    return base, idle, fanout, delivered
+
+
+async def main_async(args):
+    url = f'http://127.0.0.1:{args.port}'
+    print(f'режим: {args.mode}')
+    print(f'{"сокетов":>8} {"RSS МБ":>8} {"КБ/сокет":>9} {"доставлено":>11} {"p50 мс":>8} {"p99 мс":>8}')
+    for count in args.sockets:
+        db_path = os.path.join('/tmp', f'bench_connections_{os.getpid()}_{count}.db')
+        proc = start_server(args.mode, args.port, db_path)
+        try:
+            await wait_ready(url)
+            base, idle, fanout, delivered = await run_level(url, proc.pid, count, args.messages)
+            print(f'{count:>8} {idle:>8.1f} {(idle - base) * 1024 / count:>9.1f} {delivered:>11.0f} '
+                  f'{percentile(fanout, 0.5) * 1000:>8.1f} {percentile(fanout, 0.99) * 1000:>8.1f}')
+        finally:
+            proc.terminate()
+            proc.wait()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['threading', 'asgi'], default='asgi')
+    parser.add_argument('--sockets', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--port', type=int, default=10100)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import socketio
+
+# Рассылка при всплеске сообщений: отдельный new_message на каждое
+# сообщение против пачек new_messages (MESSAGE_BATCHING=1, fanout.py).
+#   сообщ/с - сколько сообщений в секунду дошло до всех получателей
+#   p50/p99 - задержка от отправки до получения, по всем доставкам
+# Отправители шлют без пауз, получатели сидят в general.
+# Сервер запускается через run.py в выбранном режиме отдельным процессом,
+# клиентам нужен aiohttp (pip install aiohttp).
+# Запуск: python benchmarks/bench_fanout.py --mode asgi --receivers 200 --senders 4 --messages 500
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def start_server(mode, port, workdir, batching, interval_ms):
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), WORKERS='1',
+               DATABASE_PATH=os.path.join(workdir, 'bench.db'),
+               MESSAGE_BATCHING='1' if batching else '0', BATCH_INTERVAL_MS=str(interval_ms))
+    # uploads/ создаётся в рабочем каталоге сервера
+    for name in os.listdir(ROOT):
+        if name.endswith(('.py', '.html')):
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    return subprocess.Popen([sys.executable, 'run.py'], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = socketio.AsyncClient()
+        try:
+            await client.connect(url, transports=['websocket'])
+            await client.disconnect()
+            return
+        except socketio.exceptions.ConnectionError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError('сервер не запустился')
+
+
+async def connect(url, username, on_message=None):
+    client = socketio.AsyncClient(reconnection=False)
+    if on_message is not None:
+        client.on('new_message', on_message)
+        client.on('new_messages', lambda data: [on_message(message) for message in data['messages']])
+    await client.connect(url, transports=['websocket'])
+    await client.emit('user_join', {'username': username})
+    return client
+
+
+async def run(url, args):
+    sent = {}
+    latencies = []
+    total = args.senders * args.messages
+    expected = total * args.receivers
+    done = asyncio.Event()
+
+    def received(data):
+        started = sent.get(data.get('text'))
+        if started is not None:
+            latencies.append(time.perf_counter() - started)
+            if len(latencies) >= expected:
+                done.set()
+
+    receivers = await asyncio.gather(*(connect(url, f'reader{i}', received) for i in range(args.receivers)))
+    senders = await asyncio.gather(*(connect(url, f'writer{i}') for i in range(args.senders)))
+    await asyncio.sleep(1)
+
+    async def burst(i, client):
+        for n in range(args.messages):
+            text = f'burst-{i}-{n}'
+            sent[text] = time.perf_counter()
+            await client.emit('send_message', {'username': f'writer{i}', 'text': text, 'room': 'general'})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(burst(i, client) for i, client in enumerate(senders)))
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    await asyncio.gather(*(client.disconnect() for client in receivers + senders))
+    return len(latencies) / args.receivers / elapsed, len(latencies) / expected, latencies
+
+
+async def main_async(args):
+    url = f'http://127.0.0.1:{args.port}'
+    print(f'режим: {args.mode}, получателей: {args.receivers}, '
+          f'отправителей: {args.senders} x {args.messages} сообщений')
+    print(f'{"пачки":>8} {"сообщ/с":>9} {"доставлено":>11} {"p50 мс":>8} {"p99 мс":>8}')
+    for batching in (False, True):
+        with tempfile.TemporaryDirectory() as workdir:
+            proc = start_server(args.mode, args.port, workdir, batching, args.interval)
+            try:
+                await wait_ready(url)
+                rate, delivered, latencies = await run(url, args)
+                label = f'{args.interval} мс' if batching else 'нет'
+                print(f'{label:>8} {rate:>9.0f} {delivered * 100:>10.1f}% '
+                      f'{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f}')
+            finally:
+                proc.terminate()
+                proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['threading', 'asgi'], default='asgi')
+    parser.add_argument('--receivers', type=int, default=200)
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--interval', type=int, default=5, help='BATCH_INTERVAL_MS')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--port', type=int, default=10500)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
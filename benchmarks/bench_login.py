@@ -0,0 +1,104 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('STORAGE_BACKEND', 'memory')
+
+import server
+from passwords import hash_password
+
+# Пропускная способность /api/login и p99 при разной конкурентности,
+# и задержка сообщений чата, пока идёт шквал входов.
+# Запуск: python benchmarks/bench_login.py --concurrency 1 4 16 64 --requests 200
+
+USERS = 32
+PASSWORD = 'secret-password'
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def login_storm(concurrency, total):
+    latencies = []
+    rejected = [0]
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def worker():
+        client = server.app.test_client()
+        for i in counter:
+            started = time.perf_counter()
+            response = client.post('/api/login', json={'username': f'user{i % USERS}', 'password': PASSWORD})
+            elapsed = time.perf_counter() - started
+            with lock:
+                if response.status_code == 503:
+                    rejected[0] += 1
+                else:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, rejected[0], time.perf_counter() - started
+
+
+# Отправка сообщения через Socket.IO, пока в соседних потоках идут входы
+def chat_latencies(stop, out):
+    client = server.socketio.test_client(server.app)
+    client.emit('user_join', {'username': 'chatter'})
+    client.emit('join_room', {'room': 'general'})
+    client.get_received()
+    while not stop.is_set():
+        started = time.perf_counter()
+        client.emit('send_message', {'username': 'chatter', 'text': 'ping', 'room': 'general'})
+        out.append(time.perf_counter() - started)
+        client.get_received()
+        time.sleep(0.005)
+    client.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    hasher = server.passwords
+    for i in range(USERS):
+        server.storage.create_user(f'user{i}', hash_password(PASSWORD, hasher.n, hasher.r, hasher.p), '')
+
+    idle = []
+    stop = threading.Event()
+    thread = threading.Thread(target=chat_latencies, args=(stop, idle))
+    thread.start()
+    time.sleep(1)
+    stop.set()
+    thread.join()
+    print(f'scrypt n={hasher.n} r={hasher.r} p={hasher.p}')
+    print(f'чат без нагрузки: p50 {percentile(idle, 0.5) * 1000:.2f} мс, p99 {percentile(idle, 0.99) * 1000:.2f} мс')
+
+    print(f'{"потоков":>8} {"вход/с":>8} {"p50 мс":>8} {"p99 мс":>8} {"503":>6} {"чат p99 мс":>11}')
+    for concurrency in args.concurrency:
+        chat = []
+        stop = threading.Event()
+        thread = threading.Thread(target=chat_latencies, args=(stop, chat))
+        thread.start()
+        latencies, rejected, elapsed = login_storm(concurrency, args.requests)
+        stop.set()
+        thread.join()
+        print(f'{concurrency:>8} {len(latencies) / elapsed:>8.1f} {percentile(latencies, 0.5) * 1000:>8.1f} '
+              f'{percentile(latencies, 0.99) * 1000:>8.1f} {rejected:>6} {percentile(chat, 0.99) * 1000:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+import uuid
+from collections import deque
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message import Message
+
+# Сколько байт занимает одно сообщение в истории комнаты:
+# прежний словарь из handle_message против message.Message.
+# Запуск: python benchmarks/bench_message_memory.py --messages 100000
+
+USERS = [f'user{i}' for i in range(50)]
+ROOMS = ['general', 'random', 'help']
+
+
+def payload(i):
+    # Имя и комната приходят из JSON события - каждый раз новая строка
+    return {
+        'username': ''.join(USERS[i % len(USERS)]),
+        'text': f'Сообщение номер {i}',
+        'room': ''.join(ROOMS[i % len(ROOMS)]),
+        'type': 'text'
+    }
+
+
+def make_dict(data):
+    return {
+        'id': str(uuid.uuid4()),
+        'username': data['username'],
+        'text': data.get('text', ''),
+        'file': data.get('file'),
+        'file_info': data.get('file_info'),
+        'timestamp': datetime.now().isoformat(),
+        'type': data.get('type', 'text'),
+        'room': data['room']
+    }
+
+
+def make_record(data):
+    return Message.from_event(data)
+
+
+def measure(factory, count):
+    # Текст сообщения нужен в обоих вариантах, поэтому создаём его до замера
+    payloads = [payload(i) for i in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    history = deque(factory(data) for data in payloads)
+    for data in payloads:
+        data.clear()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del history
+    return (after - before) / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    dict_bytes = measure(make_dict, args.messages)
+    record_bytes = measure(make_record, args.messages)
+    print(f'сообщений: {args.messages}')
+    print(f'dict:    {dict_bytes:8.1f} байт/сообщение')
+    print(f'Message: {record_bytes:8.1f} байт/сообщение')
+    print(f'экономия: {100 * (1 - record_bytes / dict_bytes):.0f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Первая загрузка страниц чата и пропускная способность статики.
+#   байты  - сколько уходит на index/login/register/chat.html без сжатия
+#            (как отдавал send_from_directory), с gzip и с brotli
+#   rps    - запросов в секунду на chat.html: полный ответ с gzip и
+#            повторная проверка If-None-Match -> 304
+# Сервер запускается через run.py в выбранном режиме отдельным процессом.
+# Запуск: python benchmarks/bench_static.py --mode asgi --seconds 5 --clients 8
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = ('/', '/login.html', '/register.html', '/chat.html')
+
+
+def start_server(mode, port, workdir):
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), WORKERS='1',
+               DATABASE_PATH=os.path.join(workdir, 'bench.db'))
+    # uploads/ создаётся в рабочем каталоге сервера
+    for name in os.listdir(ROOT):
+        if name.endswith(('.py', '.html')):
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    return subprocess.Popen([sys.executable, 'run.py'], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            fetch(http.client.HTTPConnection('127.0.0.1', port, timeout=5), '/')
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('сервер не запустился')
+
+
+def fetch(conn, path, headers=None):
+    conn.request('GET', path, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    return response.status, {name.lower(): value for name, value in response.getheaders()}, body
+
+
+def first_load(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    totals = {}
+    for encoding in ('identity', 'gzip', 'br'):
+        totals[encoding] = {}
+        for path in PAGES:
+            _, headers, body = fetch(conn, path, {'Accept-Encoding': encoding})
+            totals[encoding][path] = (len(body), headers.get('content-encoding', 'identity'))
+    conn.close()
+    return totals
+
+
+# clients потоков, у каждого своё keep-alive соединение
+def throughput(port, seconds, clients, headers):
+    counts = [0] * clients
+    deadline = time.monotonic() + seconds
+
+    def worker(i):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        while time.monotonic() < deadline:
+            status, _, _ = fetch(conn, '/chat.html', headers)
+            assert status in (200, 304), status
+            counts[i] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['threading', 'asgi'], default='asgi')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--port', type=int, default=10300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = start_server(args.mode, args.port, workdir)
+        try:
+            wait_ready(args.port)
+            print(f'режим: {args.mode}')
+            totals = first_load(args.port)
+            print(f'{"страница":>16} ' + ' '.join(f'{encoding:>10}' for encoding in totals))
+            for path in PAGES:
+                cells = []
+                for encoding in totals:
+                    size, used = totals[encoding][path]
+                    cells.append(f'{size:>10}' if used == encoding else f'{"-":>10}')
+                print(f'{path:>16} ' + ' '.join(cells))
+            print(f'{"всего":>16} ' + ' '.join(
+                f'{sum(size for size, _ in totals[encoding].values()):>10}' for encoding in totals))
+
+            conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=10)
+            _, headers, _ = fetch(conn, '/chat.html', {'Accept-Encoding': 'gzip'})
+            conn.close()
+            full = throughput(args.port, args.seconds, args.clients, {'Accept-Encoding': 'gzip'})
+            revalidate = throughput(args.port, args.seconds, args.clients,
+                                    {'Accept-Encoding': 'gzip', 'If-None-Match': headers['etag']})
+            print(f'chat.html gzip: {full:.0f} запр/с, 304: {revalidate:.0f} запр/с ({args.clients} клиентов)')
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
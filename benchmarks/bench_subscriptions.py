@@ -0,0 +1,99 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker import EncodeOnceManager
+from subscriptions import Subscriptions, channel
+
+# Цена рассылки одного сообщения при N клиентах в M комнатах:
+#   всем          - broadcast=True, как было в app.py и render_fix.py
+#   накоплено     - комната Socket.IO, но join_room без leave_room: клиент
+#                   остаётся во всех комнатах, где побывал (--visited)
+#   подписки      - subscriptions.py, клиент только в открытой комнате
+# Сервер python-socketio без сети: запись в сокет подменена счётчиком,
+# поэтому видна только работа сервера - выбор получателей, кодирование
+# и постановка пакетов в очередь.
+# Запуск: python benchmarks/bench_subscriptions.py --clients 1000 --rooms 50
+
+
+def make_server(clients):
+    server = socketio.Server(client_manager=EncodeOnceManager())
+    written = [0, 0]
+
+    def send(eio_sid, data):
+        written[0] += 1
+        written[1] += len(data)
+
+    server.eio.send = send
+    sids = [server.manager.connect(f'eio{i}', '/') for i in range(clients)]
+    return server, sids, written
+
+
+def payload(i, room):
+    return {
+        'id': f'{room}:{i}',
+        'room': room,
+        'seq': i,
+        'username': f'user{i % 97}',
+        'text': f'Сообщение номер {i} в комнате {room}',
+        'file': None,
+        'file_info': None,
+        'timestamp': '2024-01-01T12:00:00',
+        'type': 'text'
+    }
+
+
+def measure(server, written, messages, rooms, target):
+    written[0] = written[1] = 0
+    started = time.perf_counter()
+    for i in range(messages):
+        room = rooms[i % len(rooms)]
+        server.emit('new_message', payload(i, room), to=target(room))
+    elapsed = time.perf_counter() - started
+    return elapsed / messages, written[0] / messages, written[1] / messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--visited', type=int, default=10, help='сколько комнат клиент открывал раньше')
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+
+    rooms = [f'room{i}' for i in range(args.rooms)]
+    rng = random.Random(1)
+    results = []
+
+    server, sids, written = make_server(args.clients)
+    results.append(('всем', measure(server, written, args.messages, rooms, lambda room: None)))
+
+    server, sids, written = make_server(args.clients)
+    for i, sid in enumerate(sids):
+        visited = {rooms[i % args.rooms]} | set(rng.sample(rooms, args.visited - 1))
+        for room in visited:
+            server.enter_room(sid, room)
+    results.append(('накоплено', measure(server, written, args.messages, rooms, lambda room: room)))
+
+    server, sids, written = make_server(args.clients)
+    subscriptions = Subscriptions(server)
+    for i, sid in enumerate(sids):
+        # Переходы по комнатам, последняя - открытая сейчас
+        for room in rng.sample(rooms, args.visited - 1) + [rooms[i % args.rooms]]:
+            subscriptions.switch(sid, room)
+    results.append(('подписки', measure(server, written, args.messages, rooms, channel)))
+
+    print(f'клиентов: {args.clients}, комнат: {args.rooms}, открывали комнат: {args.visited}')
+    print(f'{"режим":>10} {"мкс/сообщ":>10} {"пакетов":>8} {"КБ/сообщ":>9}')
+    for name, (seconds, packets, size) in results:
+        print(f'{name:>10} {seconds * 1e6:>10.0f} {packets:>8.0f} {size / 1024:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
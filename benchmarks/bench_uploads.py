@@ -0,0 +1,130 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# Повторные просмотры загрузок: сколько байт и времени уходит, когда
+# комната перерисовывается и картинки/видео запрашиваются снова.
+#   full        - каждый показ скачивает файл целиком (без валидаторов)
+#   conditional - показ с If-None-Match, сервер отвечает 304 без тела
+#   immutable   - Cache-Control: immutable, браузер не ходит на сервер вовсе
+#   seek        - перемотка видео: случайные Range по 1 МБ и multi-range
+# Сервер запускается через run.py дважды: с LRU для мелких файлов и без него.
+# Запуск: python benchmarks/bench_uploads.py --mode asgi --views 200
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def start_server(mode, port, workdir, cache_bytes):
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), WORKERS='1',
+               DATABASE_PATH=os.path.join(workdir, 'bench.db'), UPLOAD_CACHE_BYTES=str(cache_bytes))
+    # uploads/ создаётся в рабочем каталоге сервера
+    for name in os.listdir(ROOT):
+        if name.endswith(('.py', '.html')):
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+    return subprocess.Popen([sys.executable, 'run.py'], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            request(port, 'GET', '/login.html')
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('сервер не запустился')
+
+
+def request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+        return response.status, {name.lower(): value for name, value in response.getheaders()}, data
+    finally:
+        conn.close()
+
+
+def upload(port, name, data):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    _, _, reply = request(port, 'POST', '/api/upload', body,
+                          {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    return json.loads(reply)['url']
+
+
+def measure(port, views, build):
+    latencies = []
+    received = 0
+    for i in range(views):
+        path, headers = build(i)
+        start = time.perf_counter()
+        status, _, data = request(port, 'GET', path, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        assert status in (200, 206, 304), status
+        received += len(data)
+    return received, latencies
+
+
+def run(mode, port, views, cache_bytes):
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = start_server(mode, port, workdir, cache_bytes)
+        try:
+            wait_ready(port)
+            images = [upload(port, f'img{i}.jpg', os.urandom(150 * 1024)) for i in range(10)]
+            video = upload(port, 'clip.mp4', os.urandom(20 * 1024 * 1024))
+            etags = {url: request(port, 'HEAD', url)[1]['etag'] for url in images}
+            size = 20 * 1024 * 1024
+
+            def seek(i):
+                start = random.randrange(0, size - 2 ** 20)
+                if i % 4 == 0:
+                    other = random.randrange(0, size - 4096)
+                    return video, {'Range': f'bytes={start}-{start + 4095},{other}-{other + 4095}'}
+                return video, {'Range': f'bytes={start}-{start + 2 ** 20 - 1}'}
+
+            return {
+                'full': measure(port, views, lambda i: (images[i % len(images)], {})),
+                'conditional': measure(port, views, lambda i: (
+                    images[i % len(images)], {'If-None-Match': etags[images[i % len(images)]]})),
+                'immutable': (0, []),
+                'seek': measure(port, views // 4 or 1, seek),
+            }
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['threading', 'asgi'], default='asgi')
+    parser.add_argument('--views', type=int, default=200)
+    parser.add_argument('--port', type=int, default=10200)
+    args = parser.parse_args()
+
+    print(f'режим: {args.mode}, показов: {args.views} (10 картинок по 150 КБ, видео 20 МБ)')
+    print(f'{"LRU":>5} {"сценарий":>12} {"запросов":>9} {"МБ":>8} {"p50 мс":>8} {"p99 мс":>8}')
+    for label, cache_bytes in (('нет', 0), ('32МБ', 32 * 1024 * 1024)):
+        results = run(args.mode, args.port, args.views, cache_bytes)
+        for name, (received, latencies) in results.items():
+            print(f'{label:>5} {name:>12} {len(latencies):>9} {received / 2 ** 20:>8.2f} '
+                  f'{percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
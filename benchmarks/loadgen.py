@@ -0,0 +1,500 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+import socketio
+
+# Нагрузочный прогон: N клиентов python-socketio по сценарию, похожему на
+# живой чат, и отчёт, который можно сравнивать между коммитами.
+#
+# Каждый клиент входит (user_join), открывает свою комнату (join_room) и
+# дальше раз в --think секунд (в среднем) делает случайное действие по
+# весам --mix:
+#   message - send_message; задержка считается до каждого получателя
+#   typing  - typing true/false
+#   switch  - перейти в другую комнату и вернуться
+#   history - GET /api/messages/<room>
+#   upload  - POST /api/upload небольшого файла
+#   call    - звонок другому клиенту: start_call + webrtc_offer, тот
+#             отвечает webrtc_answer + accept_call, через секунду end_call
+#
+# Отчёт: скорость подключения, сообщений в секунду, задержки доставки
+# p50/p95/p99, задержки HTTP и установки звонка, RSS и CPU сервера.
+# --output пишет JSON; --baseline сравнивает с прошлым JSON и завершается
+# с кодом 1, если что-то хуже больше чем на --threshold.
+#
+# Сервер: отдельный процесс через run.py (по умолчанию) или --inprocess -
+# в потоке этого же процесса (тогда RSS и CPU включают и клиентов).
+# Клиентам нужен aiohttp (pip install aiohttp).
+# Запуск: python benchmarks/loadgen.py --app asgi --clients 200 --duration 30 --output run.json
+#         python benchmarks/loadgen.py --app asgi --clients 200 --duration 30 --baseline run.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIX = 'message=50,typing=20,switch=5,history=15,upload=3,call=2'
+UPLOAD_SIZE = 16 * 1024
+CALL_HOLD = 1.0
+CALL_TIMEOUT = 5.0
+MIN_SAMPLES = 200  # меньше - p95/p99 слишком шумные, чтобы их сравнивать
+
+# Метрика отчёта -> что лучше; по ним --baseline ищет регрессии
+CHECKS = {
+    'connect_per_sec': 'higher',
+    'delivered_per_sec': 'higher',
+    'delivery_ms.p95': 'lower',
+    'delivery_ms.p99': 'lower',
+    'http_ms.history.p99': 'lower',
+    'server.cpu_percent': 'lower',
+    'server.rss_peak_mb': 'lower'
+}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def summary(seconds):
+    return {
+        'count': len(seconds),
+        'p50': round(percentile(seconds, 0.5) * 1000, 2),
+        'p95': round(percentile(seconds, 0.95) * 1000, 2),
+        'p99': round(percentile(seconds, 0.99) * 1000, 2)
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - set(MIX_ACTIONS)
+    if unknown:
+        raise SystemExit(f'Неизвестные действия в --mix: {", ".join(sorted(unknown))}')
+    return mix
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Сервер
+
+def server_env(args, workdir):
+    env = {
+        'PORT': str(args.port),
+        'HOST': '127.0.0.1',
+        'WORKERS': '1',
+        'SERVER_MODE': 'asgi' if args.app == 'asgi' else 'threading',
+        'SERVER_APP': 'server' if args.app == 'asgi' else args.app,
+        'DATABASE_PATH': os.path.join(workdir, 'loadgen.db')
+    }
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    return env
+
+
+def prepare_workdir(workdir):
+    # uploads/, база и chat_data/ создаются в рабочем каталоге сервера
+    for name in os.listdir(ROOT):
+        if name.endswith(('.py', '.html')):
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+
+
+def start_subprocess(args, workdir):
+    env = dict(os.environ, **server_env(args, workdir))
+    proc = subprocess.Popen([sys.executable, 'run.py'], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc.pid, lambda: (proc.terminate(), proc.wait())
+
+
+def start_inprocess(args, workdir):
+    os.environ.update(server_env(args, workdir))
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    if args.app == 'asgi':
+        import uvicorn
+        server = uvicorn.Server(uvicorn.Config('asgi:app', host='127.0.0.1', port=args.port, log_level='warning'))
+        target = server.run
+    else:
+        # Журнал запросов werkzeug смешался бы с отчётом
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        module = importlib.import_module(args.app)
+        target = lambda: module.socketio.run(module.app, host='127.0.0.1', port=args.port,
+                                             allow_unsafe_werkzeug=True, log_output=False)
+    threading.Thread(target=target, name='loadgen-server', daemon=True).start()
+    # Поток сервера завершится вместе с процессом
+    return os.getpid(), lambda: None
+
+
+class ProcessSampler:
+    # RSS и процессорное время процесса pid из /proc, раз в interval секунд
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss = []
+        self._tick = os.sysconf('SC_CLK_TCK')
+        self._start = None
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self._tick
+
+    def rss_mb(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    async def run(self, stop):
+        self._start = (time.perf_counter(), self.cpu_seconds())
+        while not stop.is_set():
+            self.rss.append(self.rss_mb())
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def report(self):
+        wall = time.perf_counter() - self._start[0]
+        cpu = self.cpu_seconds() - self._start[1]
+        return {
+            'pid': self.pid,
+            'cpu_percent': round(cpu / wall * 100, 1) if wall else 0.0,
+            'rss_start_mb': round(self.rss[0], 1) if self.rss else 0.0,
+            'rss_peak_mb': round(max(self.rss), 1) if self.rss else 0.0
+        }
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.monotonic() < deadline:
+            try:
+                async with http.get(url + '/') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('сервер не запустился')
+
+
+# Клиенты
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)  # имя -> секунды
+        self.counts = Counter()
+        self.errors = Counter()
+        self.sent = {}                    # текст сообщения -> время отправки
+
+
+class LoadClient:
+    def __init__(self, harness, index):
+        self.harness = harness
+        self.stats = harness.stats
+        self.username = f'load{index}'
+        self.home = harness.rooms[index % len(harness.rooms)]
+        self.room = self.home
+        self.sent = 0
+        self.call_id = None       # звонок, в котором клиент сейчас
+        self.call_answer = None   # future ответа на наш звонок
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on('new_message', self.on_message)
+        self.sio.on('new_messages', lambda data: [self.on_message(message) for message in data['messages']])
+        self.sio.on('incoming_call', self.on_incoming_call)
+        self.sio.on('call_accepted', lambda data: self.on_call_answer(data, True))
+        self.sio.on('call_rejected', lambda data: self.on_call_answer(data, False))
+        self.sio.on('call_ended', self.on_call_ended)
+        self.sio.on('webrtc_call_ended', self.on_call_ended)
+
+    async def connect(self):
+        started = time.perf_counter()
+        await self.sio.connect(self.harness.url, transports=['websocket'])
+        await self.sio.emit('user_join', {'username': self.username})
+        await self.sio.emit('join_room', {'room': self.room})
+        self.stats.latency['connect'].append(time.perf_counter() - started)
+
+    async def run(self, deadline):
+        rng = self.harness.rng
+        actions, weights = zip(*self.harness.mix.items())
+        while True:
+            await asyncio.sleep(rng.expovariate(1 / self.harness.think))
+            if time.perf_counter() >= deadline:
+                return
+            action = rng.choices(actions, weights)[0]
+            try:
+                await getattr(self, 'do_' + action)()
+                self.stats.counts[action] += 1
+            except Exception as e:
+                self.stats.errors[f'{action}: {type(e).__name__}'] += 1
+
+    # Доставка: задержка считается у каждого получателя, и у отправителя тоже
+    def on_message(self, data):
+        started = self.stats.sent.get(data.get('text'))
+        if started is not None:
+            self.stats.latency['delivery'].append(time.perf_counter() - started)
+
+    async def do_message(self):
+        self.sent += 1
+        text = f'lg {self.username} {self.sent}'
+        self.stats.sent[text] = time.perf_counter()
+        await self.sio.emit('send_message', {'username': self.username, 'text': text, 'room': self.room})
+
+    async def do_typing(self):
+        await self.sio.emit('typing', {'username': self.username, 'room': self.room, 'is_typing': True})
+        await asyncio.sleep(0.5)
+        await self.sio.emit('typing', {'username': self.username, 'room': self.room, 'is_typing': False})
+
+    async def do_switch(self):
+        self.room = self.harness.rng.choice(self.harness.rooms)
+        await self.sio.emit('join_room', {'room': self.room})
+        await asyncio.sleep(self.harness.think)
+        self.room = self.home
+        await self.sio.emit('join_room', {'room': self.room})
+
+    async def http(self, name, method, path, **kwargs):
+        started = time.perf_counter()
+        async with self.harness.http.request(method, self.harness.url + path, **kwargs) as response:
+            await response.read()
+            if response.status >= 400:
+                raise RuntimeError(f'HTTP {response.status}')
+        self.stats.latency['http.' + name].append(time.perf_counter() - started)
+
+    async def do_history(self):
+        await self.http('history', 'GET', f'/api/messages/{self.room}', params={'limit': '50'})
+
+    async def do_upload(self):
+        form = aiohttp.FormData()
+        form.add_field('file', os.urandom(UPLOAD_SIZE), filename=f'{self.username}.bin',
+                       content_type='application/octet-stream')
+        await self.http('upload', 'POST', '/api/upload', data=form)
+
+    async def do_call(self):
+        peers = [client for client in self.harness.clients if client is not self and client.call_id is None]
+        if self.call_id is not None or not peers:
+            return
+        target = self.harness.rng.choice(peers).username
+        self.sent += 1
+        call_id = self.call_id = f'lg-{self.username}-{self.sent}'
+        self.call_answer = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        try:
+            await self.sio.emit('start_call', {'username': self.username, 'target': target,
+                                               'target_user': target, 'type': 'voice', 'call_id': call_id})
+            await self.sio.emit('webrtc_offer', {'offer': {'type': 'offer', 'sdp': 'loadgen'},
+                                                 'caller': self.username, 'target_user': target, 'call_id': call_id})
+            accepted = await asyncio.wait_for(self.call_answer, CALL_TIMEOUT)
+            if not accepted:
+                self.stats.counts['call_rejected'] += 1
+                return
+            self.stats.latency['call_setup'].append(time.perf_counter() - started)
+            await asyncio.sleep(CALL_HOLD)
+        finally:
+            await self.sio.emit('end_call', {'username': self.username, 'call_id': call_id})
+            await self.sio.emit('webrtc_end_call', {'call_id': call_id})
+            self.call_id = self.call_answer = None
+
+    def on_call_answer(self, data, accepted):
+        if self.call_answer is not None and not self.call_answer.done() and data.get('call_id') == self.call_id:
+            self.call_answer.set_result(accepted)
+
+    async def on_incoming_call(self, data):
+        call_id, caller = data['call_id'], data['caller']
+        if self.call_id is not None:
+            await self.sio.emit('reject_call', {'username': self.username, 'caller': caller, 'call_id': call_id})
+            return
+        self.call_id = call_id
+        await self.sio.emit('webrtc_answer', {'answer': {'type': 'answer', 'sdp': 'loadgen'}, 'caller': caller,
+                                              'target_user': caller, 'call_id': call_id})
+        await self.sio.emit('accept_call', {'username': self.username, 'caller': caller, 'call_id': call_id})
+
+    def on_call_ended(self, data):
+        if data.get('call_id') == self.call_id and self.call_answer is None:
+            self.call_id = None
+
+
+MIX_ACTIONS = [name[len('do_'):] for name in dir(LoadClient) if name.startswith('do_')]
+
+
+class Harness:
+    def __init__(self, args):
+        self.url = f'http://127.0.0.1:{args.port}'
+        self.rooms = [f'load-{i}' for i in range(args.rooms)]
+        self.mix = parse_mix(args.mix)
+        self.think = args.think
+        self.rng = random.Random(args.seed)
+        self.stats = Stats()
+        self.clients = []
+        self.http = None
+
+    async def connect_all(self, count, concurrency):
+        self.clients = [LoadClient(self, i) for i in range(count)]
+        started = time.perf_counter()
+        for start in range(0, count, concurrency):
+            results = await asyncio.gather(*(client.connect() for client in self.clients[start:start + concurrency]),
+                                           return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    self.stats.errors[f'connect: {type(result).__name__}'] += 1
+        return time.perf_counter() - started
+
+    async def run(self, args, pid):
+        stop = asyncio.Event()
+        sampler = ProcessSampler(pid)
+        sampling = asyncio.create_task(sampler.run(stop))
+        async with aiohttp.ClientSession() as self.http:
+            connect_seconds = await self.connect_all(args.clients, args.connect_concurrency)
+            connected = [client for client in self.clients if client.sio.connected]
+            started = time.perf_counter()
+            deadline = started + args.duration
+            await asyncio.gather(*(client.run(deadline) for client in connected))
+            # Дать дойти последним сообщениям
+            await asyncio.sleep(1)
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await sampling
+            await asyncio.gather(*(client.sio.disconnect() for client in connected), return_exceptions=True)
+        return self.report(args, connect_seconds, len(connected), elapsed, sampler.report())
+
+    def report(self, args, connect_seconds, connected, elapsed, server):
+        stats = self.stats
+        latency = stats.latency
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'app': args.app,
+                'inprocess': args.inprocess,
+                'clients': args.clients,
+                'rooms': args.rooms,
+                'duration': args.duration,
+                'think': args.think,
+                'mix': self.mix,
+                'env': args.env
+            },
+            'connected': connected,
+            'connect_per_sec': round(connected / connect_seconds, 1) if connect_seconds else 0.0,
+            'connect_ms': summary(latency['connect']),
+            'sent_per_sec': round(stats.counts['message'] / elapsed, 1),
+            'delivered_per_sec': round(len(latency['delivery']) / elapsed, 1),
+            'delivery_ms': summary(latency['delivery']),
+            'http_ms': {name[len('http.'):]: summary(values) for name, values in latency.items()
+                        if name.startswith('http.')},
+            'call_setup_ms': summary(latency['call_setup']),
+            'actions': dict(stats.counts),
+            'errors': dict(stats.errors),
+            'server': server
+        }
+
+
+# Сравнение с прошлым прогоном
+
+def lookup(report, path):
+    value = report
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def regressions(report, baseline, threshold):
+    found = []
+    for path, better in CHECKS.items():
+        now, before = lookup(report, path), lookup(baseline, path)
+        if not now or not before:
+            continue
+        if path.endswith(('.p95', '.p99')):
+            count = path.rsplit('.', 1)[0] + '.count'
+            if min(lookup(report, count) or 0, lookup(baseline, count) or 0) < MIN_SAMPLES:
+                continue
+        change = (now - before) / before
+        if (better == 'higher' and change < -threshold) or (better == 'lower' and change > threshold):
+            found.append((path, before, now, change))
+    return found
+
+
+def print_report(report):
+    print(f'подключено: {report["connected"]}, {report["connect_per_sec"]}/с, '
+          f'p99 подключения {report["connect_ms"]["p99"]} мс')
+    print(f'сообщений: отправлено {report["sent_per_sec"]}/с, доставлено {report["delivered_per_sec"]}/с')
+    rows = [('доставка', report['delivery_ms']), ('звонок', report['call_setup_ms'])]
+    rows += [(f'http {name}', values) for name, values in sorted(report['http_ms'].items())]
+    print(f'{"":>14} {"n":>7} {"p50 мс":>8} {"p95 мс":>8} {"p99 мс":>8}')
+    for name, values in rows:
+        print(f'{name:>14} {values["count"]:>7} {values["p50"]:>8} {values["p95"]:>8} {values["p99"]:>8}')
+    server = report['server']
+    print(f'сервер: CPU {server["cpu_percent"]}%, RSS {server["rss_start_mb"]} -> {server["rss_peak_mb"]} МБ')
+    if report['errors']:
+        print('ошибки:', ', '.join(f'{name} x{count}' for name, count in report['errors'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app', choices=['server', 'app', 'asgi'], default='asgi')
+    parser.add_argument('--inprocess', action='store_true', help='сервер в потоке этого процесса')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--think', type=float, default=1.0, help='средняя пауза клиента между действиями, с')
+    parser.add_argument('--mix', default=MIX)
+    parser.add_argument('--connect-concurrency', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], help='переменная окружения сервера, ИМЯ=значение')
+    parser.add_argument('--port', type=int, default=10600)
+    parser.add_argument('--output', help='записать отчёт JSON')
+    parser.add_argument('--baseline', help='отчёт JSON прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.2, help='допустимое ухудшение, доля')
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare_workdir(workdir)
+        start = start_inprocess if args.inprocess else start_subprocess
+        pid, stop = start(args, workdir)
+        try:
+            asyncio.run(wait_ready(f'http://127.0.0.1:{args.port}'))
+            report = asyncio.run(Harness(args).run(args, pid))
+        finally:
+            stop()
+
+    print_report(report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if baseline is not None:
+        found = regressions(report, baseline, args.threshold)
+        for path, before, now, change in found:
+            print(f'РЕГРЕССИЯ {path}: {before} -> {now} ({change:+.0%})')
+        if found:
+            sys.exit(1)
+        print(f'регрессий нет (порог {args.threshold:.0%}, база {lookup(baseline, "meta.commit")})')
+
+
+if __name__ == '__main__':
+    main()
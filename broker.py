@@ -0,0 +1,256 @@
+import asyncio
+import pickle
+import time
+
+import socketio
+from socketio import packet
+from socketio.asyncio_manager import AsyncManager
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+from socketio.base_manager import BaseManager
+
+from backpressure import EVICT, PARK
+from storage import SQLiteConnections
+
+# Очередь сообщений Socket.IO для нескольких воркеров на одном хосте.
+# emit любого воркера записывается строкой в таблицу SQLite, остальные
+# воркеры опрашивают её и доставляют событие своим клиентам - так же,
+# как это делает RedisManager через Redis pub/sub. Для нескольких
+# хостов нужен настоящий брокер: MESSAGE_QUEUE=redis://...
+#
+# Формат адреса: sqlite:///путь/к/queue.db
+#
+# Все менеджеры здесь кодируют событие один раз на emit: стандартный
+# менеджер python-socketio заново сериализует JSON для каждого получателя,
+# и рассылка в большую комнату упирается в json.dumps.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    created REAL NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queue_created ON queue (created);
+'''
+
+SQL_PUBLISH = 'INSERT INTO queue (channel, created, payload) VALUES (?, ?, ?)'
+SQL_LAST_ID = 'SELECT COALESCE(MAX(id), 0) FROM queue'
+SQL_READ = 'SELECT id, payload FROM queue WHERE id > ? AND channel = ? ORDER BY id LIMIT ?'
+SQL_EXPIRE = 'DELETE FROM queue WHERE created < ?'
+
+POLL_INTERVAL = 0.01
+RETAIN_SECONDS = 60
+EXPIRE_EVERY = 1000
+READ_BATCH = 500
+
+
+# Пакет, закодированный один раз: Server._send_packet зовёт encode()
+# для каждого получателя и получает готовую строку
+class EncodedPacket:
+    __slots__ = ('encoded',)
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+    def encode(self):
+        return self.encoded
+
+
+# Событие -> пакет, как в Server._emit_internal
+def encode_event(server, event, data, namespace):
+    if isinstance(data, tuple):
+        data = list(data)
+    elif data is not None:
+        data = [data]
+    else:
+        data = []
+    return EncodedPacket(server.packet_class(packet.EVENT, namespace=namespace, data=[event] + data).encode())
+
+
+class EncodeOnceManager(BaseManager):
+    on_emit = None       # on_emit(event, получателей) - для метрик рассылки (metrics.py)
+    backpressure = None  # backpressure.Backpressure - медленные получатели
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        # С подтверждением у каждого получателя свой id пакета
+        if callback is not None or namespace not in self.rooms:
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        pkt = None
+        sent = 0
+        evicted = []
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+            own = data
+            if self.backpressure is not None:
+                action, own = self.backpressure.check(sid, eio_sid, event, data, namespace)
+                if action == PARK:
+                    continue
+                if action == EVICT:
+                    evicted.append(eio_sid)
+                    continue
+            if own is not data:
+                self.server._send_packet(eio_sid, encode_event(self.server, event, own, namespace))
+            else:
+                if pkt is None:
+                    pkt = encode_event(self.server, event, data, namespace)
+                self.server._send_packet(eio_sid, pkt)
+            sent += 1
+        # Отключаем после обхода: обработчик disconnect меняет комнаты
+        for eio_sid in evicted:
+            socket = self.server.eio.sockets.get(eio_sid)
+            if socket is not None:
+                socket.close(wait=False, abort=True)
+        if self.on_emit is not None:
+            self.on_emit(event, sent)
+
+    # Отложенное событие - одному своему сокету, мимо очереди сообщений
+    def deliver(self, sid, event, data, namespace='/'):
+        eio_sid = self.eio_sid_from_sid(sid, namespace)
+        if eio_sid is not None:
+            self.server._send_packet(eio_sid, encode_event(self.server, event, data, namespace))
+
+
+class AsyncEncodeOnceManager(AsyncManager):
+    on_emit = None
+    backpressure = None
+
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if callback is not None or namespace not in self.rooms:
+            return await super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, **kwargs)
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        pkt = None
+        sent = 0
+        evicted = []
+        # Отправка только ставит пакет в очередь сокета - задачи на каждого не нужны
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+            own = data
+            if self.backpressure is not None:
+                action, own = self.backpressure.check(sid, eio_sid, event, data, namespace)
+                if action == PARK:
+                    continue
+                if action == EVICT:
+                    evicted.append(eio_sid)
+                    continue
+            if own is not data:
+                await self.server._send_packet(eio_sid, encode_event(self.server, event, own, namespace))
+            else:
+                if pkt is None:
+                    pkt = encode_event(self.server, event, data, namespace)
+                await self.server._send_packet(eio_sid, pkt)
+            sent += 1
+        for eio_sid in evicted:
+            socket = self.server.eio.sockets.get(eio_sid)
+            if socket is not None:
+                await socket.close(wait=False, abort=True)
+        if self.on_emit is not None:
+            self.on_emit(event, sent)
+
+    async def deliver(self, sid, event, data, namespace='/'):
+        eio_sid = self.eio_sid_from_sid(sid, namespace)
+        if eio_sid is not None:
+            await self.server._send_packet(eio_sid, encode_event(self.server, event, data, namespace))
+
+
+def sqlite_path(url):
+    if not url.startswith('sqlite://'):
+        raise ValueError(f'Ожидается адрес sqlite:///путь, получено: {url}')
+    return url[len('sqlite://'):]
+
+
+class SQLiteQueue:
+    def __init__(self, path, channel):
+        self.channel = channel
+        self._connections = SQLiteConnections(path)
+        self._db = self._connections.get
+        self._db().executescript(SCHEMA)
+        self._published = 0
+
+    def last_id(self):
+        return self._db().execute(SQL_LAST_ID).fetchone()[0]
+
+    def publish(self, data):
+        db = self._db()
+        now = time.time()
+        db.execute(SQL_PUBLISH, (self.channel, now, pickle.dumps(data)))
+        # Читатели отстают на доли секунды, старые строки никому не нужны
+        self._published += 1
+        if self._published % EXPIRE_EVERY == 0:
+            db.execute(SQL_EXPIRE, (now - RETAIN_SECONDS,))
+
+    def read(self, after):
+        return self._db().execute(SQL_READ, (after, self.channel, READ_BATCH)).fetchall()
+
+    def close(self):
+        self._connections.close()
+
+
+# Доставка своим клиентам (_handle_emit) идёт через EncodeOnceManager.emit
+class SQLiteManager(socketio.PubSubManager, EncodeOnceManager):
+    name = 'sqlite'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None, poll_interval=POLL_INTERVAL):
+        self.queue = SQLiteQueue(sqlite_path(url), channel)
+        self.poll_interval = poll_interval
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _publish(self, data):
+        self.queue.publish(data)
+
+    def _listen(self):
+        last = self.queue.last_id()
+        while True:
+            rows = self.queue.read(last)
+            for row in rows:
+                last = row['id']
+                yield row['payload']
+            if len(rows) < READ_BATCH:
+                self.server.sleep(self.poll_interval)
+
+
+class AsyncSQLiteManager(AsyncPubSubManager, AsyncEncodeOnceManager):
+    name = 'sqlite'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None, poll_interval=POLL_INTERVAL):
+        self.queue = SQLiteQueue(sqlite_path(url), channel)
+        self.poll_interval = poll_interval
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    # Запросы к SQLite блокируют (ожидание блокировки - до таймаута
+    # соединения), поэтому в пуле потоков, а не в цикле событий
+    async def _publish(self, data):
+        await asyncio.to_thread(self.queue.publish, data)
+
+    async def _listen(self):
+        last = await asyncio.to_thread(self.queue.last_id)
+        while True:
+            rows = await asyncio.to_thread(self.queue.read, last)
+            for row in rows:
+                last = row['id']
+                yield row['payload']
+            if len(rows) < READ_BATCH:
+                await asyncio.sleep(self.poll_interval)
+
+
+class RedisManager(socketio.RedisManager, EncodeOnceManager):
+    pass
+
+
+class AsyncRedisManager(socketio.AsyncRedisManager, AsyncEncodeOnceManager):
+    pass
+
+
+# MESSAGE_QUEUE -> менеджер клиентов python-socketio (без очереди - один процесс)
+def client_manager(url, asyncio_mode=False):
+    if not url:
+        return AsyncEncodeOnceManager() if asyncio_mode else EncodeOnceManager()
+    if url.startswith('sqlite://'):
+        return AsyncSQLiteManager(url) if asyncio_mode else SQLiteManager(url)
+    if url.startswith(('redis://', 'rediss://')):
+        return AsyncRedisManager(url) if asyncio_mode else RedisManager(url)
+    raise ValueError(f'Неизвестная очередь сообщений: {url}')
@@ -0,0 +1,344 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from storage import SQLiteConnections
+
+# Сессии звонков. Раньше завершение звонка уходило всем подключённым
+# (broadcast=True): каждый клиент получал чужие «звонок завершён».
+# Теперь на каждый call_id заведена сессия: кто звонит, кому ещё звонит
+# (приглашённые без ответа), кто в разговоре и с какой вкладки, состояние
+# ringing -> active -> ended. Участники разговора входят в комнату Socket.IO
+# call:<call_id>; завершение звонка уходит в неё и тем, у кого он ещё звонит,
+# сигналинг WebRTC - только между участниками этой сессии.
+#
+# Звонок, на который никто не ответил за ring_timeout, снимает reap();
+# отключение вкладки участника - выход из звонка. Завершённая сессия
+# удаляется из реестра, поздний сигналинг по ней никуда не уходит.
+# SQLiteCallRegistry - тот же реестр, общий для воркеров (MESSAGE_QUEUE).
+
+RINGING = 'ringing'
+ACTIVE = 'active'
+ENDED = 'ended'
+# Столько же окно входящего звонка в chat.html ждёт ответа
+RING_TIMEOUT = 45
+# Сколько секунд сигналинг ждёт start_call того же звонка: обработчики
+# Flask-SocketIO идут в отдельных потоках, оффер может обогнать start_call.
+# Ждёт не обработчик - сигнал откладывается, и его отправляет start()
+EARLY_SIGNAL_TTL = 5.0
+# Сколько отложенных сигналов держать на звонок и сколько таких звонков
+EARLY_SIGNALS = 64
+EARLY_CALLS = 256
+# Сколько последних завершённых call_id помнить, чтобы не откладывать
+# сигналинг по ним
+ENDED_MEMORY = 1024
+
+
+class CallSession:
+    __slots__ = ('call_id', 'caller', 'type', 'group', 'invitees', 'participants', 'state', 'started')
+
+    def __init__(self, call_id, caller, type='voice', group=None, invitees=(), participants=None,
+                 state=RINGING, started=None):
+        self.call_id = call_id
+        self.caller = caller
+        self.type = type
+        self.group = group
+        self.invitees = set(invitees)                  # кому звонит, ответа ещё нет
+        self.participants = dict(participants or {})   # username -> sid вкладки в разговоре
+        self.state = state
+        self.started = time.time() if started is None else started
+
+    @property
+    def room(self):
+        return f'call:{self.call_id}'
+
+    def members(self):
+        return self.invitees | set(self.participants)
+
+    # Звонок закончен, если в разговоре никого, если звонящий ушёл, пока
+    # звонит, или если в разговоре остался один и звонить больше некому
+    def settle(self):
+        if not self.participants:
+            self.state = ENDED
+        elif self.state == RINGING and (not self.invitees or self.caller not in self.participants):
+            self.state = ENDED
+        elif self.state == ACTIVE and len(self.participants) < 2 and not self.invitees:
+            self.state = ENDED
+        return self
+
+    def to_json(self):
+        return json.dumps({
+            'caller': self.caller,
+            'type': self.type,
+            'group': self.group,
+            'invitees': sorted(self.invitees),
+            'participants': self.participants,
+            'state': self.state,
+            'started': self.started
+        })
+
+    @classmethod
+    def from_json(cls, call_id, data):
+        return cls(call_id, **json.loads(data))
+
+
+class CallRegistry:
+    def __init__(self, ring_timeout=RING_TIMEOUT):
+        self.ring_timeout = ring_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._ended = OrderedDict()
+        self._early = OrderedDict()    # call_id -> (срок, [(sender, target, sessions, send)])
+        self._early_lock = threading.Lock()
+
+    # Все изменения идут через _update: change(сессия или None) ->
+    # (что сохранить, что вернуть). Сессия в состоянии ended удаляется.
+    def _update(self, call_id, change):
+        with self._lock:
+            session, result = change(self._calls.get(call_id))
+            if session is None or session.state == ENDED:
+                self._calls.pop(call_id, None)
+            else:
+                self._calls[call_id] = session
+        return result
+
+    # То же для всех сессий; change(сессия) -> True, если она изменилась.
+    # Возвращает изменённые сессии.
+    def _update_all(self, change):
+        with self._lock:
+            changed = [session for session in list(self._calls.values()) if change(session)]
+            for session in changed:
+                if session.state == ENDED:
+                    del self._calls[session.call_id]
+        return changed
+
+    def get(self, call_id):
+        with self._lock:
+            return self._calls.get(call_id)
+
+    def __len__(self):
+        return len(self._calls)
+
+    # Новый звонок: caller звонит с вкладки sid тем, кто в invitees.
+    # None - такой call_id уже есть или звонить некому.
+    def start(self, call_id, caller, sid, invitees, type='voice', group=None):
+        invitees = set(invitees) - {caller}
+        if not call_id or not invitees:
+            return None
+
+        def change(session):
+            if session is not None:
+                return session, None
+            session = CallSession(call_id, caller, type, group, invitees, {caller: sid})
+            return session, session
+
+        session = self._update(call_id, change)
+        if session is not None:
+            with self._early_lock:
+                early = self._early.pop(call_id, None)
+            if early is not None and early[0] > time.monotonic():
+                for sender, target, sessions, send in early[1]:
+                    self._deliver(session, sender, target, sessions, send)
+        return session
+
+    # Приглашённый ответил с вкладки sid. None - звонка нет или его не звали.
+    def accept(self, call_id, username, sid):
+        def change(session):
+            if session is None or username not in session.invitees:
+                return session, None
+            session.invitees.discard(username)
+            session.participants[username] = sid
+            session.state = ACTIVE
+            return session, session
+
+        return self._remember(self._update(call_id, change))
+
+    # Приглашённый отказался. Возвращает сессию (state == ended, если
+    # звонить больше некому) или None, если его не звали.
+    def reject(self, call_id, username):
+        def change(session):
+            if session is None or username not in session.invitees:
+                return session, None
+            session.invitees.discard(username)
+            return session.settle(), session
+
+        return self._remember(self._update(call_id, change))
+
+    # Кто-то положил трубку: участник выходит из разговора, у приглашённого
+    # звонок перестаёт звонить. None - его в звонке не было.
+    def leave(self, call_id, username):
+        def change(session):
+            if session is None or username not in session.members():
+                return session, None
+            session.participants.pop(username, None)
+            session.invitees.discard(username)
+            return session.settle(), session
+
+        return self._remember(self._update(call_id, change))
+
+    # Вкладка sid отключилась; last_session - это была последняя вкладка
+    # пользователя, тогда и звонки ему больше не звонят.
+    # Возвращает сессии, которые от этого изменились.
+    def disconnect(self, sid, username, last_session=False):
+        def change(session):
+            changed = False
+            if username is not None and session.participants.get(username) == sid:
+                del session.participants[username]
+                changed = True
+            if last_session and username in session.invitees:
+                session.invitees.discard(username)
+                changed = True
+            if changed:
+                session.settle()
+            return changed
+
+        return [self._remember(session) for session in self._update_all(change)]
+
+    # Снять звонки, на которые не ответили за ring_timeout. Приглашённые,
+    # не ответившие в уже идущем звонке, просто перестают в него входить.
+    # Возвращает сессии, завершённые этим вызовом.
+    def reap(self, now=None):
+        deadline = (time.time() if now is None else now) - self.ring_timeout
+
+        def change(session):
+            if session.started > deadline or not session.invitees:
+                return False
+            ringing = set(session.invitees)
+            session.invitees.clear()
+            # У кого ещё звонит - тоже узнают о завершении
+            if session.settle().state == ENDED:
+                session.invitees = ringing
+            return True
+
+        changed = self._update_all(change)
+        return [self._remember(session) for session in changed if session.state == ENDED]
+
+    def _remember(self, session):
+        if session is not None and session.state == ENDED:
+            with self._lock:
+                self._ended[session.call_id] = None
+                while len(self._ended) > ENDED_MEMORY:
+                    self._ended.popitem(last=False)
+        return session
+
+    # Кому переслать сигналинг от sender к target: вкладке target в разговоре
+    # или всем его вкладкам, пока у него звонит (sessions(username) -> sid).
+    # [] - звонка нет или кто-то из двоих в нём не состоит.
+    def route(self, call_id, sender, target, sessions):
+        session = self.get(call_id)
+        return self._targets(session, sender, target, sessions) if session is not None else []
+
+    # То же, но отправляет сам: send(sids). Звонка ещё нет - сигнал
+    # откладывается до start() этого реестра (не дольше EARLY_SIGNAL_TTL),
+    # обработчик при этом не ждёт. Проверка и откладывание идут под
+    # _early_lock: start() забирает отложенное уже после сохранения сессии.
+    def signal(self, call_id, sender, target, sessions, send):
+        with self._early_lock:
+            session = self.get(call_id)
+            if session is None:
+                if call_id and call_id not in self._ended:
+                    self._defer(call_id, (sender, target, sessions, send))
+                return
+        self._deliver(session, sender, target, sessions, send)
+
+    def _targets(self, session, sender, target, sessions):
+        members = session.members()
+        if sender not in members or target not in members:
+            return []
+        sid = session.participants.get(target)
+        return [sid] if sid is not None else sessions(target)
+
+    def _deliver(self, session, sender, target, sessions, send):
+        sids = self._targets(session, sender, target, sessions)
+        # Пустой список в emit - это рассылка всем
+        if sids:
+            send(sids)
+
+    # Под _early_lock. Сроки идут по порядку добавления звонков,
+    # просроченные всегда в начале.
+    def _defer(self, call_id, signal):
+        now = time.monotonic()
+        while self._early and next(iter(self._early.values()))[0] <= now:
+            self._early.popitem(last=False)
+        early = self._early.get(call_id)
+        if early is None:
+            early = self._early[call_id] = (now + EARLY_SIGNAL_TTL, [])
+            while len(self._early) > EARLY_CALLS:
+                self._early.popitem(last=False)
+        if len(early[1]) < EARLY_SIGNALS:
+            early[1].append(signal)
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    call_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+SQL_GET_CALL = 'SELECT data FROM calls WHERE call_id = ?'
+SQL_ALL_CALLS = 'SELECT call_id, data FROM calls'
+SQL_PUT_CALL = 'INSERT OR REPLACE INTO calls (call_id, data) VALUES (?, ?)'
+SQL_DELETE_CALL = 'DELETE FROM calls WHERE call_id = ?'
+SQL_COUNT_CALLS = 'SELECT COUNT(*) FROM calls'
+
+
+class SQLiteCallRegistry(CallRegistry):
+    # Сессия - строка JSON в таблице calls; изменения - в транзакции
+    # BEGIN IMMEDIATE, поэтому ответ и отбой на разных воркерах не теряются.
+    # Вкладки участников - sid, события к ним доходят через очередь сообщений.
+    def __init__(self, path, ring_timeout=RING_TIMEOUT):
+        super().__init__(ring_timeout)
+        self._connections = SQLiteConnections(path)
+        self._db = self._connections.get
+        self._db().executescript(SCHEMA)
+
+    def _transaction(self, work):
+        conn = self._db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = work(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return result
+
+    def _store(self, conn, call_id, session):
+        if session is None or session.state == ENDED:
+            conn.execute(SQL_DELETE_CALL, (call_id,))
+        else:
+            conn.execute(SQL_PUT_CALL, (call_id, session.to_json()))
+
+    def _update(self, call_id, change):
+        def work(conn):
+            row = conn.execute(SQL_GET_CALL, (call_id,)).fetchone()
+            session, result = change(CallSession.from_json(call_id, row[0]) if row else None)
+            self._store(conn, call_id, session)
+            return result
+
+        return self._transaction(work)
+
+    def _update_all(self, change):
+        def work(conn):
+            sessions = [CallSession.from_json(row[0], row[1]) for row in conn.execute(SQL_ALL_CALLS).fetchall()]
+            changed = [session for session in sessions if change(session)]
+            for session in changed:
+                self._store(conn, session.call_id, session)
+            return changed
+
+        return self._transaction(work)
+
+    def get(self, call_id):
+        row = self._db().execute(SQL_GET_CALL, (call_id,)).fetchone()
+        return CallSession.from_json(call_id, row[0]) if row else None
+
+    def __len__(self):
+        return self._db().execute(SQL_COUNT_CALLS).fetchone()[0]
+
+    def close(self):
+        self._connections.close()
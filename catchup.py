@@ -0,0 +1,40 @@
+import os
+
+# Догон после переподключения или возврата в комнату. Клиент присылает
+# событие sync с последним увиденным seq по каждой открытой комнате
+# ({'rooms': {комната: seq}}) и получает одной пачкой только пропущенное
+# (номера seq в комнате идут подряд с 1). Вместо пропущенного - refetch,
+# если клиент отстал больше чем на SYNC_LIMIT сообщений, начало пропуска
+# уже удалено политикой хранения или клиент впереди сервера (история
+# сброшена): тогда дешевле заново загрузить последнюю страницу.
+
+SYNC_LIMIT = int(os.environ.get('SYNC_LIMIT', 200))
+SYNC_MAX_ROOMS = 20
+
+
+def _last_seen(value):
+    return value if isinstance(value, int) and not isinstance(value, bool) and value >= 0 else None
+
+
+# page(room, after=..., limit=...) -> (Message по возрастанию seq, next_cursor),
+# как storage.get_messages и RoomHistory.page.
+# -> {комната: {'messages': [...]} или {'refetch': True}}
+def catch_up(page, rooms, limit=SYNC_LIMIT, max_rooms=SYNC_MAX_ROOMS):
+    reply = {}
+    if not isinstance(rooms, dict):
+        return reply
+    for room, value in list(rooms.items())[:max_rooms]:
+        last_seq = _last_seen(value)
+        if last_seq is None:
+            continue
+        messages, more = page(room, after=last_seq, limit=limit)
+        if more is not None or (messages and messages[0].seq != last_seq + 1):
+            reply[room] = {'refetch': True}
+            continue
+        if not messages and last_seq:
+            latest, _ = page(room, limit=1)
+            if not latest or latest[-1].seq < last_seq:
+                reply[room] = {'refetch': True}
+                continue
+        reply[room] = {'messages': [message.to_dict(room) for message in messages]}
+    return reply
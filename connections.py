@@ -0,0 +1,266 @@
+import os
+import threading
+import time
+
+from storage import SQLiteConnections
+
+# Реестр подключений: sid -> соединение и username -> множество sid.
+# Все операции O(1), у пользователя может быть несколько вкладок.
+# SQLiteConnectionRegistry - тот же реестр, общий для нескольких
+# процессов-воркеров: сессии лежат в SQLite, поэтому адресные события
+# (звонки, WebRTC) находят получателя на любом воркере.
+
+
+class Connection:
+    __slots__ = ('sid', 'username', 'rooms', 'connected_at')
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.username = None
+        self.rooms = set()
+        self.connected_at = time.time()
+
+
+class ConnectionRegistry:
+    def __init__(self):
+        self._by_sid = {}
+        self._by_user = {}
+        self._by_room = {}
+        self._lock = threading.Lock()
+
+    def connect(self, sid):
+        with self._lock:
+            conn = self._by_sid.get(sid)
+            if conn is None:
+                conn = self._by_sid[sid] = Connection(sid)
+            return conn
+
+    # Привязать соединение к пользователю.
+    # Возвращает True, если это первая сессия пользователя (он только что появился в сети).
+    def bind(self, sid, username):
+        with self._lock:
+            conn = self._by_sid.get(sid)
+            if conn is None:
+                conn = self._by_sid[sid] = Connection(sid)
+            if conn.username == username:
+                return False
+            if conn.username is not None:
+                self._unbind(conn)
+            conn.username = username
+            sessions = self._by_user.setdefault(username, set())
+            sessions.add(sid)
+            return len(sessions) == 1
+
+    # Возвращает (соединение, была ли это последняя сессия пользователя)
+    def disconnect(self, sid):
+        with self._lock:
+            conn = self._by_sid.pop(sid, None)
+            if conn is None:
+                return None, False
+            for room in conn.rooms:
+                self._discard_room(room, sid)
+            if conn.username is None:
+                return conn, False
+            return conn, self._unbind(conn)
+
+    def _unbind(self, conn):
+        sessions = self._by_user.get(conn.username)
+        if sessions is None:
+            return False
+        sessions.discard(conn.sid)
+        if not sessions:
+            del self._by_user[conn.username]
+            return True
+        return False
+
+    def get(self, sid):
+        return self._by_sid.get(sid)
+
+    def username(self, sid):
+        conn = self._by_sid.get(sid)
+        return conn.username if conn is not None else None
+
+    def sessions(self, username):
+        with self._lock:
+            return list(self._by_user.get(username, ()))
+
+    def is_online(self, username):
+        return username in self._by_user
+
+    def users(self):
+        with self._lock:
+            return list(self._by_user)
+
+    # Кто онлайн из комнат rooms, плюс онлайн-пользователи из users
+    def online_in(self, rooms=(), users=()):
+        with self._lock:
+            online = {username for username in users if username in self._by_user}
+            for room in rooms:
+                for sid in self._by_room.get(room, ()):
+                    username = self._by_sid[sid].username
+                    if username is not None:
+                        online.add(username)
+            return online
+
+    # Вкладки, открывавшие комнату room
+    def room_sessions(self, room):
+        with self._lock:
+            return list(self._by_room.get(room, ()))
+
+    def join_room(self, sid, room):
+        with self._lock:
+            conn = self._by_sid.get(sid)
+            if conn is not None:
+                conn.rooms.add(room)
+                self._by_room.setdefault(room, set()).add(sid)
+
+    def leave_room(self, sid, room):
+        with self._lock:
+            conn = self._by_sid.get(sid)
+            if conn is not None:
+                conn.rooms.discard(room)
+                self._discard_room(room, sid)
+
+    def _discard_room(self, room, sid):
+        sids = self._by_room.get(room)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._by_room[room]
+
+    def __len__(self):
+        return len(self._by_sid)
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    sid TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    worker INTEGER NOT NULL,
+    connected_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username);
+CREATE TABLE IF NOT EXISTS session_rooms (
+    sid TEXT NOT NULL,
+    room TEXT NOT NULL,
+    PRIMARY KEY (sid, room)
+);
+CREATE INDEX IF NOT EXISTS session_rooms_room ON session_rooms (room);
+"""
+
+SQL_BIND = 'INSERT OR REPLACE INTO sessions (sid, username, worker, connected_at) VALUES (?, ?, ?, ?)'
+SQL_COUNT_SESSIONS = 'SELECT COUNT(*) FROM sessions WHERE username = ?'
+SQL_DELETE_SESSION = 'DELETE FROM sessions WHERE sid = ?'
+SQL_DELETE_SESSION_ROOMS = 'DELETE FROM session_rooms WHERE sid = ?'
+SQL_SESSIONS = 'SELECT sid FROM sessions WHERE username = ?'
+SQL_USERS = 'SELECT DISTINCT username FROM sessions'
+SQL_JOIN_ROOM = 'INSERT OR IGNORE INTO session_rooms (sid, room) VALUES (?, ?)'
+SQL_LEAVE_ROOM = 'DELETE FROM session_rooms WHERE sid = ? AND room = ?'
+SQL_ROOM_USERS = '''SELECT DISTINCT s.username FROM session_rooms r
+    JOIN sessions s ON s.sid = r.sid WHERE r.room = ?'''
+SQL_ROOM_SESSIONS = 'SELECT sid FROM session_rooms WHERE room = ?'
+SQL_WORKERS = 'SELECT DISTINCT worker FROM sessions'
+SQL_DELETE_WORKER_ROOMS = 'DELETE FROM session_rooms WHERE sid IN (SELECT sid FROM sessions WHERE worker = ?)'
+SQL_DELETE_WORKER = 'DELETE FROM sessions WHERE worker = ?'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SQLiteConnectionRegistry(ConnectionRegistry):
+    # Локальные Connection (get, rooms) остаются в памяти процесса,
+    # всё, что нужно другим воркерам, - в таблицах sessions/session_rooms.
+    # Воркер - это pid: сессии умерших процессов на этом хосте удаляются при старте.
+    def __init__(self, path, worker=None):
+        super().__init__()
+        self.worker = os.getpid() if worker is None else worker
+        self._connections = SQLiteConnections(path)
+        self._db = self._connections.get
+        self._db().executescript(SCHEMA)
+        self._purge(lambda worker: worker == self.worker or not _pid_alive(worker))
+
+    def _purge(self, dead):
+        conn = self._db()
+        for row in conn.execute(SQL_WORKERS).fetchall():
+            worker = row[0]
+            if dead(worker):
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute(SQL_DELETE_WORKER_ROOMS, (worker,))
+                    conn.execute(SQL_DELETE_WORKER, (worker,))
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+
+    def bind(self, sid, username):
+        super().bind(sid, username)
+        conn = self._db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(SQL_BIND, (sid, username, self.worker, time.time()))
+            count = conn.execute(SQL_COUNT_SESSIONS, (username,)).fetchone()[0]
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return count == 1
+
+    def disconnect(self, sid):
+        local, _ = super().disconnect(sid)
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(SQL_DELETE_SESSION_ROOMS, (sid,))
+            db.execute(SQL_DELETE_SESSION, (sid,))
+            remaining = 0
+            if local is not None and local.username is not None:
+                remaining = db.execute(SQL_COUNT_SESSIONS, (local.username,)).fetchone()[0]
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        if local is None or local.username is None:
+            return local, False
+        return local, remaining == 0
+
+    def sessions(self, username):
+        return [row[0] for row in self._db().execute(SQL_SESSIONS, (username,))]
+
+    def is_online(self, username):
+        return self._db().execute(SQL_COUNT_SESSIONS, (username,)).fetchone()[0] > 0
+
+    def users(self):
+        return [row[0] for row in self._db().execute(SQL_USERS)]
+
+    def online_in(self, rooms=(), users=()):
+        online = {username for username in users if self.is_online(username)}
+        for room in rooms:
+            online.update(row[0] for row in self._db().execute(SQL_ROOM_USERS, (room,)))
+        return online
+
+    def room_sessions(self, room):
+        return [row[0] for row in self._db().execute(SQL_ROOM_SESSIONS, (room,))]
+
+    def join_room(self, sid, room):
+        super().join_room(sid, room)
+        self._db().execute(SQL_JOIN_ROOM, (sid, room))
+
+    def leave_room(self, sid, room):
+        super().leave_room(sid, room)
+        self._db().execute(SQL_LEAVE_ROOM, (sid, room))
+
+    # Сессии этого воркера больше не существуют
+    def close(self):
+        self._purge(lambda worker: worker == self.worker)
+        self._connections.close()
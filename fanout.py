@@ -0,0 +1,76 @@
+import logging
+import threading
+
+# Доставка сообщений пачками. При всплеске в большой комнате дорого не
+# само сообщение, а каждый emit: сериализация и запись в каждый сокет.
+# С пачками сообщения комнаты копятся в её очереди и уходят одним событием
+# new_messages {room, messages} - через interval секунд после первого
+# сообщения пачки или сразу, как только в ней max_batch сообщений.
+# Сообщение ждёт доставки не дольше interval.
+#
+# Режим включается MESSAGE_BATCHING=1; без него каждое сообщение уходит
+# отдельным new_message, как раньше. chat.html понимает оба события.
+
+BATCH_INTERVAL = 0.005
+BATCH_MAX = 100
+
+logger = logging.getLogger(__name__)
+
+
+class MessageOutbox:
+    def __init__(self, emit_batch, interval=BATCH_INTERVAL, max_batch=BATCH_MAX):
+        self.emit_batch = emit_batch  # emit_batch(room, messages)
+        self.interval = interval
+        self.max_batch = max_batch
+        self._rooms = {}  # room -> сообщения, ещё не отправленные
+        self._lock = threading.Lock()
+        self._pending = threading.Event()  # есть что отправлять
+        self._full = threading.Event()     # какая-то пачка набрала max_batch
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='message-outbox', daemon=True)
+            self._thread.start()
+
+    # Остановить поток и отправить всё, что накопилось
+    def stop(self):
+        self._stop.set()
+        self._pending.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def add(self, room, message):
+        with self._lock:
+            batch = self._rooms.get(room)
+            if batch is None:
+                batch = self._rooms[room] = []
+            batch.append(message)
+            full = len(batch) >= self.max_batch
+        self._pending.set()
+        if full:
+            self._full.set()
+
+    def flush(self):
+        with self._lock:
+            rooms, self._rooms = self._rooms, {}
+        for room, messages in rooms.items():
+            for start in range(0, len(messages), self.max_batch):
+                self.emit_batch(room, messages[start:start + self.max_batch])
+
+    def _run(self):
+        while True:
+            # Простаивая, поток спит; окно накопления открывает первое сообщение
+            self._pending.wait()
+            if self._stop.is_set():
+                return
+            self._full.wait(self.interval)
+            self._full.clear()
+            self._pending.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Ошибка рассылки сообщений')
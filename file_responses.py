@@ -0,0 +1,276 @@
+import asyncio
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+# Отдача файлов, которые не меняются под своим именем (загрузки, статика):
+#   - сильный ETag и Cache-Control: immutable - повторный показ берётся из
+#     кеша браузера, а проверка If-None-Match отвечает 304 без тела;
+#   - Range: один диапазон - 206, несколько - multipart/byteranges (перемотка
+#     mp4/mov), пересекающиеся диапазоны склеиваются;
+#   - без копирования через пользовательское пространство, где сервер умеет:
+#     wsgi.file_wrapper (sendfile в gunicorn/uWSGI), ASGI-расширения
+#     http.response.zerocopysend и http.response.pathsend;
+#   - небольшие горячие файлы - из LRU в памяти (FileCache).
+# prepare() решает, что отвечать, wsgi_response() и ASGIFileResponse
+# отдают это во Flask и в Starlette.
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+BLOCK_SIZE = 64 * 1024
+# Больше диапазонов в одном запросе - отдаём файл целиком
+MAX_RANGES = 16
+CACHE_BYTES = 32 * 1024 * 1024
+CACHE_FILE_MAX = 256 * 1024
+
+
+class FileCache:
+    def __init__(self, max_bytes=CACHE_BYTES, max_file=CACHE_FILE_MAX):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    # UPLOAD_CACHE_BYTES=0 выключает кеш
+    @classmethod
+    def from_env(cls, prefix='UPLOAD'):
+        return cls(
+            max_bytes=int(os.environ.get(f'{prefix}_CACHE_BYTES', CACHE_BYTES)),
+            max_file=int(os.environ.get(f'{prefix}_CACHE_FILE_MAX', CACHE_FILE_MAX))
+        )
+
+    # Содержимое файла по ключу (ETag) или None, если файл не для кеша
+    def load(self, key, path, size):
+        if size > self.max_file or size > self.max_bytes:
+            return None
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                return data
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, old = self._items.popitem(last=False)
+                    self.size -= len(old)
+        return data
+
+
+def etag_matches(header, etag):
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    # If-None-Match сравнивает слабо: W/"x" совпадает с "x"
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+def not_modified_since(header, mtime):
+    if header is None:
+        return False
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+# Range: bytes=... -> [(start, end)] включительно, отсортированные и склеенные.
+# None - заголовка нет или он непонятен (отдаём файл целиком),
+# [] - ни один диапазон не попадает в файл (416).
+def parse_ranges(header, size):
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for part in header[len('bytes='):].split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+                if last and int(last) < start:
+                    return None
+            else:
+                # Суффикс: последние N байт
+                start = max(size - int(last), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start < size and start <= end:
+            ranges.append((start, end))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return None if len(merged) > MAX_RANGES else merged
+
+
+class FilePlan:
+    __slots__ = ('status', 'headers', 'path', 'size', 'segments', 'data')
+
+    def __init__(self, status, headers, path=None, size=0, segments=(), data=None):
+        self.status = status
+        self.headers = headers
+        self.path = path
+        self.size = size
+        # Тело: байты (заголовки частей multipart) и диапазоны файла (start, end)
+        self.segments = segments
+        self.data = data
+
+    @property
+    def whole_file(self):
+        return self.status == 200 and self.data is None
+
+    def iter_body(self):
+        if not self.segments:
+            return
+        f = None if self.data is not None else open(self.path, 'rb')
+        try:
+            for segment in self.segments:
+                if isinstance(segment, bytes):
+                    yield segment
+                    continue
+                start, end = segment
+                if f is None:
+                    yield self.data[start:end + 1]
+                    continue
+                f.seek(start)
+                remaining = end + 1 - start
+                while remaining:
+                    block = f.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    yield block
+        finally:
+            if f is not None:
+                f.close()
+
+
+# get_header(name) -> значение заголовка запроса или None
+def prepare(path, etag, content_type, get_header, cache=None, cache_control=IMMUTABLE, extra_headers=()):
+    stat = os.stat(path)
+    size = stat.st_size
+    headers = [
+        ('ETag', etag),
+        ('Last-Modified', formatdate(stat.st_mtime, usegmt=True)),
+        ('Cache-Control', cache_control),
+        ('Accept-Ranges', 'bytes'),
+        *extra_headers
+    ]
+
+    # If-Modified-Since учитывается только без If-None-Match
+    if_none_match = get_header('If-None-Match')
+    if etag_matches(if_none_match, etag) or (
+            if_none_match is None and not_modified_since(get_header('If-Modified-Since'), stat.st_mtime)):
+        return FilePlan(304, headers)
+
+    ranges = parse_ranges(get_header('Range'), size)
+    # If-Range с другим ETag - файл сменился, диапазоны к нему не относятся
+    if_range = get_header('If-Range')
+    if ranges is not None and if_range is not None and if_range != etag:
+        ranges = None
+    if ranges == []:
+        return FilePlan(416, headers + [('Content-Range', f'bytes */{size}'), ('Content-Length', '0')])
+
+    data = cache.load(etag, path, size) if cache is not None else None
+
+    if ranges is None:
+        headers += [('Content-Type', content_type), ('Content-Length', str(size))]
+        return FilePlan(200, headers, path, size, [(0, size - 1)] if size else [], data)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers += [('Content-Type', content_type), ('Content-Range', f'bytes {start}-{end}/{size}'),
+                    ('Content-Length', str(end + 1 - start))]
+        return FilePlan(206, headers, path, size, ranges, data)
+
+    boundary = uuid.uuid4().hex
+    segments = []
+    length = 0
+    for index, (start, end) in enumerate(ranges):
+        part = (b'\r\n' if index else b'') + (f'--{boundary}\r\n'
+                                               f'Content-Type: {content_type}\r\n'
+                                               f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode('latin-1')
+        segments += [part, (start, end)]
+        length += len(part) + end + 1 - start
+    closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+    segments.append(closing)
+    length += len(closing)
+    headers += [('Content-Type', f'multipart/byteranges; boundary={boundary}'), ('Content-Length', str(length))]
+    return FilePlan(206, headers, path, size, segments, data)
+
+
+def wsgi_response(plan, environ):
+    if plan.whole_file and plan.size and environ.get('REQUEST_METHOD') != 'HEAD':
+        # wsgi.file_wrapper сервера (если есть) отдаёт файл через sendfile
+        body = wrap_file(environ, open(plan.path, 'rb'), BLOCK_SIZE)
+    else:
+        body = plan.iter_body()
+    return Response(body, status=plan.status, headers=plan.headers, direct_passthrough=True)
+
+
+# Ответ для Starlette (и любого ASGI-приложения)
+class ASGIFileResponse:
+    def __init__(self, plan):
+        self.plan = plan
+
+    async def __call__(self, scope, receive, send):
+        plan = self.plan
+        await send({
+            'type': 'http.response.start',
+            'status': plan.status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in plan.headers]
+        })
+        extensions = scope.get('extensions') or {}
+        if scope.get('method') == 'HEAD' or not plan.segments:
+            await send({'type': 'http.response.body', 'body': b''})
+        elif plan.data is not None:
+            body = b''.join(plan.iter_body())
+            await send({'type': 'http.response.body', 'body': body})
+        elif 'http.response.zerocopysend' in extensions:
+            await self._zerocopy(send)
+        elif plan.whole_file and 'http.response.pathsend' in extensions:
+            await send({'type': 'http.response.pathsend', 'path': os.path.abspath(plan.path)})
+        else:
+            await self._stream(send)
+
+    async def _zerocopy(self, send):
+        with open(self.plan.path, 'rb') as f:
+            segments = self.plan.segments
+            for index, segment in enumerate(segments):
+                more = index < len(segments) - 1
+                if isinstance(segment, bytes):
+                    await send({'type': 'http.response.body', 'body': segment, 'more_body': more})
+                else:
+                    start, end = segment
+                    await send({'type': 'http.response.zerocopysend', 'file': f.fileno(),
+                                'offset': start, 'count': end + 1 - start, 'more_body': more})
+
+    # Чтение с диска - в пуле потоков, чтобы не держать цикл событий
+    async def _stream(self, send):
+        loop = asyncio.get_running_loop()
+        body = self.plan.iter_body()
+        try:
+            while True:
+                block = await loop.run_in_executor(None, next, body, None)
+                if block is None:
+                    break
+                await send({'type': 'http.response.body', 'body': block, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            body.close()
@@ -0,0 +1,487 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from itertools import islice
+from urllib.parse import quote, unquote
+
+from message import Message
+
+logger = logging.getLogger(__name__)
+
+# История комнат на диске: каталог на комнату, внутри сегменты
+# <первый_номер>.seg (по строке на сообщение) и .idx (смещения строк, uint64).
+# По индексу можно прочитать любой диапазон сообщений, не разбирая весь файл.
+
+SEGMENT_MESSAGES = 10000
+HOT_MESSAGES = 500
+HOT_ROOMS = 1000
+
+# Компактная запись: массив полей в фиксированном порядке, без ключей,
+# без room и без seq (номер определяется позицией строки в сегменте)
+RECORD_FIELDS = ('username', 'text', 'file', 'file_info', 'ts', 'type')
+# Прежний формат строки: с UUID и ISO-временем
+LEGACY_RECORD_FIELDS = ('id', 'username', 'text', 'file', 'file_info', 'timestamp', 'type')
+
+
+def encode_message(message):
+    record = [message.username, message.text, message.file, message.file_info, message.ts, message.type]
+    return (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def decode_message(line, seq):
+    record = json.loads(line)
+    if len(record) == len(LEGACY_RECORD_FIELDS):
+        return Message.from_dict(dict(zip(LEGACY_RECORD_FIELDS, record)), seq)
+    username, text, file, file_info, ts, type = record
+    return Message(username, text, file, file_info, ts, type, seq)
+
+
+# Страница истории по курсорам: номера [start, stop) и есть ли ещё сообщения
+# в направлении листания. Без курсоров - последние limit сообщений,
+# before - более старые, after - более новые.
+def page_range(first_seq, count, before=None, after=None, limit=100):
+    next_seq = first_seq + count
+    stop = min(before, next_seq) if before is not None else next_seq
+    if after is not None:
+        start = max(after + 1, first_seq)
+        end = max(min(start + limit, stop), start)
+        return start, end, end < stop
+    start = max(stop - limit, first_seq)
+    return start, max(stop, start), start > first_seq
+
+
+def page_cursor(messages, more, after=None):
+    if not more or not messages:
+        return None
+    return messages[-1].seq if after is not None else messages[0].seq
+
+
+def room_dirname(room):
+    name = quote(room, safe='')
+    # Не даём комнате называться '.' или '..'
+    return '%2E' + name[1:] if name.startswith('.') else name
+
+
+def room_from_dirname(name):
+    return unquote(name)
+
+
+def write_all(f, data):
+    view = memoryview(data)
+    while view:
+        view = view[f.write(view):]
+
+
+def _read_offsets(path):
+    offsets = array('Q')
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return offsets
+    offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+    return offsets
+
+
+# Файлы сегментов открываются только на время записи пачки: держать их
+# открытыми - по два дескриптора на каждую комнату, и при тысячах комнат
+# процесс упирается в лимит дескрипторов. В памяти - только номера сегментов
+# и число строк в последнем.
+class RoomLog:
+    def __init__(self, path, room, segment_messages=SEGMENT_MESSAGES):
+        self.path = path
+        self.room = room
+        self.segment_messages = segment_messages
+        self._lock = threading.Lock()
+        self._unsynced = set()  # сегменты, записанные после последнего sync()
+
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.seg'))
+        if self.segments:
+            self._active_count = self._repair(self.segments[-1])
+        else:
+            self._active_count = 0
+
+    @property
+    def first_seq(self):
+        return self.segments[0] if self.segments else 1
+
+    @property
+    def next_seq(self):
+        return self.segments[-1] + self._active_count if self.segments else 1
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    def _seg_path(self, first_seq):
+        return os.path.join(self.path, f'{first_seq:012d}.seg')
+
+    def _idx_path(self, first_seq):
+        return os.path.join(self.path, f'{first_seq:012d}.idx')
+
+    # Приводим .idx и .seg последнего сегмента в согласие после падения:
+    # отбрасываем недописанную строку и доиндексируем строки без смещения.
+    def _repair(self, first_seq):
+        seg_path, idx_path = self._seg_path(first_seq), self._idx_path(first_seq)
+        offsets = _read_offsets(idx_path)
+        with open(seg_path, 'rb') as f:
+            data = f.read()
+        while offsets and offsets[-1] >= len(data):
+            offsets.pop()
+        if offsets and data.find(b'\n', offsets[-1]) == -1:
+            offsets.pop()
+        pos = data.find(b'\n', offsets[-1]) + 1 if offsets else 0
+        while True:
+            end = data.find(b'\n', pos)
+            if end == -1:
+                break
+            offsets.append(pos)
+            pos = end + 1
+        if pos != len(data):
+            with open(seg_path, 'r+b') as f:
+                f.truncate(pos)
+        with open(idx_path, 'wb') as f:
+            offsets.tofile(f)
+        return len(offsets)
+
+    # Дописываем пачку сообщений; сначала данные, потом индекс -
+    # читатель видит только строки, смещения которых уже записаны.
+    # Сообщения с уже назначенным seq, который есть на диске, пропускаются:
+    # так пачку можно повторить после ошибки записи (persistence.py).
+    def append(self, messages):
+        with self._lock:
+            messages = [message for message in messages if not 0 < message.seq < self.next_seq]
+            while messages:
+                rollover = not self.segments or self._active_count >= self.segment_messages
+                first_seq = self.next_seq if rollover else self.segments[-1]
+                chunk = messages[:self.segment_messages - (0 if rollover else self._active_count)]
+                self._write(first_seq, chunk)
+                if rollover:
+                    self.segments.append(first_seq)
+                    self._active_count = 0
+                self._active_count += len(chunk)
+                self._unsynced.add(first_seq)
+                messages = messages[len(chunk):]
+
+    # Номер сообщения - позиция его строки, поэтому при ошибке недописанное
+    # обрезается: на диске остаётся ровно то, что было до пачки
+    def _write(self, first_seq, messages):
+        lines = [encode_message(message) for message in messages]
+        with open(self._seg_path(first_seq), 'ab', buffering=0) as seg, \
+                open(self._idx_path(first_seq), 'ab', buffering=0) as idx:
+            seg_size = seg.seek(0, os.SEEK_END)
+            idx_size = idx.seek(0, os.SEEK_END)
+            offsets = array('Q')
+            offset = seg_size
+            for line in lines:
+                offsets.append(offset)
+                offset += len(line)
+            try:
+                write_all(seg, b''.join(lines))
+                write_all(idx, offsets.tobytes())
+            except BaseException:
+                seg.truncate(seg_size)
+                idx.truncate(idx_size)
+                raise
+
+    def sync(self):
+        with self._lock:
+            unsynced, self._unsynced = self._unsynced, set()
+            try:
+                for first_seq in sorted(unsynced):
+                    for path in (self._seg_path(first_seq), self._idx_path(first_seq)):
+                        try:
+                            fd = os.open(path, os.O_RDONLY)
+                        except FileNotFoundError:
+                            # Сегмент удалён по сроку хранения
+                            continue
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+            except BaseException:
+                self._unsynced |= unsynced
+                raise
+
+    # Сообщения с номерами [start, stop)
+    def read(self, start=None, stop=None):
+        with self._lock:
+            segments = list(self.segments)
+            next_seq = self.next_seq
+        start = max(start or 1, segments[0]) if segments else 1
+        stop = min(stop or next_seq, next_seq)
+
+        messages = []
+        for i, first_seq in enumerate(segments):
+            last_seq = segments[i + 1] if i + 1 < len(segments) else next_seq
+            if last_seq <= start or first_seq >= stop:
+                continue
+            offsets = _read_offsets(self._idx_path(first_seq))
+            lo, hi = max(start, first_seq) - first_seq, min(stop, last_seq) - first_seq
+            hi = min(hi, len(offsets))
+            if lo >= hi:
+                continue
+            try:
+                with open(self._seg_path(first_seq), 'rb') as f:
+                    f.seek(offsets[lo])
+                    end = offsets[hi] if hi < len(offsets) else None
+                    data = f.read(end - offsets[lo]) if end is not None else f.read()
+            except FileNotFoundError:
+                # Сегмент только что удалён по сроку хранения
+                continue
+            lines = data.split(b'\n')[:hi - lo]
+            messages.extend(decode_message(line, first_seq + lo + n) for n, line in enumerate(lines))
+        return messages
+
+    def _last_timestamp(self, first_seq):
+        offsets = _read_offsets(self._idx_path(first_seq))
+        if not offsets:
+            return None
+        with open(self._seg_path(first_seq), 'rb') as f:
+            f.seek(offsets[-1])
+            return decode_message(f.readline(), 0).ts
+
+    # Удаляем целые закрытые сегменты с начала, пока их требует политика.
+    # Активный (последний) сегмент не трогаем никогда. on_trim(files) -
+    # поля file сообщений из удаляемых сегментов.
+    def apply_retention(self, retention, now=None, on_trim=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            segments = list(self.segments)
+            next_seq = self.next_seq
+        sizes = [os.path.getsize(self._seg_path(first_seq)) for first_seq in segments]
+        total = sum(sizes)
+
+        drop = 0
+        for i in range(len(segments) - 1):
+            expired = (
+                (retention.max_messages is not None and
+                 next_seq - segments[i + 1] >= retention.max_messages) or
+                (retention.max_bytes is not None and total > retention.max_bytes) or
+                (retention.max_age is not None and
+                 self._last_timestamp(segments[i]) < now - retention.max_age)
+            )
+            if not expired:
+                break
+            total -= sizes[i]
+            drop += 1
+
+        if drop:
+            if on_trim is not None:
+                files = [message.file for message in self.read(segments[0], segments[drop]) if message.file]
+                if files:
+                    on_trim(files)
+            with self._lock:
+                dropped, self.segments = self.segments[:drop], self.segments[drop:]
+            for first_seq in dropped:
+                os.remove(self._seg_path(first_seq))
+                os.remove(self._idx_path(first_seq))
+        return drop
+
+
+class RoomStore:
+    def __init__(self, root, segment_messages=SEGMENT_MESSAGES):
+        self.root = root
+        self.segment_messages = segment_messages
+        self._logs = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def rooms(self):
+        return [room_from_dirname(name) for name in os.listdir(self.root)]
+
+    def exists(self, room):
+        return room in self._logs or os.path.isdir(os.path.join(self.root, room_dirname(room)))
+
+    def log(self, room):
+        with self._lock:
+            log = self._logs.get(room)
+            if log is None:
+                log = RoomLog(os.path.join(self.root, room_dirname(room)), room, self.segment_messages)
+                self._logs[room] = log
+            return log
+
+    def enforce_retention(self, retention_for, on_trim=None):
+        for room in self.rooms():
+            retention = retention_for(room)
+            if retention:
+                self.log(room).apply_retention(retention, on_trim=on_trim)
+
+    # Открытых файлов у журналов нет - закрывать нечего
+    def close(self):
+        with self._lock:
+            self._logs.clear()
+
+
+# Срок хранения истории комнаты: по числу сообщений, возрасту (секунды)
+# или объёму на диске. Пустая политика ничего не удаляет.
+class Retention:
+    def __init__(self, max_messages=None, max_age=None, max_bytes=None):
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def __bool__(self):
+        return any(limit is not None for limit in (self.max_messages, self.max_age, self.max_bytes))
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        def get(name, cast):
+            value = environ.get(name)
+            return cast(value) if value else None
+        return cls(
+            max_messages=get('RETENTION_MESSAGES', int),
+            max_age=get('RETENTION_SECONDS', float),
+            max_bytes=get('RETENTION_BYTES', int)
+        )
+
+
+# Фоновый поток, который раз в interval секунд применяет сроки хранения
+class RetentionCompactor:
+    def __init__(self, enforce, interval=300.0):
+        self.enforce = enforce
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='retention-compactor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.enforce()
+            except Exception:
+                logger.exception('Ошибка очистки истории')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+# Последние сообщения комнаты в памяти; всё, что старше, читается из RoomLog
+class HotWindow:
+    __slots__ = ('messages', 'next_seq')
+
+    def __init__(self, next_seq=1, maxlen=None):
+        self.messages = deque(maxlen=maxlen)
+        self.next_seq = next_seq
+
+    @property
+    def first_seq(self):
+        return self.messages[0].seq if self.messages else self.next_seq
+
+    def push(self, message):
+        message.seq = self.next_seq
+        self.next_seq += 1
+        self.messages.append(message)
+        return message
+
+    # Номера [start, stop): горячая часть - из памяти, холодная - с диска
+    def page(self, log, before=None, after=None, limit=100):
+        hot_start = self.first_seq
+        first_seq = min(log.first_seq, hot_start) if log is not None else hot_start
+        start, stop, more = page_range(first_seq, self.next_seq - first_seq, before, after, limit)
+        page = list(islice(self.messages, max(start - hot_start, 0), max(stop - hot_start, 0)))
+        return start, min(stop, hot_start), page, more
+
+
+def read_page(window, log, lock, before=None, after=None, limit=100):
+    with lock:
+        start, cold_stop, page, more = window.page(log, before, after, limit)
+    if start < cold_stop and log is not None:
+        page = log.read(start, cold_stop) + page
+    return page, page_cursor(page, more, after)
+
+
+# Замена словаря messages_db: в памяти только последние hot_size сообщений
+# комнаты, остальная история читается из сегментов на диске по запросу.
+# on_append(room, message) вызывается под блокировкой, поэтому порядок
+# записи в журнал совпадает с порядком номеров seq.
+class RoomHistory:
+    # max_rooms - сколько окон держать в памяти; давно не открытые
+    # выгружаются и при следующем обращении читаются из сегментов заново
+    def __init__(self, store, on_append=None, hot_size=HOT_MESSAGES, max_rooms=HOT_ROOMS):
+        self.store = store
+        self.on_append = on_append
+        self.hot_size = hot_size
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()  # room -> HotWindow, недавние - в конце
+        self._lock = threading.RLock()
+
+    def _log(self, room):
+        return self.store.log(room) if self.store.exists(room) else None
+
+    # create=False: комнаты без сообщений нет - None, окно не заводится
+    # (иначе любое имя из запроса оставалось бы в памяти навсегда)
+    def _window(self, room, create=True):
+        window = self._rooms.get(room)
+        if window is not None:
+            self._rooms.move_to_end(room)
+            return window
+        log = self._log(room)
+        if log is None and not create:
+            return None
+        # Одна копия строки комнаты на все окна и ключи словарей
+        room = sys.intern(room)
+        if log is not None:
+            window = HotWindow(log.next_seq, self.hot_size)
+            window.messages.extend(log.read(log.next_seq - self.hot_size, log.next_seq))
+        else:
+            window = HotWindow(maxlen=self.hot_size)
+        self._rooms[room] = window
+        self._evict()
+        return window
+
+    # Окна сверх max_rooms, начиная с давно не открытых. Выгружается только
+    # окно, все сообщения которого уже в сегментах (on_append пишет в фоне),
+    # иначе после перечитывания номера seq пошли бы заново.
+    def _evict(self):
+        excess = len(self._rooms) - self.max_rooms
+        for room in list(self._rooms):
+            if excess <= 0:
+                break
+            log = self._log(room)
+            if (log.next_seq if log is not None else 1) >= self._rooms[room].next_seq:
+                del self._rooms[room]
+                excess -= 1
+
+    def __contains__(self, room):
+        return room in self._rooms or self.store.exists(room)
+
+    def append(self, room, message):
+        with self._lock:
+            self._window(room).push(message)
+            if self.on_append is not None:
+                self.on_append(room, message)
+        return message
+
+    def page(self, room, before=None, after=None, limit=100):
+        with self._lock:
+            window = self._window(room, create=False)
+        if window is None:
+            return [], None
+        return read_page(window, self._log(room), self._lock, before, after, limit)
+
+    # Сколько сообщений хранится в каждой комнате: {room: число}.
+    # Комнаты, которые ещё не открывали, считаются по сегментам на диске.
+    def sizes(self):
+        with self._lock:
+            windows = dict(self._rooms)
+        sizes = {}
+        for room in set(windows) | set(self.store.rooms()):
+            log = self._log(room)
+            window = windows.get(room)
+            next_seq = window.next_seq if window is not None else log.next_seq
+            first_seq = log.first_seq if log is not None else window.first_seq
+            sizes[room] = next_seq - first_seq
+        return sizes
@@ -0,0 +1,32 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+# Журнал, который не тормозит обработчики: запись только кладётся в
+# очередь, в stderr её пишет отдельный поток (QueueListener). Раньше
+# print() в обработчиках событий писал в stdout прямо в потоке запроса.
+# Уровень - LOG_LEVEL (DEBUG, INFO, WARNING, ERROR); на DEBUG видны
+# подключения, переходы по комнатам и сигналинг звонков.
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_listener = None
+
+
+# Повторный вызов ничего не делает: модули приложения зовут setup() при импорте
+def setup(level=LOG_LEVEL):
+    global _listener
+    if _listener is not None:
+        return
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,76 @@
+import sys
+import time
+from datetime import datetime
+
+# Компактная запись сообщения. Вместо словаря на каждое сообщение -
+# объект со __slots__: без повторяющихся ключей, без UUID-строки и без
+# ISO-строки времени. Комната не хранится - сообщение и так лежит в её истории.
+# Привычный словарь для клиента собирается только на границе (emit/HTTP).
+
+
+def intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class Message:
+    __slots__ = ('seq', 'username', 'text', 'file', 'file_info', 'ts', 'type')
+
+    def __init__(self, username, text='', file=None, file_info=None, ts=None, type='text', seq=0):
+        self.seq = seq
+        self.username = intern(username)
+        self.text = text
+        self.file = file
+        self.file_info = file_info
+        self.ts = time.time() if ts is None else ts
+        self.type = intern(type)
+
+    # Из данных события send_message
+    @classmethod
+    def from_event(cls, data):
+        return cls(
+            data['username'],
+            text=data.get('text', ''),
+            file=data.get('file'),
+            file_info=data.get('file_info'),
+            type=data.get('type', 'text')
+        )
+
+    # Из старого словаря (chat_data.json, прежний формат сегментов)
+    @classmethod
+    def from_dict(cls, data, seq=0):
+        return cls(
+            data['username'],
+            text=data.get('text', ''),
+            file=data.get('file'),
+            file_info=data.get('file_info'),
+            ts=parse_timestamp(data['timestamp']),
+            type=data.get('type', 'text'),
+            seq=data.get('seq', seq)
+        )
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.ts).isoformat()
+
+    def message_id(self, room):
+        return f'{room}:{self.seq}'
+
+    # Формат, который ждёт chat.html
+    def to_dict(self, room):
+        return {
+            'id': self.message_id(room),
+            'seq': self.seq,
+            'username': self.username,
+            'text': self.text,
+            'file': self.file,
+            'file_info': self.file_info,
+            'timestamp': self.timestamp,
+            'type': self.type,
+            'room': room
+        }
+
+
+def parse_timestamp(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(value).timestamp()
@@ -0,0 +1,269 @@
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from subscriptions import CHANNEL_PREFIX
+
+# Метрики для /metrics в текстовом формате Prometheus - счётчики и
+# гистограммы в памяти процесса, без prometheus_client.
+#   Counter   - накопленные суммы по меткам
+#   Histogram - распределение величины (задержки в секундах) по корзинам
+#   Gauge     - значение считается функцией collect() при каждом запросе
+# С несколькими воркерами у каждого свои числа: /metrics отдаёт тот
+# процесс, которому достался запрос.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # значения меток -> сумма
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name + _labels(self.labels, values), value) for values, value in items]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # значения меток -> [попадания в каждую корзину, в +Inf, сумма]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            items = [(values, list(counts)) for values, counts in self._values.items()]
+        samples = []
+        for values, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                samples.append((self.name + '_bucket' + _labels(self.labels, values, f'le="{_number(bound)}"'), total))
+            samples.append((self.name + '_sum' + _labels(self.labels, values), counts[-1]))
+            samples.append((self.name + '_count' + _labels(self.labels, values), total))
+        return samples
+
+
+class Gauge:
+    kind = 'gauge'
+
+    # collect() -> число или {значение метки (или кортеж значений): число}
+    def __init__(self, name, help, collect, labels=()):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labels = tuple(labels)
+
+    def samples(self):
+        value = self.collect()
+        if not isinstance(value, dict):
+            return [(self.name, value)]
+        return [(self.name + _labels(self.labels, key if isinstance(key, tuple) else (key,)), number)
+                for key, number in value.items()]
+
+
+class Metrics:
+    def __init__(self, prefix='noknowgram_'):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def gauge(self, name, help, collect, labels=()):
+        return self._add(Gauge(self.prefix + name, help, collect, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # Сломанный gauge не должен ронять весь /metrics
+                logger.warning('Метрика %s не посчиталась: %s', metric.name, e)
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name} {_number(value)}' for name, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+# Общий набор метрик сервера: задержки событий Socket.IO и HTTP-маршрутов,
+# рассылка (emit и сколько сокетов его получили), запись на диск
+class ServerMetrics(Metrics):
+    def __init__(self, prefix='noknowgram_'):
+        super().__init__(prefix)
+        self.events = self.histogram('event_seconds', 'Время обработчика события Socket.IO', ['event'])
+        self.routes = self.histogram('http_request_seconds', 'Время ответа HTTP по маршруту', ['method', 'route'])
+        self.emits = self.counter('emits_total', 'Вызовы emit', ['event'])
+        self.recipients = self.counter('emit_recipients_total', 'Сокеты, получившие emit', ['event'])
+        self.saves = self.histogram('save_seconds', 'Запись на диск', ['kind'])
+        self.rate_limited = self.counter('rate_limited_total', 'События, отброшенные лимитом частоты', ['event'])
+        self.slow_consumers = self.counter('slow_consumer_total',
+                                           'Медленные получатели: park - событие отложено, evict - сокет отключён',
+                                           ['event', 'action'])
+
+    # Для broker.EncodeOnceManager.on_emit
+    def on_emit(self, event, recipients):
+        self.emits.inc(event)
+        self.recipients.inc(event, amount=recipients)
+
+    # Для ratelimit.limit_events
+    def on_limited(self, sid, event):
+        self.rate_limited.inc(event)
+
+    # Для backpressure.Backpressure.on_drop
+    def on_drop(self, event, action):
+        self.slow_consumers.inc(event, action)
+
+    # Сокеты и комнаты Socket.IO этого процесса
+    def socket_gauges(self, server, namespace='/'):
+        def sockets():
+            return len(server.manager.rooms.get(namespace, {}).get(None, ()))
+
+        def rooms():
+            rooms = server.manager.rooms.get(namespace, {})
+            sids = rooms.get(None, {})
+            counts = {'channel': 0, 'call': 0, 'room': 0}
+            for room in list(rooms):
+                if room is None or room in sids:
+                    continue
+                if room.startswith(CHANNEL_PREFIX):
+                    counts['channel'] += 1
+                elif room.startswith('call:'):
+                    counts['call'] += 1
+                else:
+                    counts['room'] += 1
+            return counts
+
+        self.gauge('sockets', 'Открытые соединения Socket.IO', sockets)
+        self.gauge('rooms', 'Комнаты Socket.IO: channel - подписки, call - звонки, room - присутствие',
+                   rooms, ['kind'])
+
+
+def _timed(handler, histogram, event):
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def timed(*args):
+            started = time.perf_counter()
+            try:
+                return await handler(*args)
+            finally:
+                histogram.observe(time.perf_counter() - started, event)
+    else:
+        @functools.wraps(handler)
+        def timed(*args):
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                histogram.observe(time.perf_counter() - started, event)
+    return timed
+
+
+# Обработчики событий python-socketio (у Flask-SocketIO - socketio.server)
+# заменяются обёртками с замером. Звать после того, как все зарегистрированы.
+def instrument_events(server, histogram, namespace='/'):
+    handlers = server.handlers.get(namespace, {})
+    for event, handler in list(handlers.items()):
+        handlers[event] = _timed(handler, histogram, event)
+
+
+# Flask: метка маршрута - шаблон правила (/api/messages/<room>), не сам путь
+def instrument_flask(app, histogram):
+    from flask import request
+
+    @app.before_request
+    def start_timer():
+        request.environ['metrics.started'] = time.perf_counter()
+
+    @app.teardown_request
+    def stop_timer(exc):
+        started = request.environ.get('metrics.started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            histogram.observe(time.perf_counter() - started, request.method, route)
+
+
+# ASGI: маршрутизатор Starlette кладёт в scope endpoint найденного маршрута,
+# по нему и берётся шаблон пути
+class ASGIRouteMetrics:
+    def __init__(self, app, histogram, routes):
+        self.app = app
+        self.histogram = histogram
+        self.paths = {route.endpoint: route.path for route in routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = self.paths.get(scope.get('endpoint'), 'unmatched')
+            self.histogram.observe(time.perf_counter() - started, scope['method'], route)
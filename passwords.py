@@ -0,0 +1,122 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Хеширование паролей. scrypt с солью вместо одного sha256 без соли.
+# scrypt специально дорогой (десятки миллисекунд и ~16 МБ памяти на вызов),
+# поэтому считается не в потоке запроса, а в отдельном пуле с ограниченной
+# очередью: при переполнении запрос сразу получает отказ (HTTP 503),
+# а не копится вместе с трафиком чата. hashlib.scrypt отпускает GIL,
+# так что пул потоков действительно считает параллельно.
+#
+# Формат: scrypt$n$r$p$соль$хеш (соль и хеш - base64).
+# Старые хеши (64 hex-символа sha256) принимаются, и verify просит
+# перехешировать их - так же, как хеши со старыми параметрами scrypt.
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _scrypt(password, salt, n, r, p):
+    # Памяти нужно 128 * r * n байт, запас - на служебные буферы OpenSSL
+    maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=KEY_BYTES)
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = os.urandom(SALT_BYTES)
+    key = _scrypt(password, salt, n, r, p)
+    return f'scrypt${n}${r}${p}${_b64encode(salt)}${_b64encode(key)}'
+
+
+def is_legacy_hash(stored):
+    return not stored.startswith('scrypt$')
+
+
+# Возвращает (пароль верен, нужно ли перехешировать)
+def verify_password(password, stored, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    if is_legacy_hash(stored):
+        ok = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+        return ok, ok
+    try:
+        _, stored_n, stored_r, stored_p, salt, key = stored.split('$')
+        stored_n, stored_r, stored_p = int(stored_n), int(stored_r), int(stored_p)
+        salt = base64.b64decode(salt)
+        key = base64.b64decode(key)
+    except ValueError:
+        return False, False
+    ok = hmac.compare_digest(_scrypt(password, salt, stored_n, stored_r, stored_p), key)
+    return ok, ok and (stored_n, stored_r, stored_p) != (n, r, p)
+
+
+class PasswordHasher:
+    def __init__(self, workers=2, queue_size=32, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, timeout=30):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        # Одновременно в работе и в очереди - не больше workers + queue_size задач
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 2)),
+            queue_size=int(os.environ.get('PASSWORD_QUEUE', 32)),
+            n=int(os.environ.get('PASSWORD_SCRYPT_N', SCRYPT_N)),
+            r=int(os.environ.get('PASSWORD_SCRYPT_R', SCRYPT_R)),
+            p=int(os.environ.get('PASSWORD_SCRYPT_P', SCRYPT_P))
+        )
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash(self, password):
+        return self._submit(hash_password, password, self.n, self.r, self.p).result(self.timeout)
+
+    # Возвращает (пароль верен, новый хеш или None).
+    # Новый хеш считается в той же задаче, если старый устарел.
+    def verify(self, password, stored):
+        return self._submit(self._verify, password, stored).result(self.timeout)
+
+    # Для asyncio-сервера: цикл событий не ждёт scrypt
+    async def hash_async(self, password):
+        future = self._submit(hash_password, password, self.n, self.r, self.p)
+        return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    async def verify_async(self, password, stored):
+        future = self._submit(self._verify, password, stored)
+        return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+
+    def _verify(self, password, stored):
+        ok, needs_rehash = verify_password(password, stored, self.n, self.r, self.p)
+        if needs_rehash:
+            return True, hash_password(password, self.n, self.r, self.p)
+        return ok, None
+
+    def close(self):
+        self._pool.shutdown(wait=False)
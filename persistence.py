@@ -0,0 +1,322 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+from history import RoomStore, write_all
+from message import Message
+
+# Журнал событий + фоновая запись пачками (group commit).
+# Обработчики только кладут событие в очередь, а поток-писатель
+# раз в interval секунд дописывает накопившиеся события на диск:
+# сообщения - в сегменты своих комнат (history.py), остальное -
+# в журнал manifest.log, который периодически сворачивается в manifest.json.
+#
+# Раскладка каталога данных:
+#   manifest.json  - пользователи, номер последнего события
+#   manifest.log   - события после последнего сворачивания
+#   rooms/<room>/  - сегменты истории комнаты
+
+FSYNC_POLICIES = ('batch', 'interval', 'never')
+
+# Пачка, которую не удалось записать, повторяется с нарастающей паузой
+RETRY_DELAY = 0.1
+RETRY_MAX_DELAY = 5.0
+
+_STOP = object()
+
+logger = logging.getLogger(__name__)
+
+
+def empty_state():
+    return {
+        'users': {}
+    }
+
+
+# Онлайн-статус больше не сохраняется (он живёт в connections.py),
+# старые события online/offline в журнале просто пропускаются
+def apply_event(state, event):
+    if event['op'] == 'user':
+        state['users'][event['username']] = event['data']
+
+
+def _write_json(path, data, fsync=True):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class EventLog:
+    def __init__(self, data_dir, interval=0.05, fsync='batch', fsync_interval=1.0,
+                 compact_every=10000, max_batch=1000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Неизвестная политика fsync: {fsync}')
+        self.data_dir = data_dir
+        self.manifest_path = os.path.join(data_dir, 'manifest.json')
+        self.log_path = os.path.join(data_dir, 'manifest.log')
+        self.interval = interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.max_batch = max_batch
+
+        os.makedirs(data_dir, exist_ok=True)
+        self.rooms = RoomStore(os.path.join(data_dir, 'rooms'))
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._last_seq = 0
+        self._since_compact = 0
+        self._last_fsync = time.monotonic()
+        self._dirty_rooms = set()
+        self.error = None      # последняя ошибка записи; None - всё записано
+        self.on_commit = None  # on_commit(событий, секунд) - для метрик записи
+
+    # Загрузка: только манифест и короткий журнал, история комнат не читается
+    def load(self):
+        state, last_seq = self._read_manifest()
+        if not os.path.exists(self.manifest_path):
+            _write_json(self.manifest_path, dict(state, last_event=0), self.fsync != 'never')
+        for event in self._read_log():
+            if event['n'] > last_seq:
+                apply_event(state, event)
+                last_seq = event['n']
+                self._since_compact += 1
+        self._last_seq = last_seq
+        return state
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='persistence-writer', daemon=True)
+            self._thread.start()
+
+    def append(self, event):
+        self._queue.put(event)
+
+    # False, пока запись на диск не удаётся: события ждут повтора в памяти
+    @property
+    def healthy(self):
+        return self.error is None
+
+    # Дождаться, пока всё, что уже в очереди, окажется на диске.
+    # False - писатель не запущен или остановлен, истёк timeout
+    # или запись не удалась (события остались в очереди на повтор).
+    def flush(self, timeout=None):
+        if self._thread is None or not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout) and self.error is None
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        self.rooms.close()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return empty_state(), 0
+        state.pop('online_users', None)
+        return state, state.pop('last_event', 0)
+
+    def _read_log(self):
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после падения процесса
+                        break
+        except FileNotFoundError:
+            return
+
+    def _run(self):
+        log = None
+        pending = []  # события, которые не удалось записать, - повторяются первыми
+        delay = RETRY_DELAY
+        while True:
+            # После ошибки ждём delay, собирая всё новое, и повторяем пачку целиком
+            if pending:
+                batch, deadline = [], time.monotonic() + delay
+            else:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.interval
+            while (pending or len(batch) < self.max_batch) and not (batch and batch[-1] is _STOP):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stop = bool(batch) and batch[-1] is _STOP
+            waiters = [item for item in batch if isinstance(item, threading.Event)]
+            events = pending + [item for item in batch if isinstance(item, dict)]
+
+            # Ошибка диска (нет места, нет прав) не должна ни убивать писателя,
+            # ни терять пачку: сообщениям уже выданы seq, и клиенты их видели.
+            # Пока запись не удаётся, error не None и flush() возвращает False.
+            try:
+                if log is None:
+                    log = open(self.log_path, 'ab', buffering=0)
+                if events:
+                    started = time.perf_counter()
+                    self._commit(log, events)
+                    if self.on_commit is not None:
+                        self.on_commit(len(events), time.perf_counter() - started)
+            except Exception as e:
+                if self.error is None:
+                    logger.exception('Ошибка записи журнала, событий ждут повтора: %d', len(events))
+                    delay = RETRY_DELAY
+                else:
+                    delay = min(delay * 2, RETRY_MAX_DELAY)
+                self.error = e
+                pending = events
+            else:
+                if self.error is not None:
+                    logger.warning('Запись журнала восстановлена, записано событий: %d', len(events))
+                self.error = None
+                pending = []
+
+            if not pending and self.compact_every and self._since_compact >= self.compact_every:
+                try:
+                    log.close()
+                    log = None
+                    self.compact()
+                except Exception:
+                    # Журнал просто растёт дальше, сворачивание будет повторено
+                    logger.exception('Ошибка сворачивания журнала')
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                if pending:
+                    logger.error('Журнал не записан при остановке, потеряно событий: %d', len(pending))
+                break
+        if log is not None:
+            log.close()
+
+    # Номер n событию выдаётся один раз: при повторе пачки строка с тем же n
+    # может попасть в журнал дважды, и load() пропустит копию.
+    def _commit(self, log, events):
+        by_room = {}
+        lines = []
+        for event in events:
+            if event['op'] == 'message':
+                by_room.setdefault(event['room'], []).append(event['message'])
+                continue
+            if 'n' not in event:
+                self._last_seq += 1
+                event['n'] = self._last_seq
+            lines.append(json.dumps(event, ensure_ascii=False, separators=(',', ':')))
+
+        for room, messages in by_room.items():
+            room_log = self.rooms.log(room)
+            room_log.append(messages)
+            self._dirty_rooms.add(room_log)
+        if lines:
+            # Недописанная строка сломала бы чтение всего, что после неё
+            size = log.seek(0, os.SEEK_END)
+            try:
+                write_all(log, ('\n'.join(lines) + '\n').encode('utf-8'))
+            except BaseException:
+                log.truncate(size)
+                raise
+            self._since_compact += len(lines)
+
+        now = time.monotonic()
+        if self.fsync == 'batch' or (self.fsync == 'interval' and
+                                     now - self._last_fsync >= self.fsync_interval):
+            for room_log in self._dirty_rooms:
+                room_log.sync()
+            self._dirty_rooms.clear()
+            os.fsync(log.fileno())
+            self._last_fsync = now
+
+    # Сворачиваем журнал в новый манифест. Манифест запоминает номер последнего
+    # события, поэтому падение между заменой манифеста и очисткой журнала безопасно.
+    def compact(self):
+        state, last_seq = self._read_manifest()
+        for event in self._read_log():
+            if event['n'] > last_seq:
+                apply_event(state, event)
+                last_seq = event['n']
+        state['last_event'] = last_seq
+        _write_json(self.manifest_path, state, self.fsync != 'never')
+        open(self.log_path, 'w').close()
+        self._since_compact = 0
+
+
+# Старый формат: chat_data.json (+ chat_data.json.log с событиями поверх снимка)
+def load_legacy(json_path):
+    with open(json_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    last_seq = state.pop('last_event', 0)
+    state.setdefault('messages', {})
+    try:
+        with open(json_path + '.log', 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                if event['n'] <= last_seq:
+                    continue
+                if event['op'] == 'message':
+                    state['messages'].setdefault(event['room'], []).append(event['message'])
+                else:
+                    apply_event(state, event)
+    except FileNotFoundError:
+        pass
+    return state
+
+
+# Однократный перенос chat_data.json в каталог с манифестом и сегментами
+def migrate_json(json_path, data_dir):
+    manifest_path = os.path.join(data_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        raise FileExistsError(f'{manifest_path} уже существует')
+
+    state = load_legacy(json_path)
+    # Остатки прерванного переноса (манифеста ещё нет) начинаем заново
+    shutil.rmtree(os.path.join(data_dir, 'rooms'), ignore_errors=True)
+    os.makedirs(data_dir, exist_ok=True)
+    rooms = RoomStore(os.path.join(data_dir, 'rooms'))
+    try:
+        for room, messages in state['messages'].items():
+            room_log = rooms.log(room)
+            room_log.append([Message.from_dict(message) for message in messages])
+            room_log.sync()
+    finally:
+        rooms.close()
+
+    # Манифест пишем последним: его наличие означает, что перенос завершён
+    _write_json(manifest_path, {
+        'users': state.get('users', {}),
+        'last_event': 0
+    })
+    return {room: len(messages) for room, messages in state['messages'].items()}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'migrate':
+        print('Использование: python persistence.py migrate chat_data.json chat_data')
+        sys.exit(1)
+    counts = migrate_json(sys.argv[2], sys.argv[3])
+    for room, count in counts.items():
+        print(f'{room}: {count} сообщений')
@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+
+# Присутствие пользователей. Вместо полного списка online_users на каждое
+# подключение клиент получает один снимок, а дальше - только изменения
+# (joined/left), собранные за interval секунд. Пользователь, который
+# отключился и вернулся внутри одного окна, в рассылку не попадает вовсе.
+#
+# Каждая рассылка и каждый снимок получают версию - время в миллисекундах
+# (монотонно растущее внутри процесса), поэтому версии разных воркеров
+# сравнимы. Клиент отбрасывает изменения старше своего снимка. Снимок
+# собирается из реестра подключений: сначала stamp(), потом чтение.
+#
+# Изменения адресуются только тем, кто видит пользователя: комнатам,
+# где он присутствует, и сессиям из audience(username) (например,
+# участникам его групп). Без audience изменения рассылаются всем.
+# Кто в комнате, говорит room_audience(room) - реестр подключений;
+# без него изменения уходят в комнату Socket.IO с тем же именем.
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    def __init__(self, emit_delta, audience=None, room_audience=None, interval=0.25):
+        self.emit_delta = emit_delta        # emit_delta(payload, to), to=None - всем
+        self.audience = audience            # audience(username) -> список sid
+        self.room_audience = room_audience  # room_audience(room) -> список sid
+        self.interval = interval
+        self.version = 0
+        self._online = set()     # кто в сети сейчас
+        self._pending = {}       # username -> (статус до окна, статус сейчас)
+        self._rooms = {}         # username -> комнаты, где он виден
+        self._leaving = {}       # username -> комнаты, которым нужно сообщить об уходе
+        self._entered = {}       # room -> кто появился в комнате с последней рассылки
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='presence', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Вызывается на первой сессии пользователя (по всем воркерам)
+    def online(self, username):
+        with self._lock:
+            self._online.add(username)
+            self._change(username, True)
+            # Вернулся до рассылки ухода - остаётся в тех же комнатах
+            rooms = self._leaving.pop(username, None)
+            if rooms:
+                self._rooms.setdefault(username, set()).update(rooms)
+
+    # Вызывается на последней сессии пользователя
+    def offline(self, username):
+        with self._lock:
+            self._online.discard(username)
+            self._change(username, False)
+            rooms = self._rooms.pop(username, set())
+            for room in rooms:
+                entered = self._entered.get(room)
+                if entered is not None:
+                    entered.discard(username)
+            if rooms:
+                self._leaving.setdefault(username, set()).update(rooms)
+
+    def _change(self, username, online):
+        before = self._pending[username][0] if username in self._pending else not online
+        self._pending[username] = (before, online)
+
+    def enter_room(self, username, room):
+        with self._lock:
+            rooms = self._rooms.setdefault(username, set())
+            if room in rooms:
+                return
+            rooms.add(room)
+            self._entered.setdefault(room, set()).add(username)
+
+    def is_online(self, username):
+        return username in self._online
+
+    def stamp(self):
+        with self._lock:
+            return self._stamp()
+
+    def _stamp(self):
+        self.version = max(self.version + 1, int(time.time() * 1000))
+        return self.version
+
+    # Снимок всех онлайн этого процесса (один процесс без комнат - app.py)
+    def snapshot(self):
+        with self._lock:
+            return self._stamp(), sorted(self._online)
+
+    def flush(self):
+        with self._lock:
+            joined = set()
+            left = set()
+            for username, (before, online) in self._pending.items():
+                if online == before:
+                    continue
+                if online:
+                    joined.add(username)
+                else:
+                    left.add(username)
+            self._pending.clear()
+            leaving = {username: self._leaving[username] for username in left if username in self._leaving}
+            self._leaving.clear()
+            entered = self._entered
+            self._entered = {}
+            if not joined and not left and not entered:
+                return
+            version = self._stamp()
+
+            # Комнатам - одним emit на комнату; to=None - всем сразу
+            by_room = {}
+            if self.audience is None:
+                if joined or left:
+                    by_room[None] = (joined, left)
+            else:
+                for username in joined:
+                    for room in self._rooms.get(username, ()):
+                        by_room.setdefault(room, (set(), set()))[0].add(username)
+                for room, usernames in entered.items():
+                    by_room.setdefault(room, (set(), set()))[0].update(usernames)
+                for username, rooms in leaving.items():
+                    for room in rooms:
+                        by_room.setdefault(room, (set(), set()))[1].add(username)
+
+        # audience может ходить в хранилище - уже без блокировки
+        by_sid = {}
+        if self.audience is not None:
+            for index, usernames in enumerate((joined, left)):
+                for username in usernames:
+                    for sid in self.audience(username):
+                        by_sid.setdefault(sid, (set(), set()))[index].add(username)
+
+        # Сессиям с одинаковым набором изменений - один emit на всех
+        by_payload = {}
+        for sid, (sid_joined, sid_left) in by_sid.items():
+            key = (tuple(sorted(sid_joined)), tuple(sorted(sid_left)))
+            by_payload.setdefault(key, []).append(sid)
+
+        for room, (room_joined, room_left) in by_room.items():
+            to = room
+            if room is not None and self.room_audience is not None:
+                # Пустой список в emit - это рассылка всем
+                to = self.room_audience(room)
+                if not to:
+                    continue
+            self.emit_delta(self._payload(version, room_joined, room_left), to)
+        for (sid_joined, sid_left), sids in by_payload.items():
+            self.emit_delta(self._payload(version, sid_joined, sid_left), sids)
+
+    @staticmethod
+    def _payload(version, joined, left):
+        return {'version': version, 'joined': sorted(joined), 'left': sorted(left)}
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Ошибка рассылки присутствия')
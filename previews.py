@@ -0,0 +1,165 @@
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+# Превью загруженных файлов: уменьшенная картинка, кадр-обложка видео,
+# первая страница PDF. Считаются в фоне пулом потоков сразу после загрузки,
+# ответ на загрузку их не ждёт - в нём только preview_url, который клиент
+# кладёт в file_info сообщения. Комната с медиа грузит килобайты превью,
+# а не мегабайты оригиналов.
+#
+# Превью лежит рядом с блобом: uploads/.blobs/<aa>/<sha256>.preview.jpg,
+# одинаковые файлы делят одно превью. Инструменты необязательны:
+#   картинки - Pillow (pip install Pillow)
+#   видео    - ffmpeg в PATH
+#   PDF      - pdftoppm (poppler-utils) в PATH или PyMuPDF
+# Чего нет - для того типа превью не делается, и preview_url не выдаётся;
+# клиент показывает файл как раньше.
+
+PREVIEW_SIZE = 480
+PREVIEW_QUALITY = 80
+PREVIEW_SUFFIX = '.preview.jpg'
+TOOL_TIMEOUT = 30
+DIGEST = re.compile(r'[0-9a-f]{64}$')
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+VIDEO_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv'}
+PDF_EXTENSIONS = {'pdf'}
+
+logger = logging.getLogger(__name__)
+
+
+def _image_preview(source, target, size):
+    with Image.open(source) as image:
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        image.convert('RGB').save(target, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+
+
+def _video_preview(source, target, size):
+    # Кадр на первой секунде (заставки часто чёрные), у коротких роликов - первый.
+    # Ролик короче секунды - ошибка или пустой файл, тогда пробуем нулевую
+    for offset in ('1', '0'):
+        result = subprocess.run(
+            ['ffmpeg', '-v', 'error', '-y', '-ss', offset, '-i', source, '-frames:v', '1',
+             '-vf', f"scale='min({size},iw)':-2", '-f', 'image2', '-c:v', 'mjpeg', target],
+            stdin=subprocess.DEVNULL, capture_output=True, timeout=TOOL_TIMEOUT
+        )
+        if result.returncode == 0 and os.path.getsize(target):
+            return
+    raise RuntimeError(f'ffmpeg ({result.returncode}): {result.stderr.decode(errors="replace").strip()}')
+
+
+def _pdf_preview(source, target, size):
+    if shutil.which('pdftoppm'):
+        prefix = target[:-len('.jpg')]
+        subprocess.run(
+            ['pdftoppm', '-f', '1', '-l', '1', '-jpeg', '-scale-to', str(size), '-singlefile', source, prefix],
+            stdin=subprocess.DEVNULL, capture_output=True, timeout=TOOL_TIMEOUT, check=True
+        )
+        return
+    with fitz.open(source, filetype='pdf') as document:
+        page = document[0]
+        zoom = size / max(page.rect.width, page.rect.height)
+        page.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).save(target, output='jpeg')
+
+
+class PreviewPipeline:
+    def __init__(self, blobs, workers=2, size=PREVIEW_SIZE):
+        self.blobs = blobs
+        self.size = size
+        self.makers = {}
+        if Image is not None:
+            self.makers.update(dict.fromkeys(IMAGE_EXTENSIONS, _image_preview))
+        if shutil.which('ffmpeg'):
+            self.makers.update(dict.fromkeys(VIDEO_EXTENSIONS, _video_preview))
+        if shutil.which('pdftoppm') or fitz is not None:
+            self.makers.update(dict.fromkeys(PDF_EXTENSIONS, _pdf_preview))
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, blobs):
+        return cls(
+            blobs,
+            workers=int(os.environ.get('PREVIEW_WORKERS', 2)),
+            size=int(os.environ.get('PREVIEW_SIZE', PREVIEW_SIZE))
+        )
+
+    def path(self, digest):
+        return self.blobs.blob_path(digest) + PREVIEW_SUFFIX
+
+    # Вызывается BlobStore после сохранения файла: ставит превью в очередь
+    # и возвращает поля для ответа на загрузку
+    def on_store(self, digest, info):
+        maker = self.makers.get(info['extension'])
+        if maker is None:
+            return {}
+        self.submit(digest, maker)
+        return {'preview_url': f'/previews/{digest}.jpg'}
+
+    def submit(self, digest, maker):
+        with self._lock:
+            if digest in self._pending or os.path.exists(self.path(digest)):
+                return
+            future = self._pool.submit(self._make, digest, maker)
+            self._pending[digest] = future
+        future.add_done_callback(lambda _: self._done(digest))
+
+    def _done(self, digest):
+        with self._lock:
+            self._pending.pop(digest, None)
+
+    # Превью ещё считается - future, иначе None
+    def pending(self, digest):
+        with self._lock:
+            return self._pending.get(digest)
+
+    def _make(self, digest, maker):
+        target = self.path(digest)
+        fd, tmp_path = tempfile.mkstemp(suffix='.jpg', dir=self.blobs.tmp_dir)
+        os.close(fd)
+        try:
+            maker(self.blobs.blob_path(digest), tmp_path, self.size)
+            if os.path.getsize(tmp_path):
+                os.replace(tmp_path, target)
+        except Exception as e:
+            # Битый файл или сбой инструмента - просто без превью
+            logger.warning('Превью %s не получилось: %s', digest[:12], e)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Путь к готовому превью или None; если оно в работе - ждём до timeout
+    def resolve(self, name, timeout=5):
+        digest = name[:-len('.jpg')] if name.endswith('.jpg') else ''
+        if not DIGEST.match(digest):
+            return None
+        future = self.pending(digest)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except Exception:
+                pass
+        path = self.path(digest)
+        return (path, f'"{digest}-preview"') if os.path.exists(path) else None
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,81 @@
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Профиль по выборкам для /api/admin/profile. Пока открыто окно, поток,
+# вызвавший run(), раз в interval секунд снимает стеки всех остальных
+# потоков (sys._current_frames) и считает одинаковые; вне окна профилировщик
+# ничего не стоит. Время настенное: ждущие потоки (очереди, сокеты) тоже
+# попадают в профиль - их стеки заканчиваются в wait/select.
+#
+# Результат - свёрнутые стеки, по строке на стек:
+#   <поток>;<файл>:<функция>;... <число выборок>
+# формат flamegraph.pl и speedscope.
+#
+# Доступ - только с токеном, равным ADMIN_TOKEN из настроек приложения;
+# без ADMIN_TOKEN админские эндпоинты (и /metrics) выключены.
+
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def admin_allowed(presented, token):
+    return bool(token) and presented is not None and hmac.compare_digest(presented.encode(), token.encode())
+
+
+# Токен из X-Admin-Token или Authorization: Bearer (так его шлёт Prometheus)
+def admin_token(headers):
+    token = headers.get('X-Admin-Token')
+    if token is None:
+        scheme, _, value = (headers.get('Authorization') or '').partition(' ')
+        if scheme.lower() == 'bearer':
+            token = value
+    return token
+
+
+def _stack(thread, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    frames.append(thread)
+    return ';'.join(reversed(frames))
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._busy = threading.Lock()
+
+    # Снимать выборки seconds секунд. -> (Counter стек -> выборки, число проходов)
+    def run(self, seconds, interval=None):
+        if not self._busy.acquire(blocking=False):
+            raise ProfilerBusy()
+        try:
+            interval = interval or self.interval
+            me = threading.get_ident()
+            stacks = Counter()
+            passes = 0
+            deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        stacks[_stack(names.get(ident, str(ident)), frame)] += 1
+                passes += 1
+                time.sleep(interval)
+            return stacks, passes
+        finally:
+            self._busy.release()
+
+
+def folded(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
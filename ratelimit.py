@@ -0,0 +1,115 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+
+# Ограничение частоты событий от одного соединения. На каждую пару
+# (sid, событие) - маркерная корзина: вмещает burst маркеров и пополняется
+# со скоростью rate в секунду, событие забирает один маркер. Нет маркера -
+# событие отбрасывается, обработчик не вызывается. Так одна вкладка не может
+# залить комнату сообщениями или сервер - ICE-кандидатами.
+#
+# Лимиты - RATE_LIMITS: "событие=rate/burst,..."; события без лимита
+# проходят как есть, пустая строка выключает ограничение.
+
+RATE_LIMITS = 'send_message=5/20,typing=5/10,join_room=10/30,start_call=1/5,webrtc_ice_candidate=20/100,sync=1/10'
+
+
+def parse_limits(text):
+    limits = {}
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        event, _, spec = part.partition('=')
+        rate, _, burst = spec.partition('/')
+        limits[event.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+class RateLimiter:
+    def __init__(self, limits, clock=time.monotonic):
+        self.limits = dict(limits)  # событие -> (rate в секунду, burst)
+        self.clock = clock
+        self._buckets = {}  # (sid, событие) -> [маркеры, время пополнения]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        return cls(parse_limits(environ.get('RATE_LIMITS', RATE_LIMITS)))
+
+    def allow(self, sid, event):
+        limit = self.limits.get(event)
+        if limit is None:
+            return True
+        rate, burst = limit
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get((sid, event))
+            if bucket is None:
+                bucket = self._buckets[(sid, event)] = [burst, now]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+    # Соединение закрыто - его корзины больше не нужны
+    def drop(self, sid):
+        with self._lock:
+            for event in self.limits:
+                self._buckets.pop((sid, event), None)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _limited(handler, server, limiter, event, on_limited, notify, namespace):
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def limited(sid, *args):
+            if limiter.allow(sid, event):
+                return await handler(sid, *args)
+            if on_limited is not None:
+                on_limited(sid, event)
+            if event in notify:
+                await server.emit('rate_limited', {'event': event}, to=sid, namespace=namespace)
+    else:
+        @functools.wraps(handler)
+        def limited(sid, *args):
+            if limiter.allow(sid, event):
+                return handler(sid, *args)
+            if on_limited is not None:
+                on_limited(sid, event)
+            if event in notify:
+                server.emit('rate_limited', {'event': event}, to=sid, namespace=namespace)
+    return limited
+
+
+def _dropping(handler, limiter):
+    if asyncio.iscoroutinefunction(handler):
+        @functools.wraps(handler)
+        async def dropping(sid, *args):
+            limiter.drop(sid)
+            return await handler(sid, *args)
+    else:
+        @functools.wraps(handler)
+        def dropping(sid, *args):
+            limiter.drop(sid)
+            return handler(sid, *args)
+    return dropping
+
+
+# Обработчики python-socketio (у Flask-SocketIO - socketio.server) с лимитом
+# заменяются обёртками; on_limited(sid, event) - для метрик. Отправителю
+# событий из notify отвечаем rate_limited, чтобы сообщение не пропало молча.
+# Звать после того, как все обработчики зарегистрированы.
+def limit_events(server, limiter, on_limited=None, notify=('send_message',), namespace='/'):
+    handlers = server.handlers.get(namespace, {})
+    for event, handler in list(handlers.items()):
+        if event in limiter.limits:
+            handlers[event] = _limited(handler, server, limiter, event, on_limited, notify, namespace)
+    if 'disconnect' in handlers:
+        handlers['disconnect'] = _dropping(handlers['disconnect'], limiter)
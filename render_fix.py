@@ -3,14 +3,24 @@ from flask import Flask, request, jsonify, send_from_directory, send_file
 from flask_socketio import SocketIO, emit, join_room
 from datetime import datetime
 import hashlib
+import logging
 import uuid
 
+import logs
+from ratelimit import RateLimiter, limit_events
+from subscriptions import Subscriptions, channel
+
+logs.setup()
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'noknowgram-secret')
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
 
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# Сообщения - только вкладкам, открывшим комнату (subscriptions.py)
+subscriptions = Subscriptions(socketio.server)
 
 # Создаем папку для загрузок
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -49,11 +59,22 @@ def serve_upload(filename):
 # WebSocket события
 @socketio.on('connect')
 def handle_connect():
-    print("Client connected")
+    logger.debug('Client connected: %s', request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    subscriptions.drop(request.sid)
+
+@socketio.on('join_room')
+def handle_join_room(data):
+    subscriptions.switch(request.sid, data.get('room', 'general'))
 
 @socketio.on('send_message')
 def handle_message(data):
-    emit('new_message', data, broadcast=True)
+    emit('new_message', data, room=channel(data.get('room', 'general')))
+
+# Лимиты частоты событий от одного соединения (ratelimit.py, RATE_LIMITS)
+limit_events(socketio.server, RateLimiter.from_env())
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
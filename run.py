@@ -0,0 +1,41 @@
+import os
+import importlib
+
+# Единая точка запуска. Режим и число процессов - из окружения:
+#   SERVER_MODE=threading  - Flask-SocketIO на Werkzeug, поток ОС на каждое
+#                            соединение; для разработки. SERVER_APP выбирает
+#                            модуль: server (по умолчанию), app или render_fix.
+#   SERVER_MODE=asgi       - asgi.py (AsyncServer) под uvicorn, соединения -
+#                            корутины; для продакшена.
+#   WORKERS                - число процессов uvicorn; больше одного - только
+#                            вместе с MESSAGE_QUEUE (sqlite:///... или redis://...),
+#                            через неё события доходят до клиентов других воркеров.
+#   HOST, PORT             - адрес.
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threading')
+SERVER_APP = os.environ.get('SERVER_APP', 'server')
+WORKERS = int(os.environ.get('WORKERS', 1))
+HOST = os.environ.get('HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', 10000))
+
+
+def main():
+    workers = WORKERS
+    if workers > 1 and (SERVER_MODE != 'asgi' or not os.environ.get('MESSAGE_QUEUE')):
+        # Без общей очереди состояние соединений и рассылки живут в памяти процесса
+        print('⚠️  WORKERS > 1 требует SERVER_MODE=asgi и MESSAGE_QUEUE, запускаю 1')
+        workers = 1
+
+    print(f"🚀 NoknowGram: режим {SERVER_MODE}, процессов: {workers}, порт: {PORT}")
+    if SERVER_MODE == 'asgi':
+        import uvicorn
+        uvicorn.run('asgi:app', host=HOST, port=PORT, workers=workers, log_level='warning')
+    elif SERVER_MODE == 'threading':
+        module = importlib.import_module(SERVER_APP)
+        module.socketio.run(module.app, host=HOST, port=PORT, debug=False, allow_unsafe_werkzeug=True)
+    else:
+        raise SystemExit(f'Неизвестный SERVER_MODE: {SERVER_MODE} (threading или asgi)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import json
+import re
+
+# Полнотекстовый поиск по истории: инвертированный индекс SQLite FTS5.
+# Сообщение попадает в индекс сразу при добавлении (в той же транзакции,
+# что и запись в SQLiteStorage), срок хранения удаляет его из индекса
+# вместе с историей (trim). Запрос - слова через пробел, все должны
+# встретиться; каждое слово ищется и как префикс ("кот" найдёт "котёнок",
+# что заодно покрывает русские окончания). Сортировка - bm25 или по новизне.
+#
+# Регистр и ё: текст и запрос приводятся casefold() и ё -> е здесь, а не
+# токенизатором - remove_diacritics в unicode61 превращает й в и.
+#
+# search_docs связывает документ индекса с (room, seq); сами сообщения
+# читаются из хранилища. Индекс лежит в той же базе, что и история
+# (SQLiteStorage), или в своём файле рядом с ней (app.py, MemoryStorage).
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS search_docs (
+    doc INTEGER PRIMARY KEY,
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    UNIQUE (room, seq)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    body,
+    tokenize = 'unicode61 remove_diacritics 0',
+    prefix = '2 3'
+);
+'''
+
+SQL_INSERT_DOC = 'INSERT OR IGNORE INTO search_docs (room, seq) VALUES (?, ?)'
+SQL_INSERT_FTS = 'INSERT INTO search_fts (rowid, body) VALUES (?, ?)'
+SQL_LAST_SEQ = 'SELECT MAX(seq) FROM search_docs WHERE room = ?'
+SQL_TRIM_FTS = 'DELETE FROM search_fts WHERE rowid IN (SELECT doc FROM search_docs WHERE room = ? AND seq < ?)'
+SQL_TRIM_DOCS = 'DELETE FROM search_docs WHERE room = ? AND seq < ?'
+SQL_SEARCH = '''SELECT d.room, d.seq FROM search_fts f JOIN search_docs d ON d.doc = f.rowid
+    WHERE search_fts MATCH ? {rooms} ORDER BY {order} LIMIT ? OFFSET ?'''
+SQL_IN_ROOMS = 'AND d.room IN (SELECT value FROM json_each(?))'
+ORDERS = {
+    'rank': 'f.rank, f.rowid DESC',
+    'recent': 'f.rowid DESC'
+}
+
+# Буквы и цифры любых алфавитов; _ - разделитель, как в unicode61
+TOKEN = re.compile(r'[^\W_]+')
+MAX_QUERY_TERMS = 8
+# Однобуквенные слова префиксом не ищем - это почти весь индекс
+MIN_PREFIX = 2
+
+
+def normalize(text):
+    return (text or '').casefold().replace('ё', 'е')
+
+
+def tokenize(text):
+    return TOKEN.findall(normalize(text))
+
+
+# Строка запроса -> выражение MATCH или None, если искать нечего.
+# Слова в кавычках: операторы FTS5 (AND, NEAR, -) из ввода не проходят.
+def match_expression(query):
+    terms = tokenize(query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' if len(term) >= MIN_PREFIX else f'"{term}"' for term in terms)
+
+
+class SearchIndex:
+    # connections - storage.SQLiteConnections: общие с SQLiteStorage (индекс
+    # в той же базе) или свои на отдельный файл, тогда owned=True
+    def __init__(self, connections, owned=False):
+        self._connections = connections
+        self._owned = owned
+        self._db = connections.get
+        self._db().executescript(SCHEMA)
+
+    # conn - соединение, в транзакции которого пишется само сообщение
+    def add(self, room, seq, text, conn=None):
+        body = normalize(text)
+        if not body:
+            return
+        conn = conn or self._db()
+        cursor = conn.execute(SQL_INSERT_DOC, (room, seq))
+        if cursor.rowcount:
+            conn.execute(SQL_INSERT_FTS, (cursor.lastrowid, body))
+
+    # Доиндексация при старте: entries - пары (seq, text) одной комнаты
+    def add_many(self, room, entries):
+        conn = self._db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for seq, text in entries:
+                self.add(room, seq, text, conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    # Последний проиндексированный seq комнаты (0 - ничего)
+    def last_seq(self, room):
+        return self._db().execute(SQL_LAST_SEQ, (room,)).fetchone()[0] or 0
+
+    # Убрать из индекса сообщения комнаты с seq < first_seq
+    def trim(self, room, first_seq, conn=None):
+        conn = conn or self._db()
+        conn.execute(SQL_TRIM_FTS, (room, first_seq))
+        conn.execute(SQL_TRIM_DOCS, (room, first_seq))
+
+    # rooms - где искать (None - везде).
+    # -> ([(room, seq)], next_cursor или None); курсор - смещение в выдаче
+    def search(self, query, rooms=None, limit=20, cursor=0, order='rank'):
+        match = match_expression(query)
+        if match is None or (rooms is not None and not rooms):
+            return [], None
+        order = ORDERS.get(order, ORDERS['rank'])
+        if rooms is None:
+            sql, params = SQL_SEARCH.format(rooms='', order=order), (match,)
+        else:
+            sql, params = SQL_SEARCH.format(rooms=SQL_IN_ROOMS, order=order), (match, json.dumps(sorted(rooms)))
+        rows = self._db().execute(sql, params + (limit + 1, cursor)).fetchall()
+        more = len(rows) > limit
+        hits = [(row['room'], row['seq']) for row in rows[:limit]]
+        return hits, cursor + limit if more else None
+
+    def close(self):
+        if self._owned:
+            self._connections.close()
@@ -1,25 +1,187 @@
 import os
-from flask import Flask, request, jsonify, send_from_directory, send_file
-from flask_socketio import SocketIO, emit, join_room
+from flask import Flask, Response, request, jsonify, abort
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from datetime import datetime
-import hashlib
 import uuid
-import json
+import atexit
+import logging
+import mimetypes
+import logs
+from storage import create_storage
+from connections import ConnectionRegistry, SQLiteConnectionRegistry
+from calls import CallRegistry, SQLiteCallRegistry, ENDED
+from broker import client_manager
+from typing_indicators import TypingAggregator
+from presence import PresenceTracker
+from fanout import MessageOutbox
+from subscriptions import Subscriptions, channel
+from message import Message
+from passwords import PasswordHasher, HasherBusy
+from history import Retention, RetentionCompactor
+from static_assets import StaticAssets
+from file_responses import FileCache, prepare, wsgi_response
+from previews import PreviewPipeline
+from uploads import BlobStore, ChunkedUploads, UploadError, BLOCK_SIZE
+from metrics import CONTENT_TYPE, ServerMetrics, instrument_events, instrument_flask
+from profiler import MAX_PROFILE_SECONDS, ProfilerBusy, SamplingProfiler, admin_allowed, admin_token, folded
+from ratelimit import RateLimiter, limit_events
+from catchup import catch_up
+from backpressure import Backpressure
+
+logs.setup()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'noknowgram-simple-secret'
 app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'sqlite')
+app.config['DATABASE_PATH'] = os.environ.get('DATABASE_PATH', 'noknowgram.db')
+app.config['HISTORY_HOT_MESSAGES'] = int(os.environ.get('HISTORY_HOT_MESSAGES', 500))
+app.config['RETENTION'] = Retention.from_env()
+app.config['ROOM_RETENTION'] = {}  # room -> Retention, вместо общей политики
+app.config['RETENTION_INTERVAL'] = float(os.environ.get('RETENTION_INTERVAL', 300))
+app.config['UPLOAD_GC_INTERVAL'] = float(os.environ.get('UPLOAD_GC_INTERVAL', 3600))
+app.config['TYPING_INTERVAL'] = int(os.environ.get('TYPING_INTERVAL_MS', 300)) / 1000
+app.config['PRESENCE_INTERVAL'] = int(os.environ.get('PRESENCE_INTERVAL_MS', 250)) / 1000
+app.config['CALL_RING_TIMEOUT'] = float(os.environ.get('CALL_RING_TIMEOUT', 45))
+# Сообщения пачками new_messages вместо new_message на каждое (fanout.py)
+app.config['MESSAGE_BATCHING'] = os.environ.get('MESSAGE_BATCHING', '0') == '1'
+app.config['BATCH_INTERVAL'] = int(os.environ.get('BATCH_INTERVAL_MS', 5)) / 1000
+app.config['BATCH_MAX'] = int(os.environ.get('BATCH_MAX', 100))
+# Очередь для нескольких воркеров: sqlite:///путь (один хост) или redis://...
+app.config['MESSAGE_QUEUE'] = os.environ.get('MESSAGE_QUEUE')
+# Токен для /api/admin/* и /metrics (заголовок X-Admin-Token); без него они выключены
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+
+if app.config['MESSAGE_QUEUE'] and app.config['STORAGE_BACKEND'] != 'sqlite':
+    raise SystemExit('MESSAGE_QUEUE требует STORAGE_BACKEND=sqlite: история и группы должны быть общими')
+
+socketio = SocketIO(app, cors_allowed_origins="*", client_manager=client_manager(app.config['MESSAGE_QUEUE']))
+# Сообщения и typing - только вкладкам, открывшим комнату (subscriptions.py)
+subscriptions = Subscriptions(socketio.server)
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Метрики для /metrics (metrics.py): задержки событий и маршрутов, рассылка, запись
+metrics = ServerMetrics()
+socketio.server.manager.on_emit = metrics.on_emit
+instrument_flask(app, metrics.routes)
+profiler = SamplingProfiler()
+
+# Лимиты частоты событий от одного соединения (ratelimit.py, RATE_LIMITS)
+rate_limiter = RateLimiter.from_env()
+# Медленные получатели: typing и присутствие откладываются, переполненный сокет отключается (backpressure.py)
+backpressure = Backpressure.from_env(socketio.server, socketio.server.manager.deliver)
+backpressure.on_drop = metrics.on_drop
+socketio.server.manager.backpressure = backpressure
+backpressure.start()
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# База данных в памяти
-users_db = {}
-messages_db = {}
-online_users = {}  # username -> {sid, ...}
-groups_db = {}
-user_groups = {}
+# Пользователи, группы и сообщения - в хранилище (storage.py)
+storage = create_storage(
+    app.config['STORAGE_BACKEND'],
+    app.config['DATABASE_PATH'],
+    hot_size=app.config['HISTORY_HOT_MESSAGES']
+)
+atexit.register(storage.close)
+
+# scrypt считается в отдельном пуле с ограниченной очередью (PASSWORD_* в окружении)
+passwords = PasswordHasher.from_env()
+atexit.register(passwords.close)
+
+def retention_for(room):
+    return app.config['ROOM_RETENTION'].get(room, app.config['RETENTION'])
+
+# Незавершённые загрузки по частям; брошенные удаляются раз в UPLOAD_GC_INTERVAL
+blobs = BlobStore(app.config['UPLOAD_FOLDER'])
+atexit.register(blobs.close)
+
+# Сообщения удаляются по срокам хранения вместе со ссылками на их файлы
+retention = RetentionCompactor(lambda: storage.enforce_retention(retention_for, blobs.release_files),
+                               app.config['RETENTION_INTERVAL'])
+retention.start()
+# Превью картинок, видео и PDF считаются в фоне после загрузки (previews.py)
+previews = PreviewPipeline.from_env(blobs)
+blobs.on_store = previews.on_store
+atexit.register(previews.close)
+upload_cache = FileCache.from_env()
+static_assets = StaticAssets(app.root_path)
+uploads = ChunkedUploads.from_env(app.config['UPLOAD_FOLDER'], blobs)
+upload_gc = RetentionCompactor(uploads.collect, app.config['UPLOAD_GC_INTERVAL'])
+upload_gc.start()
+
+# Индикаторы набора: один список печатающих на комнату не чаще раза в TYPING_INTERVAL.
+# Каждый воркер знает только своих печатающих - клиент объединяет списки по source.
+typing_state = TypingAggregator(
+    lambda room, users: socketio.emit('typing_set', {'room': room, 'users': users, 'source': os.getpid()}, to=channel(room)),
+    interval=app.config['TYPING_INTERVAL']
+)
+typing_state.start()
+
+if app.config['MESSAGE_BATCHING']:
+    outbox = MessageOutbox(
+        lambda room, messages: socketio.emit('new_messages', {'room': room, 'messages': messages}, to=channel(room)),
+        interval=app.config['BATCH_INTERVAL'],
+        max_batch=app.config['BATCH_MAX']
+    )
+    outbox.start()
+    atexit.register(outbox.stop)
+else:
+    outbox = None
+
+# sid <-> username, несколько вкладок на пользователя; с MESSAGE_QUEUE - общий для воркеров
+if app.config['MESSAGE_QUEUE']:
+    connections = SQLiteConnectionRegistry(app.config['DATABASE_PATH'])
+else:
+    connections = ConnectionRegistry()
+atexit.register(connections.close)
+
+# Сессии звонков (calls.py): каждому звонку - своя комната call:<call_id>
+if app.config['MESSAGE_QUEUE']:
+    calls = SQLiteCallRegistry(app.config['DATABASE_PATH'], ring_timeout=app.config['CALL_RING_TIMEOUT'])
+else:
+    calls = CallRegistry(ring_timeout=app.config['CALL_RING_TIMEOUT'])
+atexit.register(calls.close)
+
+# Звонок завершён: сообщаем участникам разговора и тем, у кого он ещё звонит
+def finish_call(session, event='call_ended', payload=None, skip_sid=None):
+    audience = [session.room] + [sid for user in session.invitees for sid in connections.sessions(user)]
+    socketio.emit(event, dict(payload or {}, call_id=session.call_id), to=audience, skip_sid=skip_sid)
+    socketio.close_room(session.room)
+
+# Неотвеченные звонки снимаются раз в несколько секунд
+call_reaper = RetentionCompactor(
+    lambda: [finish_call(session, payload={'ended_by': None}) for session in calls.reap()],
+    min(5.0, app.config['CALL_RING_TIMEOUT'])
+)
+call_reaper.start()
+
+# Кроме общих комнат, об изменениях статуса узнают участники общих групп
+def presence_audience(username):
+    members = {member for group in storage.get_user_groups(username) for member in group['members']}
+    members.discard(username)
+    return [sid for member in members for sid in connections.sessions(member)]
+
+# Присутствие: снимок при входе, дальше - пачки joined/left раз в PRESENCE_INTERVAL
+presence = PresenceTracker(
+    lambda payload, to: socketio.emit('presence_delta', payload, to=to),
+    audience=presence_audience,
+    room_audience=connections.room_sessions,
+    interval=app.config['PRESENCE_INTERVAL']
+)
+presence.start()
+
+metrics.socket_gauges(socketio.server)
+metrics.gauge('users_online', 'Пользователи онлайн', lambda: len(connections.users()))
+metrics.gauge('subscriptions', 'Вкладки, подписанные на комнату', lambda: len(subscriptions))
+metrics.gauge('calls', 'Звонки: ждут ответа или идут', lambda: len(calls))
+metrics.gauge('parked_sockets', 'Сокеты с отложенными событиями', lambda: len(backpressure))
+# Без разбивки по комнатам: имена комнат (private_<a>_<b>) выдают, кто с кем
+# переписывается, а число рядов росло бы с числом пар пользователей
+metrics.gauge('stored_messages', 'Сообщения в истории всех комнат', lambda: sum(storage.room_sizes().values()))
+metrics.gauge('history_rooms', 'Комнаты с историей', lambda: len(storage.rooms()))
+
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_RESULTS = 100
 
 # Глобальные чаты
 DEFAULT_ROOMS = {
@@ -28,18 +190,59 @@ DEFAULT_ROOMS = {
     'help': '❓ Помощь'
 }
 
-# Инициализация глобальных чатов
-for room_id in DEFAULT_ROOMS:
-    if room_id not in messages_db:
-        messages_db[room_id] = []
+# Статика - только файлы из списка, из памяти, сжатая (static_assets.py)
+def static_response(name):
+    found = static_assets.respond(name, request.headers.get)
+    if found is None:
+        abort(404)
+    status, headers, body = found
+    return Response(body, status=status, headers=headers)
 
 @app.route('/')
 def serve_index():
-    return send_file('index.html')
+    return static_response('index.html')
 
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('.', path)
+    return static_response(path)
+
+# Админские маршруты и /metrics: без ADMIN_TOKEN их нет, с чужим токеном - 403
+def admin_error():
+    if not app.config['ADMIN_TOKEN']:
+        abort(404)
+    if not admin_allowed(admin_token(request.headers), app.config['ADMIN_TOKEN']):
+        return jsonify({'success': False, 'message': 'Нет доступа'}), 403
+    return None
+
+@app.route('/metrics')
+def serve_metrics():
+    error = admin_error()
+    if error is not None:
+        return error
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+# Профиль по выборкам за seconds секунд (profiler.py) - свёрнутые стеки текстом
+@app.route('/api/admin/profile', methods=['POST'])
+def admin_profile():
+    error = admin_error()
+    if error is not None:
+        return error
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), MAX_PROFILE_SECONDS)
+    interval_ms = request.args.get('interval_ms', type=float)
+    stacks, passes = profiler.run(seconds, interval_ms / 1000 if interval_ms else None)
+    return Response(folded(stacks), content_type='text/plain; charset=utf-8',
+                    headers={'X-Profile-Samples': str(passes)})
+
+@app.errorhandler(ProfilerBusy)
+def profiler_busy(e):
+    return jsonify({'success': False, 'message': 'Профиль уже снимается'}), 409
+
+# Пул хеширования паролей переполнен - просим повторить позже
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    response = jsonify({'success': False, 'message': 'Сервер перегружен, попробуйте позже'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 # API для регистрации/входа
 @app.route('/api/register', methods=['POST'])
@@ -51,13 +254,11 @@ def register():
     if not username or not password:
         return jsonify({'success': False, 'message': 'Заполните все поля'})
     
-    if username in users_db:
+    if storage.get_user(username):
         return jsonify({'success': False, 'message': 'Пользователь уже существует'})
     
-    users_db[username] = {
-        'password_hash': hashlib.sha256(password.encode()).hexdigest(),
-        'created_at': datetime.now().isoformat()
-    }
+    if not storage.create_user(username, passwords.hash(password), datetime.now().isoformat()):
+        return jsonify({'success': False, 'message': 'Пользователь уже существует'})
     
     return jsonify({'success': True, 'message': 'Пользователь создан'})
 
@@ -70,17 +271,53 @@ def login():
     if not username or not password:
         return jsonify({'success': False, 'message': 'Заполните все поля'})
     
-    user = users_db.get(username)
-    if user and user['password_hash'] == hashlib.sha256(password.encode()).hexdigest():
-        return jsonify({'success': True, 'message': 'Успешный вход'})
+    user = storage.get_user(username)
+    if user:
+        ok, new_hash = passwords.verify(password, user['password_hash'])
+        if new_hash:
+            # Старый sha256 или прежние параметры scrypt - заменяем при входе
+            storage.set_password_hash(username, new_hash)
+        if ok:
+            return jsonify({'success': True, 'message': 'Успешный вход'})
     
     return jsonify({'success': False, 'message': 'Неверный логин или пароль'})
 
-# API для получения сообщений
+# API для получения сообщений (постранично, курсоры - номера seq)
 @app.route('/api/messages/<room>')
 def get_messages(room):
-    messages = messages_db.get(room, [])
-    return jsonify({'messages': messages[-100:]})  # Последние 100 сообщений
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), MAX_PAGE_SIZE)
+    messages, next_cursor = storage.get_messages(room, before=before, after=after, limit=limit)
+    return jsonify({'messages': [message.to_dict(room) for message in messages], 'next_cursor': next_cursor})
+
+# Комнаты, чью историю видит пользователь: общие, его группы и личные
+# чаты private_<a>_<b> (имена отсортированы)
+def search_rooms(username):
+    rooms = set(DEFAULT_ROOMS)
+    rooms.update(group['id'] for group in storage.get_user_groups(username))
+    for room in storage.rooms():
+        names = room[len('private_'):]
+        if room.startswith('private_') and (names.startswith(username + '_') or names.endswith('_' + username)):
+            rooms.add(room)
+    return rooms
+
+# Поиск по истории (search.py): q - слова, каждое ищется и как префикс;
+# room - искать в одной комнате; order=rank|recent; cursor - из next_cursor
+@app.route('/api/search')
+def search_messages():
+    username = request.args.get('username', '')
+    rooms = search_rooms(username)
+    room = request.args.get('room')
+    if room is not None:
+        if room not in rooms:
+            return jsonify({'success': False, 'message': 'Нет доступа к комнате'}), 403
+        rooms = {room}
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_SEARCH_RESULTS)
+    cursor = max(request.args.get('cursor', 0, type=int), 0)
+    found, next_cursor = storage.search(request.args.get('q', ''), rooms, limit=limit, cursor=cursor,
+                                        order=request.args.get('order', 'rank'))
+    return jsonify({'results': [message.to_dict(room) for room, message in found], 'next_cursor': next_cursor})
 
 # API для групп
 @app.route('/api/groups/create', methods=['POST'])
@@ -94,30 +331,19 @@ def create_group():
         return jsonify({'success': False, 'message': 'Неверные данные'})
     
     group_id = f"group_{uuid.uuid4().hex[:8]}"
-    groups_db[group_id] = {
+    group = storage.create_group({
         'id': group_id,
         'name': group_name,
         'creator': creator,
         'members': list(set([creator] + members)),
         'created_at': datetime.now().isoformat()
-    }
-    
-    # Создаем комнату для группы
-    messages_db[group_id] = []
-    
-    # Добавляем группу пользователям
-    for member in groups_db[group_id]['members']:
-        if member not in user_groups:
-            user_groups[member] = []
-        user_groups[member].append(group_id)
+    })
     
-    return jsonify({'success': True, 'group': groups_db[group_id]})
+    return jsonify({'success': True, 'group': group})
 
 @app.route('/api/groups/<username>')
 def get_user_groups(username):
-    user_groups_list = user_groups.get(username, [])
-    groups_data = [groups_db[group_id] for group_id in user_groups_list if group_id in groups_db]
-    return jsonify({'groups': groups_data})
+    return jsonify({'groups': storage.get_user_groups(username)})
 
 # Загрузка файлов
 @app.route('/api/upload', methods=['POST'])
@@ -129,108 +355,155 @@ def upload_file():
     if file.filename == '':
         return jsonify({'success': False, 'message': 'Файл не выбран'})
     
-    # Определяем тип файла
-    original_name = file.filename
-    file_ext = original_name.rsplit('.', 1)[1].lower() if '.' in original_name else ''
-    
-    file_types = {
-        'images': {'png', 'jpg', 'jpeg', 'gif', 'webp'},
-        'videos': {'mp4', 'avi', 'mov', 'mkv'},
-        'audio': {'mp3', 'wav', 'ogg'},
-        'documents': {'pdf', 'doc', 'docx', 'txt'},
-        'archives': {'zip', 'rar', '7z'}
-    }
-    
-    file_type = 'other'
-    for type_name, extensions in file_types.items():
-        if file_ext in extensions:
-            file_type = type_name
-            break
-    
-    filename = f"{uuid.uuid4().hex}.{file_ext}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
-    
-    file_size = os.path.getsize(filepath)
-    
-    return jsonify({
-        'success': True,
-        'filename': filename,
-        'original_name': original_name,
-        'url': f'/uploads/{filename}',
-        'type': file_type,
-        'size': file_size,
-        'extension': file_ext
-    })
+    # Хеш считается по ходу записи, одинаковое содержимое хранится один раз
+    writer = blobs.writer()
+    try:
+        for block in iter(lambda: file.stream.read(BLOCK_SIZE), b''):
+            writer.write(block)
+        info = writer.commit(file.filename)
+    finally:
+        writer.close()
+    return jsonify(info)
 
+# Загрузка по частям с докачкой (uploads.py)
+@app.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({'success': False, 'message': e.message}), e.status
+
+@app.route('/api/uploads', methods=['POST'])
+def upload_init():
+    data = request.get_json() or {}
+    return jsonify(uploads.init(data.get('name'), data.get('size'), data.get('sha256')))
+
+# Тело - сырые байты диапазона из Content-Range, пишутся на диск блоками
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def upload_range(upload_id):
+    writer = uploads.open_range(upload_id, request.headers.get('Content-Range'))
+    try:
+        for block in iter(lambda: request.stream.read(BLOCK_SIZE), b''):
+            writer.write(block)
+        chunk = writer.commit()
+    finally:
+        writer.close()
+    return jsonify({'success': True, 'chunk': chunk})
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    return jsonify(uploads.status(upload_id))
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def upload_finalize(upload_id):
+    return jsonify(uploads.finalize(upload_id))
+
+# Такой файл уже есть - ссылка на него по proof из ответа на создание загрузки
+@app.route('/api/uploads/<upload_id>/dedup', methods=['POST'])
+def upload_dedup(upload_id):
+    data = request.get_json() or {}
+    return jsonify(uploads.dedup(upload_id, data.get('proof')))
+
+# Имена загрузок уникальны и не меняются: ETag, immutable, Range (file_responses.py)
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    found = blobs.resolve(filename)
+    if found is None:
+        abort(404)
+    path, etag = found
+    # Блоб лежит без расширения, тип берём из имени в ссылке
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    plan = prepare(path, etag, content_type, request.headers.get, cache=upload_cache)
+    return wsgi_response(plan, request.environ)
+
+@app.route('/previews/<name>')
+def preview_file(name):
+    found = previews.resolve(name)
+    if found is None:
+        abort(404)
+    path, etag = found
+    plan = prepare(path, etag, 'image/jpeg', request.headers.get, cache=upload_cache)
+    return wsgi_response(plan, request.environ)
 
 # WebSocket события
 @socketio.on('connect')
 def handle_connect():
-    print(f'Client connected: {request.sid}')
+    connections.connect(request.sid)
+    logger.debug('Client connected: %s', request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    for username, data in list(online_users.items()):
-        if data.get('sid') == request.sid:
-            del online_users[username]
-            emit('user_left', {'username': username}, broadcast=True)
-            emit('online_users', {'users': list(online_users.keys())}, broadcast=True)
-            break
+    conn, last_session = connections.disconnect(request.sid)
+    subscriptions.drop(request.sid)
+    # Вкладка была в звонке - она из него выходит
+    if conn is not None and conn.username is not None:
+        for session in calls.disconnect(request.sid, conn.username, last_session):
+            if session.state == ENDED:
+                finish_call(session, payload={'ended_by': conn.username})
+    # Пользователь ушёл, только когда закрыта его последняя вкладка
+    if last_session:
+        typing_state.clear(conn.username)
+        presence.offline(conn.username)
 
 @socketio.on('user_join')
 def handle_user_join(data):
     username = data['username']
-    online_users[username] = {'sid': request.sid}
-    
-    # Отправляем пользователю список онлайн и его группы
-    emit('online_users', {'users': list(online_users.keys())}, room=request.sid)
-    emit('user_joined', {'username': username}, broadcast=True)
-    
-    # Отправляем группы пользователя
-    user_groups_list = user_groups.get(username, [])
-    groups_data = [groups_db[group_id] for group_id in user_groups_list if group_id in groups_db]
-    emit('user_groups', {'groups': groups_data}, room=request.sid)
+    if connections.bind(request.sid, username):
+        presence.online(username)
+    
+    # Общий чат - для всех, в нём пользователь виден каждому онлайн
+    connections.join_room(request.sid, 'general')
+    presence.enter_room(username, 'general')
+    
+    # Отправляем пользователю снимок онлайн (общие комнаты и группы) и его группы
+    groups = storage.get_user_groups(username)
+    members = {member for group in groups for member in group['members']}
+    version = presence.stamp()
+    users = sorted(connections.online_in(rooms=connections.get(request.sid).rooms, users=members))
+    emit('presence_snapshot', {'version': version, 'users': users}, room=request.sid)
+    emit('user_groups', {'groups': groups}, room=request.sid)
 
 @socketio.on('join_room')
 def handle_join_room(data):
     room = data.get('room', 'general')
-    join_room(room)
-    print(f"User joined room: {room}")
+    # Присутствие копится по всем открытым комнатам (в реестре подключений,
+    # не в комнатах Socket.IO), трафик - только текущей
+    connections.join_room(request.sid, room)
+    subscriptions.switch(request.sid, room)
+    username = connections.username(request.sid)
+    if username is not None:
+        presence.enter_room(username, room)
+    # Кто онлайн в этой комнате - клиент добавляет к своему списку
+    version = presence.stamp()
+    users = sorted(connections.online_in(rooms=[room]))
+    emit('presence_snapshot', {'version': version, 'users': users, 'room': room}, room=request.sid)
+    logger.debug('User joined room: %s', room)
 
 @socketio.on('send_message')
 def handle_message(data):
     room = data.get('room', 'general')
     
-    if room not in messages_db:
-        messages_db[room] = []
-    
-    message = {
-        'id': str(uuid.uuid4()),
-        'username': data['username'],
-        'text': data.get('text', ''),
-        'file': data.get('file'),
-        'file_info': data.get('file_info'),
-        'timestamp': datetime.now().isoformat(),
-        'type': data.get('type', 'text'),
-        'room': room
-    }
-    
-    messages_db[room].append(message)
-    emit('new_message', message, room=room)
+    message = Message.from_event(data)
+    # Файл - только свой: token приходит в ответе на загрузку, ссылка
+    # сообщения учитывается, чтобы файл не удалился, пока на него ссылаются
+    if message.file and not blobs.attach(message.file, data.get('file_token')):
+        emit('message_rejected', {'reason': 'file'}, room=request.sid)
+        return
+    
+    with metrics.saves.time('message'):
+        storage.add_message(room, message)
+    if outbox is not None:
+        outbox.add(room, message.to_dict(room))
+    else:
+        emit('new_message', message.to_dict(room), room=channel(room))
+
+# Догон после переподключения или возврата в комнату: только пропущенное (catchup.py)
+@socketio.on('sync')
+def handle_sync(data):
+    emit('synced', {'rooms': catch_up(storage.get_messages, data.get('rooms'))}, room=request.sid)
 
 @socketio.on('typing')
 def handle_typing(data):
-    emit('user_typing', {
-        'username': data['username'],
-        'is_typing': data['is_typing'],
-        'room': data.get('room', 'general')
-    }, room=data.get('room', 'general'))
+    typing_state.update(data.get('room', 'general'), data['username'], data['is_typing'])
 
-# ЗВОНКИ - УПРОЩЕННАЯ РЕАЛИЗАЦИЯ
+# ЗВОНКИ: сессия на call_id (calls.py), события - только её участникам
 @socketio.on('start_call')
 def handle_start_call(data):
     target = data.get('target')
@@ -238,132 +511,142 @@ def handle_start_call(data):
     call_id = data.get('call_id')
     caller = data.get('username')
     
-    print(f"Call started: {caller} -> {target}, type: {call_type}, call_id: {call_id}")
+    logger.info('Call started: %s -> %s, type: %s, call_id: %s', caller, target, call_type, call_id)
     
-    if target.startswith('group_'):
-        # Групповой звонок
-        group = groups_db.get(target)
-        if group:
-            for member in group['members']:
-                if member != caller and member in online_users:
-                    emit('incoming_call', {
-                        'caller': caller,
-                        'type': call_type,
-                        'call_id': call_id,
-                        'is_group': True,
-                        'group_name': group['name']
-                    }, room=online_users[member]['sid'])
+    group = storage.get_group(target) if target.startswith('group_') else None
+    if group:
+        # Групповой звонок - всем участникам группы, кто онлайн
+        members = group['members']
     else:
         # Личный звонок
-        target_user = online_users.get(target)
-        if target_user:
-            emit('incoming_call', {
-                'caller': caller,
-                'type': call_type,
-                'call_id': call_id,
-                'is_group': False
-            }, room=target_user['sid'])
-        else:
-            # Если пользователь не онлайн, уведомляем звонящего
-            emit('call_rejected', {
-                'rejected_by': target,
-                'call_id': call_id
-            }, room=request.sid)
+        members = [target]
+    # Сессии читаются один раз: между проверкой и emit пользователь мог
+    # уйти, а пустой room= python-socketio рассылает всем
+    online = {member: connections.sessions(member) for member in members}
+    invitees = [member for member, sids in online.items() if sids]
+    session = calls.start(call_id, caller, request.sid, invitees, type=call_type, group=target if group else None)
+    if session is None:
+        # Некому звонить (пользователь не онлайн) - уведомляем звонящего
+        emit('call_rejected', {
+            'rejected_by': group['name'] if group else target,
+            'call_id': call_id
+        }, room=request.sid)
+        return
+    
+    join_room(session.room)
+    sessions = [sid for member in session.invitees for sid in online.get(member, ())]
+    if not sessions:
+        return
+    emit('incoming_call', {
+        'caller': caller,
+        'type': call_type,
+        'call_id': call_id,
+        'is_group': bool(group),
+        'group_name': group['name'] if group else None
+    }, room=sessions)
 
 @socketio.on('accept_call')
 def handle_accept_call(data):
-    caller = data['caller']
     call_id = data['call_id']
     accepted_by = data['username']
     
-    print(f"Call accepted: {call_id} by {accepted_by}")
+    logger.info('Call accepted: %s by %s', call_id, accepted_by)
     
-    caller_user = online_users.get(caller)
-    if caller_user:
-        emit('call_accepted', {
-            'accepted_by': accepted_by,
-            'call_id': call_id
-        }, room=caller_user['sid'])
+    session = calls.accept(call_id, accepted_by, request.sid)
+    if session is None:
+        return
+    join_room(session.room)
+    emit('call_accepted', {
+        'accepted_by': accepted_by,
+        'call_id': call_id
+    }, room=session.room, include_self=False)
 
 @socketio.on('reject_call')
 def handle_reject_call(data):
-    caller = data['caller']
     call_id = data['call_id']
     rejected_by = data['username']
     
-    print(f"Call rejected: {call_id} by {rejected_by}")
+    logger.info('Call rejected: %s by %s', call_id, rejected_by)
     
-    caller_user = online_users.get(caller)
-    if caller_user:
-        emit('call_rejected', {
-            'rejected_by': rejected_by,
-            'call_id': call_id
-        }, room=caller_user['sid'])
+    # Звонящему сообщаем, только когда отказались все, кому звонили
+    session = calls.reject(call_id, rejected_by)
+    if session is not None and session.state == ENDED:
+        finish_call(session, 'call_rejected', {'rejected_by': rejected_by})
 
 @socketio.on('end_call')
 def handle_end_call(data):
     call_id = data.get('call_id')
     ended_by = data.get('username')
     
-    print(f"Call ended: {call_id} by {ended_by}")
+    logger.info('Call ended: %s by %s', call_id, ended_by)
     
-    emit('call_ended', {
-        'ended_by': ended_by,
-        'call_id': call_id
-    }, broadcast=True)
+    session = calls.leave(call_id, ended_by)
+    if session is None:
+        return
+    if session.state == ENDED:
+        finish_call(session, payload={'ended_by': ended_by}, skip_sid=request.sid)
+    else:
+        leave_room(session.room)
+
+# WebRTC signaling - только между участниками звонка. Если start_call
+# этого звонка ещё не обработан, сигнал уйдёт из него - обработчик не ждёт
+def relay_signal(event, data, payload):
+    calls.signal(data.get('call_id'), connections.username(request.sid), data.get('target_user'),
+                 connections.sessions, lambda sessions: socketio.emit(event, payload, room=sessions))
 
-# WebRTC signaling - ПРОСТАЯ РЕАЛИЗАЦИЯ
 @socketio.on('webrtc_offer')
 def handle_webrtc_offer(data):
     target_user = data.get('target_user')
     call_id = data.get('call_id')
     
-    print(f"WebRTC offer: {call_id} -> {target_user}")
+    logger.debug('WebRTC offer: %s -> %s', call_id, target_user)
     
-    target = online_users.get(target_user)
-    if target:
-        emit('webrtc_offer', {
-            'offer': data['offer'],
-            'caller': data.get('caller'),
-            'call_id': call_id
-        }, room=target['sid'])
+    relay_signal('webrtc_offer', data, {
+        'offer': data['offer'],
+        'caller': data.get('caller'),
+        'call_id': call_id
+    })
 
 @socketio.on('webrtc_answer')
 def handle_webrtc_answer(data):
     target_user = data.get('target_user')
     call_id = data.get('call_id')
     
-    print(f"WebRTC answer: {call_id} -> {target_user}")
+    logger.debug('WebRTC answer: %s -> %s', call_id, target_user)
     
-    target = online_users.get(target_user)
-    if target:
-        emit('webrtc_answer', {
-            'answer': data['answer'],
-            'call_id': call_id
-        }, room=target['sid'])
+    relay_signal('webrtc_answer', data, {
+        'answer': data['answer'],
+        'call_id': call_id
+    })
 
 @socketio.on('webrtc_ice_candidate')
 def handle_webrtc_ice_candidate(data):
-    target_user = data.get('target_user')
     call_id = data.get('call_id')
     
-    target = online_users.get(target_user)
-    if target:
-        emit('webrtc_ice_candidate', {
-            'candidate': data['candidate'],
-            'call_id': call_id
-        }, room=target['sid'])
+    relay_signal('webrtc_ice_candidate', data, {
+        'candidate': data['candidate'],
+        'call_id': call_id
+    })
 
+# Клиент шлёт его вместе с end_call - обычно звонок к этому моменту уже снят
 @socketio.on('webrtc_end_call')
 def handle_webrtc_end_call(data):
     call_id = data.get('call_id')
-    emit('webrtc_call_ended', {
-        'call_id': call_id
-    }, broadcast=True)
+    session = calls.leave(call_id, connections.username(request.sid))
+    if session is None:
+        return
+    if session.state == ENDED:
+        finish_call(session, 'webrtc_call_ended', skip_sid=request.sid)
+    else:
+        leave_room(session.room)
+
+# Все обработчики зарегистрированы - лимиты частоты и замер времени
+limit_events(socketio.server, rate_limiter, on_limited=metrics.on_limited)
+instrument_events(socketio.server, metrics.events)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     print("🚀 NoknowGram PRO с видеозвонками запущен!")
     print(f"🌐 Порт: {port}")
     print("📞 WebRTC видеозвонки: ВКЛ")
-    socketio.run(app, host='0.0.0.0', port=port, debug=True, allow_unsafe_werkzeug=True)
+    socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from file_responses import etag_matches
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Статика чата: chat.html (~90 КБ встроенного CSS/JS), вход, регистрация.
+# Файлы из списка читаются один раз при старте, сжимаются gzip и brotli
+# (если установлен пакет brotli) и держатся в памяти. На запрос - готовые
+# байты под Accept-Encoding, ETag по содержимому и 304 при совпадении.
+# Отдаются только файлы из списка: раньше serve_static отдавал всё из
+# рабочего каталога, включая исходники и chat_data.json.
+# После правки html сервер нужно перезапустить.
+
+STATIC_ASSETS = ('index.html', 'login.html', 'register.html', 'chat.html')
+# Файлы лежат рядом с модулем, а не в рабочем каталоге процесса
+STATIC_ROOT = os.path.dirname(os.path.abspath(__file__))
+# Имена не версионированы - браузер хранит копию, но каждый раз сверяет ETag
+CACHE_CONTROL = 'no-cache'
+# Меньше этого сжатие не окупает заголовки
+MIN_COMPRESS_SIZE = 1024
+
+
+def compressors():
+    available = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        available['br'] = lambda data: brotli.compress(data, quality=11)
+    return available
+
+
+# Accept-Encoding -> {кодировка: q}
+def accepted_encodings(header):
+    accepted = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+class Asset:
+    __slots__ = ('name', 'content_type', 'digest', 'variants')
+
+    def __init__(self, name, data, codecs):
+        self.name = name
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/'):
+            self.content_type += '; charset=utf-8'
+        self.digest = hashlib.sha256(data).hexdigest()[:32]
+        # Кодировка -> байты; сжатая версия хранится, только если она меньше
+        self.variants = {'identity': data}
+        if len(data) >= MIN_COMPRESS_SIZE:
+            for encoding, compress in codecs.items():
+                compressed = compress(data)
+                if len(compressed) < len(data):
+                    self.variants[encoding] = compressed
+
+    def etag(self, encoding):
+        return f'"{self.digest}"' if encoding == 'identity' else f'"{self.digest}-{encoding}"'
+
+    # Лучшая из доступных кодировок, которую принимает клиент
+    def negotiate(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        default = accepted.get('*', 0.0)
+        best, best_q = 'identity', 0.0
+        for encoding in ('br', 'gzip'):
+            q = accepted.get(encoding, default)
+            if encoding in self.variants and q > best_q:
+                best, best_q = encoding, q
+        return best
+
+
+class StaticAssets:
+    def __init__(self, root=STATIC_ROOT, names=STATIC_ASSETS):
+        codecs = compressors()
+        self.assets = {}
+        for name in names:
+            with open(os.path.join(root, name), 'rb') as f:
+                self.assets[name] = Asset(name, f.read(), codecs)
+
+    # -> (status, headers, body) или None, если файла нет в списке
+    def respond(self, name, get_header):
+        asset = self.assets.get(name)
+        if asset is None:
+            return None
+        encoding = asset.negotiate(get_header('Accept-Encoding'))
+        etag = asset.etag(encoding)
+        headers = [('ETag', etag), ('Cache-Control', CACHE_CONTROL), ('Vary', 'Accept-Encoding')]
+        if etag_matches(get_header('If-None-Match'), etag):
+            return 304, headers, b''
+        body = asset.variants[encoding]
+        headers.append(('Content-Type', asset.content_type))
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+        return 200, headers, body
@@ -0,0 +1,436 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from history import HOT_MESSAGES, HotWindow, RoomStore, page_cursor, read_page
+from message import Message
+from search import SearchIndex
+
+# Хранилище пользователей, групп и сообщений для server.py.
+# MemoryStorage - словари в памяти, у каждой комнаты ограниченное окно
+#                 последних сообщений, старые выгружаются в сегменты на диске,
+# SQLiteStorage - индексированная база с WAL и пулом соединений по потокам.
+
+
+class Storage:
+    def get_user(self, username):
+        raise NotImplementedError
+
+    def create_user(self, username, password_hash, created_at):
+        raise NotImplementedError
+
+    def set_password_hash(self, username, password_hash):
+        raise NotImplementedError
+
+    # message - message.Message, хранилище присваивает ему seq
+    def add_message(self, room, message):
+        raise NotImplementedError
+
+    # Страница истории: (Message по возрастанию seq, next_cursor или None)
+    def get_messages(self, room, before=None, after=None, limit=100):
+        raise NotImplementedError
+
+    def create_group(self, group):
+        raise NotImplementedError
+
+    def get_group(self, group_id):
+        raise NotImplementedError
+
+    def get_user_groups(self, username):
+        raise NotImplementedError
+
+    # retention_for(room) -> history.Retention или None;
+    # on_trim(files) - поля file удалённых сообщений (ссылки на загрузки)
+    def enforce_retention(self, retention_for, on_trim=None):
+        raise NotImplementedError
+
+    def rooms(self):
+        raise NotImplementedError
+
+    # Сколько сообщений хранится в каждой комнате: {room: число}
+    def room_sizes(self):
+        raise NotImplementedError
+
+    # Полнотекстовый поиск (search.py) в комнатах rooms.
+    # -> ([(room, Message)] по релевантности, next_cursor или None)
+    def search(self, query, rooms, limit=20, cursor=0, order='rank'):
+        hits, next_cursor = self.search_index.search(query, rooms, limit, cursor, order)
+        found = []
+        for room, seq in hits:
+            message = self.get_message(room, seq)
+            if message is not None:
+                found.append((room, message))
+        return found, next_cursor
+
+    def get_message(self, room, seq):
+        page, _ = self.get_messages(room, after=seq - 1, limit=1)
+        return page[0] if page and page[0].seq == seq else None
+
+    def close(self):
+        pass
+
+
+class MemoryStorage(Storage):
+    def __init__(self, hot_size=HOT_MESSAGES, spill_batch=100, spill_dir=None):
+        self.users = {}
+        self.messages = {}  # room -> HotWindow
+        self.groups = {}
+        self.user_groups = {}
+        self.hot_size = hot_size
+        self.spill_batch = spill_batch
+        # Хранилище живёт в памяти, поэтому и выгрузка - во временный каталог
+        self._own_spill_dir = spill_dir is None
+        self.spill = RoomStore(spill_dir or tempfile.mkdtemp(prefix='noknowgram-spill-'))
+        self._search_dir = tempfile.mkdtemp(prefix='noknowgram-search-')
+        self.search_index = SearchIndex(SQLiteConnections(os.path.join(self._search_dir, 'search.db')), owned=True)
+        self._lock = threading.Lock()
+
+    def get_user(self, username):
+        return self.users.get(username)
+
+    def create_user(self, username, password_hash, created_at):
+        with self._lock:
+            if username in self.users:
+                return False
+            self.users[username] = {'password_hash': password_hash, 'created_at': created_at}
+            return True
+
+    def set_password_hash(self, username, password_hash):
+        with self._lock:
+            if username in self.users:
+                self.users[username]['password_hash'] = password_hash
+
+    # Окно переполнилось - выгружаем самые старые сообщения одной пачкой
+    def add_message(self, room, message):
+        with self._lock:
+            window = self.messages.get(room)
+            if window is None:
+                window = self.messages[sys.intern(room)] = HotWindow()
+            window.push(message)
+            if len(window.messages) > self.hot_size + self.spill_batch:
+                spilled = [window.messages.popleft() for _ in range(self.spill_batch)]
+                self.spill.log(room).append(spilled)
+        self.search_index.add(room, message.seq, message.text)
+        return message
+
+    def get_messages(self, room, before=None, after=None, limit=100):
+        window = self.messages.get(room)
+        if window is None:
+            return [], None
+        log = self.spill.log(room) if self.spill.exists(room) else None
+        return read_page(window, log, self._lock, before, after, limit)
+
+    def create_group(self, group):
+        with self._lock:
+            self.groups[group['id']] = group
+            for member in group['members']:
+                self.user_groups.setdefault(member, []).append(group['id'])
+        return group
+
+    def get_group(self, group_id):
+        return self.groups.get(group_id)
+
+    def get_user_groups(self, username):
+        return [self.groups[group_id] for group_id in self.user_groups.get(username, [])
+                if group_id in self.groups]
+
+    # Сроки хранения применяются к выгруженной части, окно в памяти остаётся
+    def enforce_retention(self, retention_for, on_trim=None):
+        self.spill.enforce_retention(retention_for, on_trim)
+        for room in self.spill.rooms():
+            self.search_index.trim(room, self.spill.log(room).first_seq)
+
+    def rooms(self):
+        return list(self.messages)
+
+    def room_sizes(self):
+        with self._lock:
+            windows = list(self.messages.items())
+        sizes = {}
+        for room, window in windows:
+            first_seq = self.spill.log(room).first_seq if self.spill.exists(room) else window.first_seq
+            sizes[room] = window.next_seq - first_seq
+        return sizes
+
+    def close(self):
+        self.spill.close()
+        self.search_index.close()
+        shutil.rmtree(self._search_dir, ignore_errors=True)
+        if self._own_spill_dir:
+            shutil.rmtree(self.spill.root, ignore_errors=True)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL,
+    created_at TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS messages (
+    room TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    username TEXT NOT NULL,
+    text TEXT,
+    file TEXT,
+    file_info TEXT,
+    timestamp TEXT NOT NULL,
+    type TEXT NOT NULL,
+    PRIMARY KEY (room, seq)
+);
+CREATE INDEX IF NOT EXISTS messages_room_timestamp ON messages (room, timestamp);
+
+-- Последний выданный номер в комнате: не сбрасывается, даже если
+-- срок хранения удалил все сообщения комнаты
+CREATE TABLE IF NOT EXISTS room_seq (
+    room TEXT PRIMARY KEY,
+    last_seq INTEGER NOT NULL
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO room_seq (room, last_seq) SELECT room, MAX(seq) FROM messages GROUP BY room;
+
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    creator TEXT NOT NULL,
+    created_at TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS group_members (
+    username TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    PRIMARY KEY (username, group_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS group_members_group ON group_members (group_id);
+'''
+
+# Запросы держим константами: sqlite3 кэширует подготовленные
+# выражения в каждом соединении по тексту запроса.
+SQL_GET_USER = 'SELECT password_hash, created_at FROM users WHERE username = ?'
+SQL_INSERT_USER = 'INSERT OR IGNORE INTO users (username, password_hash, created_at) VALUES (?, ?, ?)'
+SQL_UPDATE_PASSWORD = 'UPDATE users SET password_hash = ? WHERE username = ?'
+SQL_NEXT_SEQ = '''INSERT INTO room_seq (room, last_seq) VALUES (?, 1)
+    ON CONFLICT (room) DO UPDATE SET last_seq = last_seq + 1
+    RETURNING last_seq'''
+SQL_INSERT_MESSAGE = '''INSERT INTO messages (room, seq, id, username, text, file, file_info, timestamp, type)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+SQL_MESSAGE_COLUMNS = 'room, seq, id, username, text, file, file_info, timestamp, type'
+SQL_MESSAGES_BEFORE = f'''SELECT {SQL_MESSAGE_COLUMNS} FROM messages
+    WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?'''
+SQL_MESSAGES_AFTER = f'''SELECT {SQL_MESSAGE_COLUMNS} FROM messages
+    WHERE room = ? AND seq > ? AND seq < ? ORDER BY seq LIMIT ?'''
+SQL_ROOMS = 'SELECT room FROM room_seq'
+SQL_ROOM_SIZES = 'SELECT room, COUNT(*) FROM messages GROUP BY room'
+SQL_FIRST_SEQ = 'SELECT MIN(seq) FROM messages WHERE room = ?'
+SQL_GET_MESSAGE = f'SELECT {SQL_MESSAGE_COLUMNS} FROM messages WHERE room = ? AND seq = ?'
+SQL_UNINDEXED = 'SELECT seq, text FROM messages WHERE room = ? AND seq > ? ORDER BY seq LIMIT ?'
+SQL_TRIM_BY_COUNT = '''DELETE FROM messages WHERE room = ? AND seq <= (SELECT MAX(seq) FROM messages WHERE room = ?) - ?
+    RETURNING file'''
+SQL_TRIM_BY_AGE = 'DELETE FROM messages WHERE room = ? AND timestamp < ? RETURNING file'
+SQL_TRIM_BY_BYTES = '''DELETE FROM messages WHERE room = ? AND seq <= (
+    SELECT MAX(seq) FROM (
+        SELECT seq, SUM(length(id) + length(username) + COALESCE(length(text), 0) +
+                        COALESCE(length(file), 0) + COALESCE(length(file_info), 0) +
+                        length(timestamp) + length(type)) OVER (ORDER BY seq DESC) AS total
+        FROM messages WHERE room = ?
+    ) WHERE total > ?
+)
+RETURNING file'''
+SQL_INSERT_GROUP = 'INSERT INTO groups (id, name, creator, created_at) VALUES (?, ?, ?, ?)'
+SQL_INSERT_MEMBER = 'INSERT OR IGNORE INTO group_members (username, group_id) VALUES (?, ?)'
+SQL_GET_GROUP = 'SELECT id, name, creator, created_at FROM groups WHERE id = ?'
+SQL_GROUP_MEMBERS = 'SELECT username FROM group_members WHERE group_id = ?'
+SQL_USER_GROUPS = '''SELECT g.id, g.name, g.creator, g.created_at
+    FROM group_members m JOIN groups g ON g.id = m.group_id
+    WHERE m.username = ?'''
+
+SEQ_MAX = 2 ** 63 - 1
+
+
+# Одно соединение на поток: sqlite3-соединения нельзя делить между потоками.
+# Общий для хранилища, реестра сессий и брокера (connections.py, broker.py).
+class SQLiteConnections:
+    def __init__(self, path, cached_statements=128):
+        self.path = path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path, cached_statements=128):
+        self.path = path
+        self._connections = SQLiteConnections(path, cached_statements)
+        self._conn = self._connections.get
+        self._conn().executescript(SCHEMA)
+        # Индекс поиска - в той же базе, пишется в транзакции add_message
+        self.search_index = SearchIndex(self._connections)
+        self._index_history()
+
+    # Сообщения, которых ещё нет в индексе (база до появления поиска)
+    def _index_history(self, batch=1000):
+        for (room,) in self._conn().execute(SQL_ROOMS).fetchall():
+            last = self.search_index.last_seq(room)
+            while True:
+                rows = self._conn().execute(SQL_UNINDEXED, (room, last, batch)).fetchall()
+                if not rows:
+                    break
+                self.search_index.add_many(room, [(row['seq'], row['text']) for row in rows])
+                last = rows[-1]['seq']
+
+    def get_user(self, username):
+        row = self._conn().execute(SQL_GET_USER, (username,)).fetchone()
+        if row is None:
+            return None
+        return {'password_hash': row['password_hash'], 'created_at': row['created_at']}
+
+    def create_user(self, username, password_hash, created_at):
+        cur = self._conn().execute(SQL_INSERT_USER, (username, password_hash, created_at))
+        return cur.rowcount == 1
+
+    def set_password_hash(self, username, password_hash):
+        self._conn().execute(SQL_UPDATE_PASSWORD, (password_hash, username))
+
+    def add_message(self, room, message):
+        conn = self._conn()
+        file_info = message.file_info
+        # BEGIN IMMEDIATE сериализует писателей, номер в комнате не повторится
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            message.seq = conn.execute(SQL_NEXT_SEQ, (room,)).fetchone()[0]
+            conn.execute(SQL_INSERT_MESSAGE, (
+                room, message.seq, message.message_id(room), message.username, message.text,
+                message.file, json.dumps(file_info) if file_info is not None else None,
+                message.timestamp, message.type
+            ))
+            self.search_index.add(room, message.seq, message.text, conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return message
+
+    # Берём на одну строку больше, чтобы узнать, есть ли следующая страница
+    def get_messages(self, room, before=None, after=None, limit=100):
+        upper = before if before is not None else SEQ_MAX
+        if after is not None:
+            rows = self._conn().execute(SQL_MESSAGES_AFTER, (room, after, upper, limit + 1)).fetchall()
+        else:
+            rows = self._conn().execute(SQL_MESSAGES_BEFORE, (room, upper, limit + 1)).fetchall()
+            rows.reverse()
+        more = len(rows) > limit
+        if more:
+            rows = rows[:limit] if after is not None else rows[1:]
+        page = [self._message_from_row(row) for row in rows]
+        return page, page_cursor(page, more, after)
+
+    def create_group(self, group):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(SQL_INSERT_GROUP, (group['id'], group['name'], group['creator'], group['created_at']))
+            conn.executemany(SQL_INSERT_MEMBER, [(member, group['id']) for member in group['members']])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return group
+
+    def get_group(self, group_id):
+        row = self._conn().execute(SQL_GET_GROUP, (group_id,)).fetchone()
+        return self._group_from_row(row) if row is not None else None
+
+    def get_user_groups(self, username):
+        rows = self._conn().execute(SQL_USER_GROUPS, (username,)).fetchall()
+        return [self._group_from_row(row) for row in rows]
+
+    def enforce_retention(self, retention_for, on_trim=None):
+        conn = self._conn()
+        for (room,) in conn.execute(SQL_ROOMS).fetchall():
+            retention = retention_for(room)
+            if not retention:
+                continue
+            trimmed = []
+            if retention.max_messages is not None:
+                trimmed += conn.execute(SQL_TRIM_BY_COUNT, (room, room, retention.max_messages)).fetchall()
+            if retention.max_age is not None:
+                cutoff = datetime.fromtimestamp(time.time() - retention.max_age).isoformat()
+                trimmed += conn.execute(SQL_TRIM_BY_AGE, (room, cutoff)).fetchall()
+            if retention.max_bytes is not None:
+                trimmed += conn.execute(SQL_TRIM_BY_BYTES, (room, room, retention.max_bytes)).fetchall()
+            files = [file for (file,) in trimmed if file]
+            if files and on_trim is not None:
+                on_trim(files)
+            first_seq = conn.execute(SQL_FIRST_SEQ, (room,)).fetchone()[0]
+            self.search_index.trim(room, first_seq if first_seq is not None else SEQ_MAX)
+
+    def rooms(self):
+        return [row[0] for row in self._conn().execute(SQL_ROOMS).fetchall()]
+
+    def room_sizes(self):
+        return dict(self._conn().execute(SQL_ROOM_SIZES).fetchall())
+
+    def get_message(self, room, seq):
+        row = self._conn().execute(SQL_GET_MESSAGE, (room, seq)).fetchone()
+        return self._message_from_row(row) if row is not None else None
+
+    def close(self):
+        self._connections.close()
+
+    def _group_from_row(self, row):
+        members = self._conn().execute(SQL_GROUP_MEMBERS, (row['id'],)).fetchall()
+        return {
+            'id': row['id'],
+            'name': row['name'],
+            'creator': row['creator'],
+            'members': [member['username'] for member in members],
+            'created_at': row['created_at']
+        }
+
+    @staticmethod
+    def _message_from_row(row):
+        return Message.from_dict({
+            'username': row['username'],
+            'text': row['text'],
+            'file': row['file'],
+            'file_info': json.loads(row['file_info']) if row['file_info'] is not None else None,
+            'timestamp': row['timestamp'],
+            'type': row['type'],
+            'seq': row['seq']
+        })
+
+
+def create_storage(backend='sqlite', path='noknowgram.db', hot_size=HOT_MESSAGES):
+    if backend == 'memory':
+        return MemoryStorage(hot_size=hot_size)
+    if backend == 'sqlite':
+        return SQLiteStorage(path)
+    raise ValueError(f'Неизвестное хранилище: {backend}')
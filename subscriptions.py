@@ -0,0 +1,66 @@
+import threading
+
+# Подписки вкладок на комнаты. Сообщения и typing комнаты уходят в её
+# канал - комнату Socket.IO room:<имя>, - и получают их только вкладки,
+# которые на эту комнату подписаны. Переключая чат, вкладка переходит на
+# новую комнату и уходит из прежней: раньше join_room только добавлял
+# комнаты, и со временем клиент получал трафик всех чатов, где побывал.
+#
+# Каналы отделены от комнат присутствия (presence.py, connections.py):
+# пользователь остаётся виден там, где был, а трафик идёт только туда,
+# куда смотрит вкладка.
+#
+# server - python-socketio Server или AsyncServer (у Flask-SocketIO это
+# socketio.server); enter_room/leave_room у обоих синхронные.
+
+CHANNEL_PREFIX = 'room:'
+
+
+def channel(room):
+    return CHANNEL_PREFIX + room
+
+
+class Subscriptions:
+    def __init__(self, server, namespace='/'):
+        self.server = server
+        self.namespace = namespace
+        self._by_sid = {}  # sid -> комнаты, на которые подписана вкладка
+        self._lock = threading.Lock()
+
+    def subscribe(self, sid, room):
+        with self._lock:
+            rooms = self._by_sid.setdefault(sid, set())
+            if room in rooms:
+                return False
+            rooms.add(room)
+        self.server.enter_room(sid, channel(room), namespace=self.namespace)
+        return True
+
+    def unsubscribe(self, sid, room):
+        with self._lock:
+            rooms = self._by_sid.get(sid)
+            if not rooms or room not in rooms:
+                return False
+            rooms.discard(room)
+        self.server.leave_room(sid, channel(room), namespace=self.namespace)
+        return True
+
+    # Вкладка открыла комнату room: подписка только на неё
+    def switch(self, sid, room):
+        with self._lock:
+            previous = self._by_sid.get(sid, set()) - {room}
+        for old in previous:
+            self.unsubscribe(sid, old)
+        return self.subscribe(sid, room)
+
+    def rooms(self, sid):
+        with self._lock:
+            return set(self._by_sid.get(sid, ()))
+
+    # Отключение: из комнат Socket.IO сокет убирает сам сервер
+    def drop(self, sid):
+        with self._lock:
+            self._by_sid.pop(sid, None)
+
+    def __len__(self):
+        return len(self._by_sid)
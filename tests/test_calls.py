@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+import calls
+from calls import CallRegistry, SQLiteCallRegistry
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def registry(request, tmp_path):
+    if request.param == 'memory':
+        registry = CallRegistry()
+    else:
+        registry = SQLiteCallRegistry(str(tmp_path / 'calls.db'))
+    yield registry
+    registry.close()
+
+
+def tabs(username):
+    return [f'{username}-tab']
+
+
+def test_route_unknown_call_does_not_wait(registry):
+    started = time.monotonic()
+    assert registry.route('forged', 'alice', 'bob', tabs) == []
+    sent = []
+    registry.signal('forged', 'alice', 'bob', tabs, sent.append)
+    assert time.monotonic() - started < 0.1
+    assert sent == []
+
+
+def test_signal_before_start_is_sent_by_start(registry):
+    sent = []
+    registry.signal('c1', 'alice', 'bob', tabs, sent.append)
+    registry.signal('c1', 'mallory', 'bob', tabs, sent.append)
+    assert sent == []
+
+    registry.start('c1', 'alice', 'alice-tab', ['bob'])
+    assert sent == [['bob-tab']]
+
+    registry.signal('c1', 'alice', 'bob', tabs, sent.append)
+    assert sent == [['bob-tab'], ['bob-tab']]
+
+
+def test_early_signal_expires(registry, monkeypatch):
+    sent = []
+    registry.signal('c1', 'alice', 'bob', tabs, sent.append)
+    monkeypatch.setattr(calls, 'EARLY_SIGNAL_TTL', 0)
+    registry.signal('c2', 'alice', 'bob', tabs, sent.append)
+    now = time.monotonic()
+    monkeypatch.setattr(calls.time, 'monotonic', lambda: now + 10)
+
+    registry.start('c1', 'alice', 'alice-tab', ['bob'])
+    registry.start('c2', 'alice', 'alice-tab', ['bob'])
+    assert sent == []
+
+
+def test_ended_call_drops_signal(registry):
+    registry.start('c1', 'alice', 'alice-tab', ['bob'])
+    registry.leave('c1', 'alice')
+    sent = []
+    registry.signal('c1', 'alice', 'bob', tabs, sent.append)
+    registry.start('c1', 'alice', 'alice-tab', ['bob'])
+    assert sent == []
+
+
+def test_early_signals_are_bounded(registry, monkeypatch):
+    monkeypatch.setattr(calls, 'EARLY_CALLS', 4)
+    monkeypatch.setattr(calls, 'EARLY_SIGNALS', 2)
+    sent = []
+    for n in range(10):
+        registry.signal(f'forged-{n}', 'alice', 'bob', tabs, sent.append)
+    for _ in range(5):
+        registry.signal('forged-9', 'alice', 'bob', tabs, sent.append)
+    assert len(registry._early) == 4
+    assert len(registry._early['forged-9'][1]) == 2
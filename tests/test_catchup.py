@@ -0,0 +1,56 @@
+import pytest
+
+from catchup import catch_up
+from history import Retention
+from message import Message
+from storage import SQLiteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / 'chat.db'))
+    for n in range(1, 11):
+        storage.add_message('general', Message('alice', f'g{n}'))
+    storage.add_message('dev', Message('bob', 'd1'))
+    yield storage
+    storage.close()
+
+
+def texts(reply, room):
+    return [message['text'] for message in reply[room]['messages']]
+
+
+def test_only_missed_messages(storage):
+    reply = catch_up(storage.get_messages, {'general': 7, 'dev': 1})
+    assert texts(reply, 'general') == ['g8', 'g9', 'g10']
+    assert [message['seq'] for message in reply['general']['messages']] == [8, 9, 10]
+    assert reply['dev'] == {'messages': []}
+
+
+def test_new_room_from_zero(storage):
+    assert texts(catch_up(storage.get_messages, {'dev': 0}), 'dev') == ['d1']
+    assert catch_up(storage.get_messages, {'empty': 0}) == {'empty': {'messages': []}}
+
+
+def test_too_far_behind_refetches(storage):
+    assert catch_up(storage.get_messages, {'general': 2}, limit=5) == {'general': {'refetch': True}}
+    assert texts(catch_up(storage.get_messages, {'general': 5}, limit=5), 'general') == \
+        ['g6', 'g7', 'g8', 'g9', 'g10']
+
+
+def test_client_ahead_of_server_refetches(storage):
+    assert catch_up(storage.get_messages, {'general': 50, 'empty': 3}) == \
+        {'general': {'refetch': True}, 'empty': {'refetch': True}}
+
+
+def test_trimmed_history_refetches(storage):
+    storage.enforce_retention(lambda room: Retention(max_messages=3) if room == 'general' else None)
+    assert catch_up(storage.get_messages, {'general': 2}) == {'general': {'refetch': True}}
+    assert texts(catch_up(storage.get_messages, {'general': 7}), 'general') == ['g8', 'g9', 'g10']
+
+
+def test_bad_cursors_are_ignored(storage):
+    assert catch_up(storage.get_messages, ['general']) == {}
+    assert catch_up(storage.get_messages, {'general': -1, 'dev': True, 'x': '3', 'y': None}) == {}
+    rooms = {f'room-{n}': 0 for n in range(30)}
+    assert len(catch_up(storage.get_messages, rooms, max_rooms=20)) == 20
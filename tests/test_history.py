@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from history import RoomHistory, RoomLog, RoomStore
+from message import Message
+from persistence import EventLog
+
+resource = pytest.importorskip('resource')
+
+
+@pytest.fixture
+def low_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    in_use = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else 64
+    limit = in_use + 32
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        yield limit
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_room_store_keeps_no_files_open(tmp_path, low_fd_limit):
+    store = RoomStore(str(tmp_path))
+    rooms = [f'room-{n}' for n in range(low_fd_limit * 2)]
+    for room in rooms:
+        store.log(room).append([Message('alice', f'hi {room}')])
+        store.log(room).sync()
+    for room in rooms:
+        messages = store.log(room).read()
+        assert [(m.seq, m.text) for m in messages] == [(1, f'hi {room}')]
+
+
+def test_event_log_writes_more_rooms_than_fd_limit(tmp_path, low_fd_limit):
+    log = EventLog(str(tmp_path), fsync='batch')
+    log.load()
+    log.start()
+    history = RoomHistory(log.rooms, on_append=lambda room, message: log.append(
+        {'op': 'message', 'room': room, 'message': message}), max_rooms=16)
+    rooms = [f'room-{n}' for n in range(low_fd_limit * 2)]
+    try:
+        for room in rooms:
+            history.append(room, Message('alice', 'one'))
+            history.append(room, Message('bob', 'two'))
+        assert log.flush(10)
+    finally:
+        log.close()
+
+    store = RoomStore(os.path.join(str(tmp_path), 'rooms'))
+    for room in rooms:
+        assert [(m.seq, m.text) for m in store.log(room).read()] == [(1, 'one'), (2, 'two')]
+
+
+def test_segments_roll_over(tmp_path):
+    log = RoomLog(str(tmp_path), 'general', segment_messages=3)
+    log.append([Message('alice', str(n)) for n in range(7)])
+    assert log.segments == [1, 4, 7]
+    assert [m.text for m in log.read(3, 6)] == ['2', '3', '4']
+
+    reopened = RoomLog(str(tmp_path), 'general', segment_messages=3)
+    assert reopened.next_seq == 8
+    reopened.append([Message('bob', 'last')])
+    assert [(m.seq, m.text) for m in reopened.read(7)] == [(7, '6'), (8, 'last')]
+
+
+def test_failed_write_leaves_segment_untouched(tmp_path, monkeypatch):
+    import history
+
+    log = RoomLog(str(tmp_path), 'general')
+    log.append([Message('alice', 'one')])
+
+    def broken(f, data):
+        f.write(data[:len(data) // 2])
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(history, 'write_all', broken)
+    with pytest.raises(OSError):
+        log.append([Message('alice', 'two')])
+    monkeypatch.undo()
+
+    log.append([Message('alice', 'two')])
+    reopened = RoomLog(str(tmp_path), 'general')
+    assert [(m.seq, m.text) for m in reopened.read()] == [(1, 'one'), (2, 'two')]
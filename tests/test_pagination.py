@@ -0,0 +1,77 @@
+import pytest
+
+from history import RoomHistory, RoomStore, page_range
+from message import Message
+from storage import MemoryStorage, SQLiteStorage
+
+TOTAL = 23
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'history'])
+def pages(request, tmp_path):
+    # page(room, before, after, limit) поверх каждого хранилища; у memory
+    # и history часть сообщений - на диске, часть - в горячем окне
+    if request.param == 'memory':
+        storage = MemoryStorage(hot_size=5, spill_batch=4, spill_dir=str(tmp_path / 'spill'))
+        add, page, close = storage.add_message, storage.get_messages, storage.close
+    elif request.param == 'sqlite':
+        storage = SQLiteStorage(str(tmp_path / 'chat.db'))
+        add, page, close = storage.add_message, storage.get_messages, storage.close
+    else:
+        store = RoomStore(str(tmp_path / 'rooms'))
+        history = RoomHistory(store, on_append=lambda room, message: store.log(room).append([message]),
+                              hot_size=5)
+        add, page, close = history.append, history.page, store.close
+    for n in range(1, TOTAL + 1):
+        add('general', Message('alice', f'm{n}'))
+    yield page
+    close()
+
+
+def seqs(messages):
+    return [message.seq for message in messages]
+
+
+def test_page_range():
+    assert page_range(1, 10, limit=3) == (8, 11, True)
+    assert page_range(1, 10, before=8, limit=3) == (5, 8, True)
+    assert page_range(1, 10, before=3, limit=3) == (1, 3, False)
+    assert page_range(1, 10, after=7, limit=3) == (8, 11, False)
+    assert page_range(1, 10, after=2, limit=3) == (3, 6, True)
+    assert page_range(1, 10, after=0, before=4, limit=10) == (1, 4, False)
+    # Курсоры за пределами истории
+    assert page_range(5, 6, before=100, limit=3) == (8, 11, True)
+    assert page_range(5, 6, after=20, limit=3) == (21, 21, False)
+    assert page_range(5, 6, before=2, limit=3) == (5, 5, False)
+
+
+def test_latest_page(pages):
+    messages, cursor = pages('general', limit=4)
+    assert seqs(messages) == [20, 21, 22, 23]
+    assert [message.text for message in messages] == ['m20', 'm21', 'm22', 'm23']
+    assert cursor == 20
+
+
+def test_walk_backwards(pages):
+    seen = []
+    cursor = None
+    while True:
+        messages, cursor = pages('general', before=cursor, limit=4)
+        seen = seqs(messages) + seen
+        if cursor is None:
+            break
+    assert seen == list(range(1, TOTAL + 1))
+
+
+def test_walk_forwards(pages):
+    seen = []
+    cursor = 0
+    while cursor is not None:
+        messages, cursor = pages('general', after=cursor, limit=4)
+        seen += seqs(messages)
+    assert seen == list(range(1, TOTAL + 1))
+
+
+def test_empty_room(pages):
+    assert pages('nowhere', limit=4) == ([], None)
+    assert pages('general', after=TOTAL, limit=4) == ([], None)
@@ -0,0 +1,86 @@
+import logging
+
+import history
+import persistence
+from history import RoomHistory, RoomStore
+from message import Message
+from persistence import EventLog
+
+
+def start_log(path, **kwargs):
+    log = EventLog(str(path), **kwargs)
+    log.load()
+    log.start()
+    return log
+
+
+def on_append(log):
+    return lambda room, message: log.append({'op': 'message', 'room': room, 'message': message})
+
+
+def fail_writes(monkeypatch, times):
+    calls = {'failed': 0}
+    write_all = history.write_all
+
+    def flaky(f, data):
+        if calls['failed'] < times:
+            calls['failed'] += 1
+            f.write(data[:len(data) // 2])
+            raise OSError(28, 'No space left on device')
+        write_all(f, data)
+
+    monkeypatch.setattr(history, 'write_all', flaky)
+    monkeypatch.setattr(persistence, 'write_all', flaky)
+    return calls
+
+
+def test_flush_without_writer_returns_false(tmp_path):
+    log = EventLog(str(tmp_path))
+    assert log.flush(1) is False
+    log.start()
+    assert log.flush(1) is True
+    log.close()
+    assert log.flush(1) is False
+
+
+def test_failed_batch_is_retried_without_gaps(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(persistence, 'RETRY_DELAY', 0.01)
+    log = start_log(tmp_path, fsync='batch')
+    rooms = RoomHistory(log.rooms, on_append=on_append(log))
+    rooms.append('general', Message('alice', 'one'))
+    assert log.flush(5)
+
+    calls = fail_writes(monkeypatch, 3)
+    with caplog.at_level(logging.ERROR, logger='persistence'):
+        rooms.append('general', Message('alice', 'two'))
+        rooms.append('general', Message('bob', 'three'))
+        log.append({'op': 'user', 'username': 'bob', 'data': {'password_hash': 'x'}})
+        assert log.flush(5) is False
+    assert not log.healthy
+    assert 'Ошибка записи журнала' in caplog.text
+    assert log._thread.is_alive()
+
+    rooms.append('general', Message('carol', 'four'))
+    for _ in range(100):
+        if log.flush(5):
+            break
+    assert calls['failed'] == 3
+    assert log.healthy
+    log.close()
+
+    store = RoomStore(str(tmp_path / 'rooms'))
+    assert [(m.seq, m.text) for m in store.log('general').read()] == [
+        (1, 'one'), (2, 'two'), (3, 'three'), (4, 'four')]
+    reloaded = EventLog(str(tmp_path)).load()
+    assert reloaded['users'] == {'bob': {'password_hash': 'x'}}
+
+
+def test_unwritable_batch_at_shutdown_is_reported(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(persistence, 'RETRY_DELAY', 0.01)
+    log = start_log(tmp_path)
+    fail_writes(monkeypatch, 10 ** 6)
+    log.append({'op': 'user', 'username': 'bob', 'data': {}})
+    with caplog.at_level(logging.ERROR, logger='persistence'):
+        assert log.flush(5) is False
+        log.close()
+    assert 'потеряно событий: 1' in caplog.text
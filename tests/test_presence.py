@@ -0,0 +1,39 @@
+from connections import ConnectionRegistry, SQLiteConnectionRegistry
+from presence import PresenceTracker
+
+
+def tracker(connections, sent):
+    return PresenceTracker(lambda payload, to: sent.append((payload['joined'], payload['left'], to)),
+                           audience=lambda username: [], room_audience=connections.room_sessions)
+
+
+def test_room_delta_goes_to_room_sessions(tmp_path):
+    for connections in (ConnectionRegistry(), SQLiteConnectionRegistry(str(tmp_path / 'c.db'))):
+        sent = []
+        presence = tracker(connections, sent)
+        connections.bind('a1', 'alice')
+        connections.bind('b1', 'bob')
+        connections.join_room('a1', 'dev')
+        connections.join_room('b1', 'dev')
+        connections.join_room('b1', 'ops')
+        presence.online('alice')
+        presence.enter_room('alice', 'dev')
+        presence.flush()
+        assert [(joined, sorted(to)) for joined, left, to in sent] == [(['alice'], ['a1', 'b1'])]
+
+        connections.leave_room('b1', 'dev')
+        sent.clear()
+        presence.offline('alice')
+        presence.flush()
+        assert [(left, to) for joined, left, to in sent] == [(['alice'], ['a1'])]
+        connections.close()
+
+
+def test_empty_room_is_not_broadcast():
+    connections = ConnectionRegistry()
+    sent = []
+    presence = tracker(connections, sent)
+    presence.online('alice')
+    presence.enter_room('alice', 'nobody-here')
+    presence.flush()
+    assert sent == []
@@ -0,0 +1,43 @@
+import subprocess
+
+import pytest
+
+import previews
+
+
+def fake_ffmpeg(monkeypatch, outcomes):
+    offsets = []
+
+    def run(args, **kwargs):
+        assert 'check' not in kwargs
+        offset = args[args.index('-ss') + 1]
+        offsets.append(offset)
+        returncode, frame = outcomes[offset]
+        with open(args[-1], 'wb') as f:
+            f.write(frame)
+        return subprocess.CompletedProcess(args, returncode, b'', b'seek past end')
+
+    monkeypatch.setattr(previews.subprocess, 'run', run)
+    return offsets
+
+
+def test_short_video_falls_back_to_first_frame(tmp_path, monkeypatch):
+    target = tmp_path / 'preview.jpg'
+    offsets = fake_ffmpeg(monkeypatch, {'1': (1, b''), '0': (0, b'jpeg')})
+    previews._video_preview('clip.mp4', str(target), 480)
+    assert offsets == ['1', '0']
+    assert target.read_bytes() == b'jpeg'
+
+
+def test_empty_frame_falls_back_to_first_frame(tmp_path, monkeypatch):
+    target = tmp_path / 'preview.jpg'
+    offsets = fake_ffmpeg(monkeypatch, {'1': (0, b''), '0': (0, b'jpeg')})
+    previews._video_preview('clip.mp4', str(target), 480)
+    assert offsets == ['1', '0']
+
+
+def test_video_without_frames_raises(tmp_path, monkeypatch):
+    target = tmp_path / 'preview.jpg'
+    fake_ffmpeg(monkeypatch, {'1': (1, b''), '0': (1, b'')})
+    with pytest.raises(RuntimeError, match='seek past end'):
+        previews._video_preview('clip.mp4', str(target), 480)
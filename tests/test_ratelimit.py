@@ -0,0 +1,110 @@
+import asyncio
+
+from ratelimit import RATE_LIMITS, RateLimiter, limit_events, parse_limits
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Server:
+    def __init__(self, handlers):
+        self.handlers = {'/': handlers}
+        self.emitted = []
+
+    def emit(self, event, data, to=None, namespace=None):
+        self.emitted.append((event, data, to))
+
+
+class AsyncServer(Server):
+    async def emit(self, event, data, to=None, namespace=None):
+        super().emit(event, data, to, namespace)
+
+
+def test_parse_limits():
+    assert parse_limits('send_message=5/20, typing=2,,join_room=0.5/3') == {
+        'send_message': (5.0, 20.0),
+        'typing': (2.0, 2.0),
+        'join_room': (0.5, 3.0)
+    }
+    assert parse_limits('') == {}
+    assert parse_limits(RATE_LIMITS)['send_message'] == (5.0, 20.0)
+
+
+def test_burst_then_rate():
+    clock = Clock()
+    limiter = RateLimiter({'send_message': (2, 3)}, clock=clock)
+    assert [limiter.allow('a', 'send_message') for _ in range(4)] == [True, True, True, False]
+    # Другая вкладка и события без лимита не затронуты
+    assert limiter.allow('b', 'send_message')
+    assert all(limiter.allow('a', 'typing') for _ in range(100))
+
+    clock.now += 0.25
+    assert not limiter.allow('a', 'send_message')
+    clock.now += 0.25
+    assert limiter.allow('a', 'send_message')
+    assert not limiter.allow('a', 'send_message')
+
+    # Простой не копит маркеров больше burst
+    clock.now += 60
+    assert [limiter.allow('a', 'send_message') for _ in range(4)] == [True, True, True, False]
+
+
+def test_drop_forgets_connection():
+    limiter = RateLimiter({'send_message': (1, 1), 'typing': (1, 1)}, clock=Clock())
+    limiter.allow('a', 'send_message')
+    limiter.allow('a', 'typing')
+    limiter.allow('b', 'typing')
+    assert len(limiter) == 3
+    limiter.drop('a')
+    assert len(limiter) == 1
+    assert limiter.allow('a', 'send_message')
+
+
+def test_limit_events_wraps_sync_handlers():
+    calls = []
+    server = Server({
+        'send_message': lambda sid, data: calls.append(('send_message', sid, data)),
+        'typing': lambda sid, data: calls.append(('typing', sid, data)),
+        'user_join': lambda sid, data: calls.append(('user_join', sid, data)),
+        'disconnect': lambda sid: calls.append(('disconnect', sid)),
+    })
+    limiter = RateLimiter({'send_message': (1, 1), 'typing': (1, 1)}, clock=Clock())
+    limited = []
+    limit_events(server, limiter, on_limited=lambda sid, event: limited.append((sid, event)))
+    handlers = server.handlers['/']
+
+    for _ in range(2):
+        handlers['send_message']('a', 'hi')
+        handlers['typing']('a', {})
+        handlers['user_join']('a', {})
+    assert [call[0] for call in calls] == ['send_message', 'typing', 'user_join', 'user_join']
+    assert limited == [('a', 'send_message'), ('a', 'typing')]
+    # Только отправителю и только для событий из notify
+    assert server.emitted == [('rate_limited', {'event': 'send_message'}, 'a')]
+
+    handlers['disconnect']('a')
+    assert calls[-1] == ('disconnect', 'a')
+    assert len(limiter) == 0
+
+
+def test_limit_events_wraps_async_handlers():
+    calls = []
+
+    async def send_message(sid, data):
+        calls.append(data)
+        return 'ok'
+
+    server = AsyncServer({'send_message': send_message})
+    limit_events(server, RateLimiter({'send_message': (1, 1)}, clock=Clock()))
+    handler = server.handlers['/']['send_message']
+    assert asyncio.iscoroutinefunction(handler)
+
+    assert asyncio.run(handler('a', 'one')) == 'ok'
+    assert asyncio.run(handler('a', 'two')) is None
+    assert calls == ['one']
+    assert server.emitted == [('rate_limited', {'event': 'send_message'}, 'a')]
@@ -0,0 +1,30 @@
+import gzip
+
+import static_assets
+from static_assets import STATIC_ASSETS, StaticAssets
+
+
+def headers(values):
+    return lambda name: values.get(name)
+
+
+def test_root_does_not_depend_on_cwd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assets = StaticAssets()
+    assert set(assets.assets) == set(STATIC_ASSETS)
+    status, _, body = assets.respond('chat.html', headers({}))
+    assert status == 200
+    with open(f'{static_assets.STATIC_ROOT}/chat.html', 'rb') as f:
+        assert body == f.read()
+
+
+def test_explicit_root(tmp_path):
+    (tmp_path / 'page.html').write_text('<p>' * 1000)
+    assets = StaticAssets(str(tmp_path), names=('page.html',))
+    status, response_headers, body = assets.respond('page.html', headers({'Accept-Encoding': 'gzip'}))
+    assert status == 200
+    assert ('Content-Encoding', 'gzip') in response_headers
+    assert gzip.decompress(body) == b'<p>' * 1000
+    etag = dict(response_headers)['ETag']
+    assert assets.respond('page.html', headers({'Accept-Encoding': 'gzip', 'If-None-Match': etag}))[0] == 304
+    assert assets.respond('app.py', headers({})) is None
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+
+import pytest
+
+from uploads import BlobStore, URL_PREFIX
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    store = BlobStore(str(tmp_path))
+    yield store
+    store.close()
+
+
+def upload(blobs, data, name='photo.png'):
+    writer = blobs.writer()
+    try:
+        writer.write(data)
+        return writer.commit(name)
+    finally:
+        writer.close()
+
+
+def digest_of(blobs, info):
+    path, etag = blobs.resolve(info['filename'])
+    return etag.strip('"')
+
+
+def test_attach_requires_upload_token(blobs):
+    info = upload(blobs, b'secret bytes')
+    assert blobs.attach(info['url'], None) is False
+    assert blobs.attach(info['url'], '0' * 32) is False
+    assert blobs.attach(URL_PREFIX + 'missing.png', info['token']) is False
+    assert blobs.attach(info['url'], info['token']) is True
+
+
+def test_forwarded_url_is_rejected(blobs):
+    info = upload(blobs, b'original')
+    path = blobs.resolve(info['filename'])[0]
+    assert blobs.attach(info['url'], info['token'])
+    # Чужая ссылка в сообщение не ставится - и её удаление по сроку
+    # хранения не может снять ссылку оригинала
+    assert blobs.attach(info['url'], 'forged') is False
+    assert os.path.exists(path)
+    blobs.release_files([info['url']])
+    assert not os.path.exists(path)
+
+
+def test_refs_are_counted_per_message(blobs):
+    info = upload(blobs, b'shared twice')
+    path = blobs.resolve(info['filename'])[0]
+    open(path + '.preview.jpg', 'wb').close()
+    assert blobs.attach(info['url'], info['token'])
+    assert blobs.attach(info['url'], info['token'])
+
+    blobs.release_files([info['url']])
+    assert os.path.exists(path)
+    blobs.release_files([info['url']])
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.preview.jpg')
+    assert blobs.resolve(info['filename']) is None
+    # Лишнее удаление ничего не ломает
+    blobs.release_files([info['url']])
+
+
+def test_same_content_from_two_uploads_shares_blob(blobs):
+    first = upload(blobs, b'same bytes')
+    second = upload(blobs, b'same bytes', 'copy.png')
+    assert digest_of(blobs, first) == digest_of(blobs, second)
+    assert blobs.attach(first['url'], first['token'])
+    assert blobs.attach(second['url'], second['token'])
+
+    blobs.release_files([first['url']])
+    path = blobs.resolve(second['filename'])[0]
+    assert os.path.exists(path)
+    blobs.release_files([second['url']])
+    assert not os.path.exists(path)
+
+    # Тот же хеш после удаления блоба - снова на диске
+    third = upload(blobs, b'same bytes')
+    assert os.path.exists(blobs.resolve(third['filename'])[0])
+
+
+def test_unsent_upload_is_not_released(blobs):
+    info = upload(blobs, b'never sent')
+    assert blobs.release(info['filename']) is False
+    assert blobs.resolve(info['filename']) is not None
+
+
+def test_legacy_index_is_migrated(tmp_path):
+    db = sqlite3.connect(str(tmp_path / '.index.db'))
+    db.executescript('''
+        CREATE TABLE blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL);
+        CREATE TABLE files (filename TEXT PRIMARY KEY, digest TEXT NOT NULL, original_name TEXT NOT NULL,
+                            size INTEGER NOT NULL, created REAL NOT NULL);
+        INSERT INTO blobs VALUES ('ab' || printf('%062d', 0), 1, 1);
+        INSERT INTO files VALUES ('old.png', 'ab' || printf('%062d', 0), 'old.png', 1, 0);
+    ''')
+    db.commit()
+    db.close()
+    blobs = BlobStore(str(tmp_path))
+    try:
+        # Старые имена: владелец неизвестен, число сообщений тоже - не удаляются
+        assert blobs.release('old.png') is False
+        assert blobs.attach(URL_PREFIX + 'old.png', '') is False
+        assert upload(blobs, b'new')['token']
+    finally:
+        blobs.close()
@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+
+# Кто печатает в комнате. Вместо пересылки каждого события typing всей
+# комнате копим состояние и не чаще раза в interval секунд отправляем
+# один список печатающих - и только если он изменился.
+# Повторные is_typing: true лишь продлевают срок жизни записи.
+
+logger = logging.getLogger(__name__)
+
+
+class TypingAggregator:
+    def __init__(self, emit_set, interval=0.3, ttl=5.0):
+        self.emit_set = emit_set  # emit_set(room, users)
+        self.interval = interval
+        self.ttl = ttl
+        self._typing = {}  # room -> {username: expires_at}
+        self._dirty = set()
+        self._sent = {}  # room -> последний отправленный список
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='typing-aggregator', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def update(self, room, username, is_typing):
+        with self._lock:
+            users = self._typing.get(room)
+            if is_typing:
+                if users is None:
+                    users = self._typing[room] = {}
+                if username not in users:
+                    self._dirty.add(room)
+                users[username] = time.monotonic() + self.ttl
+            elif users and users.pop(username, None) is not None:
+                self._dirty.add(room)
+                if not users:
+                    del self._typing[room]
+
+    # Пользователь отключился - убираем его из всех комнат сразу
+    def clear(self, username):
+        with self._lock:
+            for room, users in list(self._typing.items()):
+                if users.pop(username, None) is not None:
+                    self._dirty.add(room)
+                    if not users:
+                        del self._typing[room]
+
+    def typing(self, room):
+        with self._lock:
+            return sorted(self._typing.get(room, ()))
+
+    def flush(self):
+        now = time.monotonic()
+        with self._lock:
+            for room, users in list(self._typing.items()):
+                expired = [username for username, expires_at in users.items() if expires_at <= now]
+                for username in expired:
+                    del users[username]
+                if expired:
+                    self._dirty.add(room)
+                if not users:
+                    del self._typing[room]
+            updates = []
+            for room in self._dirty:
+                users = sorted(self._typing.get(room, ()))
+                if users != self._sent.get(room, []):
+                    updates.append((room, users))
+                    if users:
+                        self._sent[room] = users
+                    else:
+                        self._sent.pop(room, None)
+            self._dirty.clear()
+        for room, users in updates:
+            self.emit_set(room, users)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Ошибка рассылки typing')
@@ -0,0 +1,639 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from storage import SQLiteConnections
+
+# Загрузка файлов по частям с докачкой.
+#   init(name, size)         -> upload_id и размер части
+#   open_range(id, range)    -> запись одного диапазона байт прямо на диск
+#   status(id)               -> какие части уже есть, чтобы продолжить
+#   finalize(id)             -> файл переезжает в uploads/, ответ как у /api/upload
+#   dedup(id, proof)         -> такой файл уже есть - ссылка на него без передачи байт
+# Каждая часть пишется по своему смещению в общий файл, после записи
+# появляется файл-метка части. Повторный PUT той же части просто
+# перезаписывает те же байты, поэтому части можно слать параллельно и
+# повторять после обрыва. Незавершённые загрузки старше ttl удаляет collect().
+#
+# Каталог незавершённых: uploads/.partial/<upload_id>/{meta.json,data,chunks/}
+# sha256 файла считается по мере прихода частей (RunningDigest), finalize
+# досчитывает только то, что не успело войти в хеш.
+#
+# Готовые файлы хранятся по содержимому (BlobStore): uploads/.blobs/<sha256>,
+# одинаковые байты - один файл на диске. Индекс uploads/.index.db связывает
+# имя из ссылки /uploads/<uuid>.<ext> с блобом; у блоба считаются имена,
+# у имени - сообщения, которые на него ссылаются. Сообщение ставит ссылку
+# через attach() с token из ответа на загрузку - чужой файл в своё
+# сообщение не вставить. Когда сообщения удаляются по срокам хранения
+# (release_files), ссылки снимаются; имя без сообщений и блоб без имён удаляются.
+# Файлы, загруженные до индекса, лежат прямо в uploads/ и отдаются как раньше.
+
+URL_PREFIX = '/uploads/'
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_SIZE = 2 * 1024 * 1024 * 1024
+PARTIAL_TTL = 24 * 3600
+BLOCK_SIZE = 64 * 1024
+
+FILE_TYPES = {
+    'images': {'png', 'jpg', 'jpeg', 'gif', 'webp'},
+    'videos': {'mp4', 'avi', 'mov', 'mkv'},
+    'audio': {'mp3', 'wav', 'ogg'},
+    'documents': {'pdf', 'doc', 'docx', 'txt'},
+    'archives': {'zip', 'rar', '7z'}
+}
+
+HASH_BLOCK_SIZE = 1024 * 1024
+# Диапазон, хеш которого доказывает, что у клиента есть байты файла
+PROOF_SIZE = 64 * 1024
+
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+UPLOAD_ID = re.compile(r'[0-9a-f]{32}$')
+SHA256 = re.compile(r'[0-9a-f]{64}$')
+
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+);
+-- token - секрет загрузившего для attach(); messages - сколько сообщений
+-- ссылается на файл (NULL - файл из индекса до подсчёта, не удаляется)
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    digest TEXT NOT NULL REFERENCES blobs(digest),
+    original_name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    token TEXT,
+    messages INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+'''
+# Индекс без подсчёта ссылок сообщений
+INDEX_COLUMNS = (('token', 'TEXT'), ('messages', 'INTEGER'))
+
+SQL_BLOB = 'SELECT size, refs FROM blobs WHERE digest = ?'
+SQL_INSERT_BLOB = 'INSERT INTO blobs (digest, size, refs) VALUES (?, ?, 1)'
+SQL_ADD_REF = 'UPDATE blobs SET refs = refs + 1 WHERE digest = ?'
+SQL_DROP_REF = 'UPDATE blobs SET refs = refs - 1 WHERE digest = ?'
+SQL_DELETE_BLOB = 'DELETE FROM blobs WHERE digest = ?'
+SQL_INSERT_FILE = '''INSERT INTO files (filename, digest, original_name, size, created, token, messages)
+    VALUES (?, ?, ?, ?, ?, ?, 0)'''
+SQL_FILE = 'SELECT digest, original_name, size, token, messages FROM files WHERE filename = ?'
+SQL_DELETE_FILE = 'DELETE FROM files WHERE filename = ?'
+SQL_ATTACH = 'UPDATE files SET messages = messages + 1 WHERE filename = ?'
+SQL_DETACH = 'UPDATE files SET messages = messages - 1 WHERE filename = ?'
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def file_extension(name):
+    return name.rsplit('.', 1)[1].lower() if '.' in name else ''
+
+
+def file_type(extension):
+    for type_name, extensions in FILE_TYPES.items():
+        if extension in extensions:
+            return type_name
+    return 'other'
+
+
+# Ответ на загрузку - тот же, что отдавал /api/upload в server.py, плюс
+# token: его знает только загрузивший, с ним файл прикладывается к сообщению
+def upload_info(filename, original_name, size, token):
+    extension = file_extension(original_name)
+    return {
+        'success': True,
+        'filename': filename,
+        'original_name': original_name,
+        'url': f'/uploads/{filename}',
+        'type': file_type(extension),
+        'size': size,
+        'extension': extension,
+        'token': token
+    }
+
+
+# Поток байт -> временный файл, sha256 считается по ходу записи
+class BlobWriter:
+    def __init__(self, store):
+        self.store = store
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.tmp_dir)
+        self._file = os.fdopen(fd, 'wb')
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def commit(self, original_name):
+        self._file.close()
+        return self.store.add(self.tmp_path, self._hash.hexdigest(), self.size, original_name)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class BlobStore:
+    # on_store(digest, info) -> доп. поля ответа; вызывается после каждого
+    # сохранения файла (например, PreviewPipeline.on_store)
+    def __init__(self, upload_folder, index_path=None, on_store=None):
+        self.upload_folder = upload_folder
+        self.on_store = on_store
+        self.root = os.path.join(upload_folder, '.blobs')
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self._connections = SQLiteConnections(index_path or os.path.join(upload_folder, '.index.db'))
+        self._db = self._connections.get
+        self._db().executescript(INDEX_SCHEMA)
+        columns = {row['name'] for row in self._db().execute('PRAGMA table_info(files)')}
+        for name, type in INDEX_COLUMNS:
+            if name not in columns:
+                self._db().execute(f'ALTER TABLE files ADD COLUMN {name} {type}')
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def writer(self):
+        return BlobWriter(self)
+
+    # Готовый файл tmp_path с известным хешем -> новое имя для ссылки.
+    # Если такой блоб уже есть, tmp_path удаляется, на диске остаётся одна копия.
+    def add(self, tmp_path, digest, size, original_name):
+        path = self.blob_path(digest)
+        filename = f"{uuid.uuid4().hex}.{file_extension(original_name)}"
+        token = secrets.token_hex(16)
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if db.execute(SQL_BLOB, (digest,)).fetchone() is None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                db.execute(SQL_INSERT_BLOB, (digest, size))
+            else:
+                os.remove(tmp_path)
+                db.execute(SQL_ADD_REF, (digest,))
+            db.execute(SQL_INSERT_FILE, (filename, digest, original_name, size, time.time(), token))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return self._stored(digest, upload_info(filename, original_name, size, token))
+
+    # Проверка до загрузки: блоб с таким хешем и размером уже есть и клиент
+    # доказал, что у него есть сами байты, - новая ссылка на блоб без
+    # передачи байт. Иначе None. Одного хеша мало: его знает любой, кто
+    # где-то видел файл, и ссылка отдала бы ему содержимое.
+    def link(self, digest, size, original_name, challenge, proof):
+        if not SHA256.match(digest or '') or not isinstance(proof, str):
+            return None
+        filename = f"{uuid.uuid4().hex}.{file_extension(original_name)}"
+        token = secrets.token_hex(16)
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(SQL_BLOB, (digest,)).fetchone()
+            if row is None or row['size'] != size or not self._proved(digest, challenge, proof):
+                db.execute('ROLLBACK')
+                return None
+            db.execute(SQL_ADD_REF, (digest,))
+            db.execute(SQL_INSERT_FILE, (filename, digest, original_name, size, time.time(), token))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return self._stored(digest, upload_info(filename, original_name, size, token))
+
+    # proof - sha256(nonce + байты [start, end) блоба), диапазон выбрал сервер
+    def _proved(self, digest, challenge, proof):
+        start, end = challenge['start'], challenge['end']
+        with open(self.blob_path(digest), 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        expected = hashlib.sha256(challenge['nonce'].encode() + data).hexdigest()
+        return hmac.compare_digest(expected, proof)
+
+    def _stored(self, digest, info):
+        if self.on_store is not None:
+            info.update(self.on_store(digest, info))
+        return info
+
+    # Сообщение с файлом url: ставит ссылку, только если token совпал с
+    # выданным при загрузке. False - файла нет в индексе или он чужой.
+    def attach(self, url, token):
+        if not isinstance(url, str) or not url.startswith(URL_PREFIX) or not isinstance(token, str):
+            return False
+        filename = url[len(URL_PREFIX):]
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(SQL_FILE, (filename,)).fetchone()
+            if row is None or row['token'] is None or not hmac.compare_digest(row['token'], token):
+                db.execute('ROLLBACK')
+                return False
+            db.execute(SQL_ATTACH, (filename,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return True
+
+    # Сообщение со ссылкой удалено. Имя без сообщений удаляется, блоб без
+    # имён - с диска вместе с производными (<sha256>.preview.jpg и т.п.).
+    # Файлы удаляются до COMMIT: add() того же хеша ждёт эту транзакцию и
+    # кладёт свой файл уже после, а не теряет его.
+    def release(self, filename):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(SQL_FILE, (filename,)).fetchone()
+            if row is None or not row['messages']:
+                db.execute('ROLLBACK')
+                return False
+            digest = row['digest']
+            if row['messages'] > 1:
+                db.execute(SQL_DETACH, (filename,))
+            else:
+                db.execute(SQL_DELETE_FILE, (filename,))
+                db.execute(SQL_DROP_REF, (digest,))
+                if db.execute(SQL_BLOB, (digest,)).fetchone()['refs'] <= 0:
+                    db.execute(SQL_DELETE_BLOB, (digest,))
+                    self._remove_blob(digest)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return True
+
+    def _remove_blob(self, digest):
+        directory = os.path.dirname(self.blob_path(digest))
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name == digest or name.startswith(digest + '.'):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+    # Имя из ссылки /uploads/<filename> -> (путь на диске, ETag) или None.
+    # ETag блоба - его хеш. Старые файлы прямо в uploads/ тоже не меняются,
+    # им хватает размера и времени записи (служебные .blobs, .partial и
+    # .index.db наружу не отдаются).
+    def resolve(self, filename):
+        row = self._db().execute(SQL_FILE, (filename,)).fetchone()
+        if row is not None:
+            return self.blob_path(row['digest']), f'"{row["digest"]}"'
+        if filename.startswith('.') or os.path.basename(filename) != filename:
+            return None
+        path = os.path.join(self.upload_folder, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        return path, f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    # Поля file удалённых сообщений (storage.enforce_retention, on_trim):
+    # по ссылке на каждое сообщение, старые файлы без индекса не трогаем
+    def release_files(self, files):
+        for url in files:
+            if url.startswith(URL_PREFIX):
+                self.release(url[len(URL_PREFIX):])
+
+    # Временные файлы оборванных загрузок
+    def collect(self, ttl, now=None):
+        cutoff = (time.time() if now is None else now) - ttl
+        removed = 0
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def close(self):
+        self._connections.close()
+
+
+# sha256 непрерывного начала файла загрузки в этом процессе. Части идут
+# в любом порядке: та, что продолжает начало, хешируется прямо из тела
+# запроса, пришедшие раньше - дочитываются с диска, когда дыра перед
+# ними закроется. busy - хеш сейчас продвигает один поток.
+class RunningDigest:
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.next_index = 0
+        self.busy = False
+
+
+class RangeWriter:
+    # running - захваченный RunningDigest, если часть продолжает хеш
+    def __init__(self, uploads, upload, index, start, length, running=None):
+        self.uploads = uploads
+        self.upload = upload
+        self.index = index
+        self.remaining = length
+        self.running = running
+        self._file = open(os.path.join(upload.path, 'data'), 'r+b')
+        self._file.seek(start)
+
+    def write(self, data):
+        if len(data) > self.remaining:
+            self.close()
+            raise UploadError('Тело запроса длиннее диапазона')
+        self._file.write(data)
+        if self.running is not None:
+            self.running.hash.update(data)
+        self.remaining -= len(data)
+
+    # Метка части появляется только когда все её байты на диске
+    def commit(self):
+        self._file.close()
+        if self.remaining:
+            self.close()
+            raise UploadError('Диапазон передан не полностью')
+        open(os.path.join(self.upload.path, 'chunks', str(self.index)), 'wb').close()
+        self.upload.touch()
+        running, self.running = self.running, None
+        if running is not None:
+            running.next_index = self.index + 1
+        self.uploads.advance(self.upload, running)
+        return self.index
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        # Часть не дописана, а в хеш уже попала - хеш придётся начать заново
+        if self.running is not None:
+            self.uploads.discard_digest(self.upload.upload_id)
+            self.running = None
+
+
+class PartialUpload:
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    @property
+    def upload_id(self):
+        return os.path.basename(self.path)
+
+    @property
+    def size(self):
+        return self.meta['size']
+
+    @property
+    def chunk_size(self):
+        return self.meta['chunk_size']
+
+    @property
+    def chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def received(self):
+        return sorted(int(name) for name in os.listdir(os.path.join(self.path, 'chunks')))
+
+    def touch(self):
+        os.utime(os.path.join(self.path, 'meta.json'))
+
+    def save(self):
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+
+class ChunkedUploads:
+    def __init__(self, upload_folder, blobs, chunk_size=CHUNK_SIZE, max_size=MAX_SIZE, ttl=PARTIAL_TTL,
+                 allowed_extensions=None):
+        self.upload_folder = upload_folder
+        self.blobs = blobs
+        self.root = os.path.join(upload_folder, '.partial')
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self.allowed_extensions = allowed_extensions
+        self._digests = {}  # upload_id -> RunningDigest
+        self._digests_lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_env(cls, upload_folder, blobs, allowed_extensions=None):
+        return cls(
+            upload_folder,
+            blobs,
+            chunk_size=int(os.environ.get('UPLOAD_CHUNK_SIZE', CHUNK_SIZE)),
+            max_size=int(os.environ.get('UPLOAD_MAX_SIZE', MAX_SIZE)),
+            ttl=float(os.environ.get('UPLOAD_PARTIAL_TTL', PARTIAL_TTL)),
+            allowed_extensions=allowed_extensions
+        )
+
+    # sha256 (необязательно) - хеш всего файла, посчитанный клиентом. Тогда
+    # в ответе есть proof: {start, end, nonce} - клиент может прислать
+    # sha256(nonce + байты [start, end)) в dedup() и, если такой файл уже
+    # есть, получить ссылку на него. proof выдаётся всегда, есть файл или
+    # нет, поэтому init не подтверждает, что файл с этим хешем на сервере.
+    def init(self, name, size, sha256=None):
+        name = os.path.basename(name or '')
+        if not name:
+            raise UploadError('Файл не выбран')
+        if not isinstance(size, int) or size < 0:
+            raise UploadError('Неверный размер файла')
+        if size > self.max_size:
+            raise UploadError('Файл слишком большой', 413)
+        if self.allowed_extensions is not None and file_extension(name) not in self.allowed_extensions:
+            raise UploadError('Недопустимый тип файла')
+
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.root, upload_id)
+        os.makedirs(os.path.join(path, 'chunks'))
+        # Файл сразу нужного размера: части пишутся по своим смещениям
+        with open(os.path.join(path, 'data'), 'wb') as f:
+            f.truncate(size)
+        meta = {'name': name, 'size': size, 'chunk_size': self.chunk_size, 'created': time.time()}
+        if sha256 and size:
+            start = secrets.randbelow(max(size - PROOF_SIZE, 0) + 1)
+            meta['sha256'] = sha256
+            meta['proof'] = {'start': start, 'end': min(start + PROOF_SIZE, size), 'nonce': secrets.token_hex(16)}
+        upload = PartialUpload(path, meta)
+        upload.save()
+        info = {'success': True, 'upload_id': upload_id, 'chunk_size': upload.chunk_size, 'chunks': upload.chunks}
+        if 'proof' in meta:
+            info['proof'] = meta['proof']
+        return info
+
+    def get(self, upload_id):
+        if not UPLOAD_ID.match(upload_id or ''):
+            raise UploadError('Загрузка не найдена', 404)
+        path = os.path.join(self.root, upload_id)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                return PartialUpload(path, json.load(f))
+        except FileNotFoundError:
+            raise UploadError('Загрузка не найдена', 404)
+
+    # content_range - заголовок Content-Range: bytes start-end/total.
+    # Диапазон должен совпадать с одной частью.
+    def open_range(self, upload_id, content_range):
+        upload = self.get(upload_id)
+        match = CONTENT_RANGE.match(content_range or '')
+        if match is None:
+            raise UploadError('Нужен заголовок Content-Range: bytes start-end/total')
+        start, end, total = (int(value) for value in match.groups())
+        if total != upload.size or start % upload.chunk_size or end < start:
+            raise UploadError('Неверный диапазон', 416)
+        index = start // upload.chunk_size
+        if end + 1 != min(start + upload.chunk_size, upload.size):
+            raise UploadError('Неверный диапазон', 416)
+        return RangeWriter(self, upload, index, start, end + 1 - start, self._claim(upload_id, index))
+
+    # Захватить хеш загрузки; index - только если хеш дошёл ровно до этой части
+    def _claim(self, upload_id, index=None):
+        with self._digests_lock:
+            running = self._digests.get(upload_id)
+            if running is None:
+                running = self._digests[upload_id] = RunningDigest()
+            if running.busy or (index is not None and running.next_index != index):
+                return None
+            running.busy = True
+            return running
+
+    def discard_digest(self, upload_id):
+        with self._digests_lock:
+            self._digests.pop(upload_id, None)
+
+    # Продвинуть хеш по частям, которые уже на диске. running - захваченный
+    # вызывающим или None: тогда захватываем сами, а если хеш занят - его
+    # продвинет владелец (или досчитает finalize).
+    def advance(self, upload, running=None):
+        if running is None:
+            running = self._claim(upload.upload_id)
+            if running is None:
+                return
+        try:
+            received = set(upload.received())
+            if running.next_index in received:
+                with open(os.path.join(upload.path, 'data'), 'rb') as f:
+                    while running.next_index in received:
+                        self._hash_chunk(f, upload, running)
+        except FileNotFoundError:
+            # Загрузку уже забрал finalize
+            pass
+        finally:
+            with self._digests_lock:
+                running.busy = False
+
+    def _hash_chunk(self, f, upload, running):
+        start = running.next_index * upload.chunk_size
+        remaining = min(upload.chunk_size, upload.size - start)
+        f.seek(start)
+        while remaining > 0:
+            block = f.read(min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            running.hash.update(block)
+            remaining -= len(block)
+        running.next_index += 1
+
+    # Ответ на proof из init. Проверка одна на загрузку: дальше - обычная
+    # передача частей. Нет такого файла и неверный proof неотличимы.
+    def dedup(self, upload_id, proof):
+        upload = self.get(upload_id)
+        challenge = upload.meta.pop('proof', None)
+        if challenge is None:
+            raise UploadError('Проверка уже выполнена', 409)
+        upload.save()
+        info = self.blobs.link(upload.meta['sha256'], upload.size, upload.meta['name'], challenge, proof)
+        if info is None:
+            return {'success': True, 'deduplicated': False}
+        shutil.rmtree(upload.path, ignore_errors=True)
+        return dict(info, deduplicated=True)
+
+    def status(self, upload_id):
+        upload = self.get(upload_id)
+        return {
+            'success': True,
+            'upload_id': upload_id,
+            'size': upload.size,
+            'chunk_size': upload.chunk_size,
+            'chunks': upload.chunks,
+            'received': upload.received()
+        }
+
+    def finalize(self, upload_id):
+        upload = self.get(upload_id)
+        received = upload.received()
+        # Пустой файл - одна часть без байт
+        if upload.size and len(received) != upload.chunks:
+            missing = sorted(set(range(upload.chunks)) - set(received))
+            raise UploadError(f'Не хватает частей: {missing[:10]}', 409)
+
+        # Хеш, накопленный по мере прихода частей; занятый другим потоком
+        # или оставшийся в другом процессе - считаем заново
+        with self._digests_lock:
+            running = self._digests.pop(upload_id, None)
+        if running is None or running.busy:
+            running = RunningDigest()
+
+        # Файл сначала забирается из каталога загрузки: параллельный
+        # finalize той же загрузки получит 404, а не второй экземпляр.
+        fd, tmp_path = tempfile.mkstemp(dir=self.blobs.tmp_dir)
+        os.close(fd)
+        try:
+            os.replace(os.path.join(upload.path, 'data'), tmp_path)
+        except FileNotFoundError:
+            os.remove(tmp_path)
+            raise UploadError('Загрузка не найдена', 404)
+        shutil.rmtree(upload.path, ignore_errors=True)
+        try:
+            with open(tmp_path, 'rb') as f:
+                while running.next_index < upload.chunks:
+                    self._hash_chunk(f, upload, running)
+            return self.blobs.add(tmp_path, running.hash.hexdigest(), upload.size, upload.meta['name'])
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Брошенные загрузки: meta.json не обновлялся дольше ttl
+    def collect(self, now=None):
+        cutoff = (time.time() if now is None else now) - self.ttl
+        removed = 0
+        for upload_id in os.listdir(self.root):
+            path = os.path.join(self.root, upload_id)
+            try:
+                if os.path.getmtime(os.path.join(path, 'meta.json')) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                # Загрузка только создаётся или уже финализирована
+                if os.path.exists(path) and os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+        with self._digests_lock:
+            for upload_id in list(self._digests):
+                if not os.path.isdir(os.path.join(self.root, upload_id)):
+                    del self._digests[upload_id]
+        return removed + self.blobs.collect(self.ttl, now)